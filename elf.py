@@ -0,0 +1,50 @@
+#!/usr/bin/python
+import struct
+
+from ihex import data_rec, data_segments
+
+# reads the loadable segments of a 32 bit little endian ELF file
+class elf:
+    PT_LOAD = 1
+
+    def __init__(self, filename):
+        fd = open(filename, "rb")
+        image = fd.read()
+        fd.close()
+
+        if image[0:4] != b"\x7fELF":
+            raise Exception("not an ELF file")
+        if image[4] != 1 or image[5] != 1:
+            raise Exception("only 32 bit little endian ELF files are supported")
+
+        (e_entry, e_phoff, e_phentsize, e_phnum) = \
+                self.unpack("<24xII10xHH", image, 0)
+
+        self.start_addr = e_entry
+
+        self.data = []
+        for i in range(0, e_phnum):
+            (p_type, p_offset, p_vaddr, p_paddr, p_filesz) = \
+                    self.unpack("<IIIII", image, e_phoff + i * e_phentsize)
+            if p_type != self.PT_LOAD or p_filesz == 0:
+                continue
+            data = image[p_offset:p_offset + p_filesz]
+            if len(data) != p_filesz:
+                raise Exception("segment %d is truncated" % i)
+            # the physical address is where the data is loaded
+            self.data.append(data_rec(p_paddr, data))
+
+    def unpack(self, fmt, image, offset):
+        size = struct.calcsize(fmt)
+        if offset + size > len(image):
+            raise Exception("file is truncated")
+        return struct.unpack(fmt, image[offset:offset + size])
+
+    def dump(self):
+        for d in self.data:
+            print(d)
+
+    # return the data as a sorted list of (address, data) tuples, one for
+    # each contiguous run of data
+    def segments(self):
+        return data_segments(self.data, "segments")
@@ -12,6 +12,27 @@ class data_rec:
     def __repr__(self):
         return "%08x: %x" % (self.addr, len(self.data))
 
+
+# the data of a list of data_rec as a sorted list of (address, data)
+# tuples, one for each contiguous run of data. what names the records in
+# the error raised when they overlap.
+def data_segments(records, what="records"):
+    sort_list = []
+    for d in records:
+        sort_list.append((d.addr, d.data))
+    sort_list.sort(key=lambda x: x[0])
+    segments = []
+    for (addr, data) in sort_list:
+        if segments:
+            last_addr = segments[-1][0] + len(segments[-1][1])
+            if addr < last_addr:
+                raise Exception("overlapping %s in file" % what)
+            if addr == last_addr:
+                segments[-1][1].extend(data)
+                continue
+        segments.append((addr, bytearray(data)))
+    return [(addr, bytes(data)) for (addr, data) in segments]
+
 class ihex:
     TYPE_DATA = 0
     TYPE_EOF = 1
@@ -98,12 +119,19 @@ class ihex:
         intlist = [fill for _ in range(len)]
         return self.intlist_tostr(intlist)
 
+    # return the data as a sorted list of (address, data) tuples, one for
+    # each contiguous run of data
+    def segments(self):
+        return data_segments(self.data, "sections")
+
     def flatten(self, fill = 0xff):
         sort_list = []
         for d in self.data:
             sort_list.append((d.addr, d.data))
         sort_list.sort(key=lambda x: x[0])
-        data = b''
+        # pieces are joined once at the end, appending to a byte string
+        # copies all of it every time
+        pieces = []
         last_addr = sort_list[0][0]
         start_addr = last_addr
         for e in sort_list:
@@ -113,8 +141,38 @@ class ihex:
             if pad < 0:
                 raise Exception("overlapping sections in file")
             if pad > 0:
-                data += self.padding(fill, pad)
+                pieces.append(self.padding(fill, pad))
                 l += pad
-            data += e[1]
+            pieces.append(e[1])
             last_addr += l
-        return (start_addr, data)
+        return (start_addr, b''.join(pieces))
+
+
+def record(addr, rtype, data):
+    rec = bytes([len(data), (addr >> 8) & 0xff, addr & 0xff, rtype]) + data
+    csum = (0x100 - sum(rec) % 0x100) % 0x100
+    return ":%s%02X\n" % ("".join(["%02X" % x for x in rec]), csum)
+
+
+# write a list of (address, data) segments as an intel hex file using
+# extended linear address records for addresses above 64k
+def write(filename, segments, start_addr=None, record_size=16):
+    fd = open(filename, "w")
+    upper = None
+    for (addr, data) in segments:
+        i = 0
+        while i < len(data):
+            a = addr + i
+            # records must not cross a 64k boundary
+            count = min(record_size, len(data) - i, 0x10000 - (a & 0xffff))
+            if a >> 16 != upper:
+                upper = a >> 16
+                fd.write(record(0, ihex.TYPE_EXTENDED_LINEAR_ADDR,
+                        bytes([upper >> 8, upper & 0xff])))
+            fd.write(record(a & 0xffff, ihex.TYPE_DATA, data[i:i + count]))
+            i += count
+    if start_addr is not None:
+        fd.write(record(0, ihex.TYPE_START_LINEAR_ADDR,
+                start_addr.to_bytes(4, "big")))
+    fd.write(record(0, ihex.TYPE_EOF, b''))
+    fd.close()
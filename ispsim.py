@@ -0,0 +1,640 @@
+#!/usr/bin/python3
+#
+# A stand-in for the LPC ISP bootloader.
+#
+# The simulator implements the same device interface as the serial and udp
+# devices in nxpprog (write, readline and read) so an nxpprog session can
+# be run against it without any hardware. It models the flash sectors, the
+# ram used as programming buffer and the command state machine closely
+# enough to check the programmer end to end.
+#
+# While running it accounts for the traffic of every phase of the session
+# which is what the transfer planner (nxpprog.py --plan) is built on.
+
+import binascii
+import socket
+import sys
+
+import nxpprog
+
+# commands refused until the unlock command has been given
+LOCKED_CMDS = "ECG"
+
+# session phase a command is accounted to. P is accounted to the phase
+# of the command following it, all others belong to the sync phase.
+cmd_phase = {
+        "E": "erase",
+        "I": "erase",
+        "W": "program",
+        "C": "program",
+        "M": "program",
+        "R": "verify",
+        "G": "start",
+        "S": "start",
+}
+
+phases = ("sync", "erase", "program", "verify", "start")
+
+# timing model used by the planner
+plan_model_default = {
+        # seconds from the end of a request to the start of its response,
+        # dominated by the usb serial adapter latency
+        "turnaround": 0.002,
+        # bits per character on a serial line: start, 8 data and stop bit
+        "char_bits": 10,
+        # bit rate used for udp transfers
+        "udp_bit_rate": 10000000,
+        # seconds to erase one flash sector
+        "erase_time": 0.1,
+        # seconds to blank check one flash sector
+        "blank_check_time": 0.001,
+        # seconds to copy 256 bytes from ram to flash
+        "copy_time": 0.001,
+        # seconds waited for a response that never comes when no timeout
+        # is given
+        "timeout": 5,
+}
+
+
+class IspSimulator(object):
+    def __init__(self, cpu, echo=True, ram_base=0x10000000, transfer=None):
+        self.parms = nxpprog.cpu_parms[cpu]
+        self.cpu = cpu
+        self.echo = echo
+        # uuencode or binary W and R data, by default that of the cpu
+        self.transfer = transfer or self.parms.get("transfer", "uuencode")
+
+        self.sectors = self.parms["flash_sector"]
+        self.sector_count = self.parms.get("flash_sector_count",
+                len(self.sectors))
+        self.flash_size = 1024 * sum(self.sectors[:self.sector_count])
+        banks = self.parms.get("flash_bank_addr", 0)
+        if banks == 0:
+            self.banks = (0,)
+        elif isinstance(banks, tuple):
+            self.banks = banks
+        else:
+            self.banks = (banks,)
+        self.flash = [bytearray(b'\xff' * self.flash_size)
+                for _ in self.banks]
+        self.prepared = [set() for _ in self.banks]
+
+        # ram is stored sparsely in 1k pages
+        self.ram = {}
+
+        self.locked = True
+        self.state = "sync"
+        self.inbuf = b''
+        self.outbuf = b''
+
+        # the active W or R transfer
+        self.xfer = None
+
+        # accounting, see account()
+        self.commands = []
+        self.phase = "sync"
+        self.stats = {}
+        self.last_io = None
+
+    # start over as after a reset into isp mode, the memory is kept
+    def reset(self, echo=True):
+        self.echo = echo
+        self.locked = True
+        self.state = "sync"
+        self.inbuf = b''
+        self.outbuf = b''
+        self.xfer = None
+        for prepared in self.prepared:
+            prepared.clear()
+
+    # device interface
+
+    def write(self, data):
+        self.last_io = "write"
+        self.inbuf += data
+        self.process()
+
+    def readline(self, timeout=None):
+        self.turnaround()
+        while True:
+            i = self.outbuf.find(b'\n')
+            if i < 0:
+                line = self.outbuf
+                self.outbuf = b''
+            else:
+                line = self.outbuf[:i]
+                self.outbuf = self.outbuf[i + 1:]
+            line = line.strip(b'\r')
+            if line or i < 0:
+                if not line:
+                    self.timeout(timeout)
+                return line.decode("UTF-8", "ignore")
+
+    def read(self, size, timeout=None):
+        self.turnaround()
+        data = self.outbuf[:size]
+        self.outbuf = self.outbuf[size:]
+        if len(data) < size:
+            self.timeout(timeout)
+        return data
+
+    # accounting
+
+    def account(self, key, value):
+        stats = self.stats.setdefault(self.phase, {})
+        stats[key] = stats.get(key, 0) + value
+
+    def turnaround(self):
+        if self.last_io == "write":
+            self.account("round_trips", 1)
+        self.last_io = "read"
+
+    def timeout(self, timeout):
+        self.account("timeouts", 1)
+        self.account("timeout_time",
+                timeout or plan_model_default["timeout"])
+
+    def set_phase(self, cmd):
+        phase = cmd_phase.get(cmd, "sync")
+        if cmd == "S" and self.parms.get("read_crc"):
+            # S reads a crc instead of selecting the boot bank
+            phase = "verify"
+        if cmd == "P":
+            phase = "prepare"
+        elif "prepare" in self.stats:
+            # fold the preceding prepare command into this phase
+            stats = self.stats.setdefault(phase, {})
+            for (key, value) in self.stats.pop("prepare").items():
+                stats[key] = stats.get(key, 0) + value
+        self.phase = phase
+
+    # the estimated duration of every phase of the session using the
+    # timing model from plan_model_default, updated with model
+    def report(self, baud=115200, udp=False, model=None):
+        m = dict(plan_model_default)
+        if model:
+            m.update(model)
+
+        if udp:
+            byte_time = 8.0 / m["udp_bit_rate"]
+        else:
+            byte_time = float(m["char_bits"]) / baud
+
+        report = { "commands": self.commands, "phases": {} }
+        total = {}
+        for phase in phases:
+            stats = self.stats.get(phase)
+            if not stats:
+                continue
+            entry = {}
+            for key in ("commands", "tx_bytes", "rx_bytes", "round_trips",
+                    "timeouts"):
+                entry[key] = stats.get(key, 0)
+            entry["seconds"] = \
+                    (entry["tx_bytes"] + entry["rx_bytes"]) * byte_time + \
+                    entry["round_trips"] * m["turnaround"] + \
+                    stats.get("timeout_time", 0) + \
+                    stats.get("delay_time", 0) + \
+                    stats.get("erase_sectors", 0) * m["erase_time"] + \
+                    stats.get("blank_check_sectors", 0) * \
+                            m["blank_check_time"] + \
+                    stats.get("copy_bytes", 0) / 256.0 * m["copy_time"]
+            report["phases"][phase] = entry
+            for (key, value) in entry.items():
+                total[key] = total.get(key, 0) + value
+        report["total"] = total
+        return report
+
+    # memory model
+
+    def flash_index(self, addr):
+        for bank in range(0, len(self.banks)):
+            offset = addr - self.banks[bank]
+            if offset >= 0 and offset < self.flash_size:
+                return (bank, offset)
+        return (None, None)
+
+    def sector_range(self, sector):
+        start = 1024 * sum(self.sectors[:sector])
+        return (start, start + 1024 * self.sectors[sector])
+
+    def sector_of(self, offset):
+        for sector in range(0, self.sector_count):
+            (start, end) = self.sector_range(sector)
+            if offset >= start and offset < end:
+                return sector
+        return None
+
+    def mem_read(self, addr, count):
+        (bank, offset) = self.flash_index(addr)
+        if bank is not None:
+            return bytes(self.flash[bank][offset:offset + count])
+        data = b''
+        for a in range(addr, addr + count):
+            page = self.ram.get(a // 1024)
+            data += bytes([page[a % 1024] if page else 0])
+        return data
+
+    def ram_write(self, addr, data):
+        for i in range(0, len(data)):
+            a = addr + i
+            page = self.ram.setdefault(a // 1024, bytearray(1024))
+            page[a % 1024] = data[i]
+
+    # output helpers
+
+    def send(self, data):
+        self.account("rx_bytes", len(data))
+        self.outbuf += data
+
+    def sendln(self, line):
+        self.send(("%s\r\n" % line).encode("UTF-8"))
+
+    def status(self, code):
+        self.sendln("%d" % code)
+
+    # input processing
+
+    def process(self):
+        while True:
+            if self.state == "sync":
+                i = self.inbuf.find(b'?')
+                if i < 0:
+                    self.inbuf = b''
+                    return
+                self.inbuf = self.inbuf[i + 1:]
+                self.account("tx_bytes", i + 1)
+                self.sendln("Synchronized")
+                self.state = "sync_ack"
+                continue
+
+            if self.state == "wbin":
+                if not self.inbuf:
+                    return
+                self.write_data_binary()
+                continue
+
+            i = self.inbuf.find(b'\n')
+            if i < 0:
+                return
+            line = self.inbuf[:i].strip(b'\r').decode("UTF-8", "ignore")
+            self.inbuf = self.inbuf[i + 1:]
+            if self.state == "cmd" and line.split():
+                self.set_phase(line.split()[0])
+            self.account("tx_bytes", i + 1)
+            if not line and self.state != "wdata":
+                continue
+
+            if self.echo and self.state != "rack":
+                self.sendln(line)
+
+            if self.state == "sync_ack":
+                if line == "Synchronized":
+                    self.sendln("OK")
+                    self.state = "osc"
+            elif self.state == "osc":
+                self.sendln("OK")
+                self.state = "cmd"
+            elif self.state == "wdata":
+                self.write_data_line(line)
+            elif self.state == "rack":
+                self.read_ack(line)
+            else:
+                self.command(line)
+
+    def command(self, line):
+        args = line.split()
+        if not args:
+            return
+        cmd = args[0]
+
+        self.commands.append(line)
+        self.account("commands", 1)
+        try:
+            vals = [int(x) for x in args[1:] if x not in ("A", "T")]
+        except ValueError:
+            self.status(nxpprog.PARAM_ERROR)
+            return
+
+        if self.locked and cmd in LOCKED_CMDS:
+            self.status(nxpprog.CMD_LOCKED)
+            return
+
+        handler = getattr(self, "cmd_" + cmd, None)
+        if not handler:
+            self.status(nxpprog.INVALID_COMMAND)
+            return
+        handler(vals)
+
+    def bank_arg(self, vals, count):
+        if len(self.banks) > 1 or "flash_bank_addr" in self.parms:
+            if len(vals) != count + 1:
+                return None
+            return vals[count]
+        if len(vals) != count:
+            return None
+        return 0
+
+    def sector_args(self, vals):
+        bank = self.bank_arg(vals, 2)
+        if bank is None:
+            self.status(nxpprog.PARAM_ERROR)
+            return None
+        (start, end) = vals[0:2]
+        if bank >= len(self.banks) or start > end or \
+                end >= self.sector_count:
+            self.status(nxpprog.INVALID_SECTOR)
+            return None
+        return (bank, start, end)
+
+    def cmd_U(self, vals):
+        if vals != [23130]:
+            self.status(nxpprog.INVALID_CODE)
+            return
+        self.locked = False
+        self.status(nxpprog.CMD_SUCCESS)
+
+    def cmd_A(self, vals):
+        self.status(nxpprog.CMD_SUCCESS)
+        self.echo = bool(vals and vals[0])
+
+    def cmd_B(self, vals):
+        self.status(nxpprog.CMD_SUCCESS)
+
+    def cmd_J(self, vals):
+        self.status(nxpprog.CMD_SUCCESS)
+        devid = self.parms.get("devid", 0)
+        if isinstance(devid, tuple):
+            for d in devid:
+                self.sendln("%d" % d)
+        else:
+            self.sendln("%d" % devid)
+
+    def cmd_N(self, vals):
+        self.status(nxpprog.CMD_SUCCESS)
+        for word in (0x12345678, 0x9abcdef0, 0x0badcafe, 0x00c0ffee):
+            self.sendln("%d" % word)
+
+    def cmd_P(self, vals):
+        args = self.sector_args(vals)
+        if not args:
+            return
+        (bank, start, end) = args
+        self.prepared[bank].update(range(start, end + 1))
+        self.status(nxpprog.CMD_SUCCESS)
+
+    def cmd_E(self, vals):
+        args = self.sector_args(vals)
+        if not args:
+            return
+        (bank, start, end) = args
+        for sector in range(start, end + 1):
+            if sector not in self.prepared[bank]:
+                self.status(nxpprog.SECTOR_NOT_PREPARED_FOR_WRITE_OPERATION)
+                return
+        for sector in range(start, end + 1):
+            (s, e) = self.sector_range(sector)
+            self.flash[bank][s:e] = b'\xff' * (e - s)
+        self.account("erase_sectors", end - start + 1)
+        self.prepared[bank].clear()
+        self.status(nxpprog.CMD_SUCCESS)
+
+    def cmd_I(self, vals):
+        args = self.sector_args(vals)
+        if not args:
+            return
+        (bank, start, end) = args
+        self.account("blank_check_sectors", end - start + 1)
+        (s, _) = self.sector_range(start)
+        (_, e) = self.sector_range(end)
+        for offset in range(s, e, 4):
+            word = self.flash[bank][offset:offset + 4]
+            if word != b'\xff\xff\xff\xff':
+                self.status(nxpprog.SECTOR_NOT_BLANK)
+                self.sendln("%d" % offset)
+                self.sendln("%d" % int.from_bytes(word, "little"))
+                return
+        self.status(nxpprog.CMD_SUCCESS)
+
+    def cmd_C(self, vals):
+        if len(vals) != 3:
+            self.status(nxpprog.PARAM_ERROR)
+            return
+        (dst, src, count) = vals
+        (bank, offset) = self.flash_index(dst)
+        if bank is None:
+            self.status(nxpprog.DST_ADDR_NOT_MAPPED)
+            return
+        if dst % 256:
+            self.status(nxpprog.DST_ADDR_ERROR)
+            return
+        if count not in (256, 512, 1024, 4096):
+            self.status(nxpprog.COUNT_ERROR)
+            return
+        for o in range(offset, offset + count, 1024):
+            if self.sector_of(o) not in self.prepared[bank]:
+                self.status(nxpprog.SECTOR_NOT_PREPARED_FOR_WRITE_OPERATION)
+                return
+        self.account("copy_bytes", count)
+        data = self.mem_read(src, count)
+        flash = self.flash[bank]
+        for i in range(0, count):
+            # flash programming can only clear bits
+            flash[offset + i] &= data[i]
+        self.prepared[bank].clear()
+        self.status(nxpprog.CMD_SUCCESS)
+
+    def cmd_M(self, vals):
+        if len(vals) != 3:
+            self.status(nxpprog.PARAM_ERROR)
+            return
+        (a, b, count) = vals
+        da = self.mem_read(a, count)
+        db = self.mem_read(b, count)
+        for i in range(0, count):
+            if da[i] != db[i]:
+                self.status(nxpprog.COMPARE_ERROR)
+                self.sendln("%d" % (i & ~3))
+                return
+        self.status(nxpprog.CMD_SUCCESS)
+
+    def cmd_G(self, vals):
+        self.status(nxpprog.CMD_SUCCESS)
+        self.state = "running"
+
+    def cmd_S(self, vals):
+        if self.parms.get("read_crc"):
+            self.read_crc(vals)
+            return
+        if len(vals) != 1 or vals[0] >= len(self.banks):
+            self.status(nxpprog.PARAM_ERROR)
+            return
+        self.boot_bank = vals[0]
+        self.status(nxpprog.CMD_SUCCESS)
+
+    def read_crc(self, vals):
+        if len(vals) != 2:
+            self.status(nxpprog.PARAM_ERROR)
+            return
+        (addr, count) = vals
+        if addr % 4:
+            self.status(nxpprog.ADDR_ERROR)
+            return
+        if count % 4:
+            self.status(nxpprog.COUNT_ERROR)
+            return
+        self.status(nxpprog.CMD_SUCCESS)
+        self.sendln("%d" % (binascii.crc32(self.mem_read(addr, count)) &
+                0xffffffff))
+
+    def cmd_W(self, vals):
+        if len(vals) != 2:
+            self.status(nxpprog.PARAM_ERROR)
+            return
+        (addr, count) = vals
+        if addr % 4:
+            self.status(nxpprog.ADDR_ERROR)
+            return
+        if count % 4:
+            self.status(nxpprog.COUNT_ERROR)
+            return
+        self.status(nxpprog.CMD_SUCCESS)
+        self.xfer = { "addr": addr, "count": count, "data": b'',
+                "lines": 0, "block": b'' }
+        if self.transfer == "binary":
+            self.state = "wbin"
+        else:
+            self.state = "wdata"
+
+    def write_data_binary(self):
+        xfer = self.xfer
+        n = xfer["count"] - len(xfer["data"])
+        xfer["data"] += self.inbuf[:n]
+        self.account("tx_bytes", len(self.inbuf[:n]))
+        self.inbuf = self.inbuf[n:]
+        if len(xfer["data"]) == xfer["count"]:
+            self.ram_write(xfer["addr"], xfer["data"])
+            self.xfer = None
+            self.state = "cmd"
+
+    def write_data_line(self, line):
+        xfer = self.xfer
+        if xfer["lines"] == 20 or \
+                len(xfer["data"]) + len(xfer["block"]) == xfer["count"]:
+            # checksum line
+            try:
+                csum = int(line)
+            except ValueError:
+                csum = -1
+            if csum == sum(xfer["block"]):
+                xfer["data"] += xfer["block"]
+                self.sendln("OK")
+            else:
+                self.sendln("RESEND")
+            xfer["block"] = b''
+            xfer["lines"] = 0
+            if len(xfer["data"]) == xfer["count"]:
+                self.ram_write(xfer["addr"], xfer["data"])
+                self.xfer = None
+                self.state = "cmd"
+            return
+        try:
+            xfer["block"] += binascii.a2b_uu(line)
+        except (binascii.Error, ValueError):
+            pass
+        xfer["lines"] += 1
+
+    def cmd_R(self, vals):
+        if len(vals) != 2:
+            self.status(nxpprog.PARAM_ERROR)
+            return
+        (addr, count) = vals
+        if addr % 4:
+            self.status(nxpprog.ADDR_ERROR)
+            return
+        if count % 4:
+            self.status(nxpprog.COUNT_ERROR)
+            return
+        self.status(nxpprog.CMD_SUCCESS)
+        if self.transfer == "binary":
+            self.send(self.mem_read(addr, count))
+            return
+        self.xfer = { "data": self.mem_read(addr, count), "pos": 0 }
+        self.send_read_group()
+
+    def send_read_group(self):
+        xfer = self.xfer
+        block = xfer["data"][xfer["pos"]:xfer["pos"] + 900]
+        for i in range(0, len(block), 45):
+            line = binascii.b2a_uu(block[i:i + 45]).rstrip(b'\n')
+            self.send(line + b'\r\n')
+        self.sendln("%d" % sum(block))
+        xfer["group"] = block
+        self.state = "rack"
+
+    def read_ack(self, line):
+        xfer = self.xfer
+        if line == "OK":
+            xfer["pos"] += len(xfer["group"])
+        if xfer["pos"] >= len(xfer["data"]):
+            self.xfer = None
+            self.state = "cmd"
+        else:
+            self.send_read_group()
+
+
+# run the programming steps of nxpprog against the simulator and return
+# the command sequence together with the traffic and estimated time of
+# every phase. segments is a list of (address, data) tuples as used by
+# nxpprog.prog_segments.
+def plan(cpu, segments, baud=115200, osc_freq=16000, udp=False,
+        erase_all=False, verify=False, start=True, model=None,
+        pipeline=False):
+    sim = IspSimulator(cpu)
+    prog = nxpprog.nxpprog(cpu, sim, baud, osc_freq, verify=verify)
+    prog.pipeline = pipeline
+
+    success = prog.prog_segments(segments, erase_all, verify)
+    if verify:
+        if not prog.verify_segments(segments):
+            success = False
+    if start:
+        prog.start(segments[0][0])
+
+    report = sim.report(baud, udp, model)
+    report["cpu"] = cpu
+    report["udp"] = udp
+    if not udp:
+        report["baud"] = baud
+    report["image_bytes"] = sum([len(data) for (addr, data) in segments])
+    report["success"] = success
+    return report
+
+
+# serve the simulator on a tcp port like a network serial server, for
+# trying nxpprog.py socket://localhost:<port> without hardware. Every
+# connection starts a new isp session on the same flash contents.
+def serve(cpu, port, echo=True):
+    sim = IspSimulator(cpu, echo)
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(("localhost", port))
+    server.listen(1)
+    while True:
+        conn, addr = server.accept()
+        sim.reset(echo)
+        while True:
+            data = conn.recv(4096)
+            if not data:
+                break
+            sim.write(data)
+            if sim.outbuf:
+                conn.sendall(sim.outbuf)
+                sim.outbuf = b''
+        conn.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        nxpprog.panic("%s <cpu> <tcp port>" % sys.argv[0])
+    serve(sys.argv[1], int(sys.argv[2]))
@@ -0,0 +1,235 @@
+#!/usr/bin/python3
+#
+# Benchmarks of the host side hot paths of nxpprog.
+#
+# Every benchmark runs offline on generated images from 32k to 2M, dense
+# (one contiguous run of data) and sparse (1k of data every 4k), and
+# measures the throughput in image bytes per second. --save stores the
+# results as the baseline, later runs compare against it and fail when a
+# benchmark got slower than the baseline by more than the threshold. The
+# baseline depends on the machine, so it is not shipped and a run without
+# one fails too.
+#
+# nxpbench.py [--save] [--baseline=<file>] [--threshold=<fraction>]
+#             [--filter=<substring>]
+
+import binascii
+import getopt
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import ihex
+import nxpprog
+
+image_sizes = (32 * 1024, 256 * 1024, 2 * 1024 * 1024)
+image_kinds = ("dense", "sparse")
+
+# the cpu the nxpprog methods are run for
+bench_cpu = "lpc1768"
+
+baseline_default = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        "nxpbench.json")
+# fail when the throughput drops below (1 - threshold) times the baseline
+threshold_default = 0.25
+
+# run each benchmark for at least this many seconds, best of repeats
+min_time = .2
+repeats = 5
+
+
+# a device that takes every write and acknowledges every checksum
+class NullDevice(object):
+    def write(self, data):
+        pass
+
+    def readline(self, timeout=None):
+        return "OK"
+
+    def read(self, size, timeout=None):
+        return b''
+
+
+# the (address, data) segments of a generated image
+def image_segments(size, kind):
+    data = bytes(bytearray((i * 7 + (i >> 8)) & 0xff for i in range(size)))
+    if kind == "dense":
+        return [(0, data)]
+    return [(addr, data[addr:addr + 1024]) for addr in range(0, size, 4096)]
+
+
+# seconds one call of fn takes, the best of several timed loops
+def measure(fn):
+    best = None
+    for r in range(0, repeats):
+        count = 0
+        start = time.perf_counter()
+        while True:
+            fn()
+            count += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+        if best is None or elapsed / count < best:
+            best = elapsed / count
+    return best
+
+
+# a list of (name, bytes, function) benchmarks of one image
+def benchmarks(prog, hexfile, segments):
+    ih = ihex.ihex(hexfile)
+    (base, image) = ih.flatten()
+    size = sum([len(data) for (addr, data) in segments])
+
+    line_size = prog.uu_line_size
+    block_size = prog.uu_block_size
+    uu_lines = [binascii.b2a_uu(image[i:i + line_size]).rstrip(b'\n')
+            for i in range(0, len(image), line_size)]
+    blocks = [image[i:i + block_size]
+            for i in range(0, len(image), block_size)]
+
+    flash_size = 1024 * sum(prog.get_cpu_parm("flash_sector")
+            [:prog.flash_sector_count()])
+    ram_block = prog.get_cpu_parm("flash_prog_buffer_size",
+            nxpprog.flash_prog_buffer_size_default)
+
+    # expected data differing in one byte per 64k like a bad flash word
+    expected = bytearray(image)
+    for i in range(0, len(expected), 64 * 1024):
+        expected[i] ^= 0xff
+    expected = bytes(expected)
+
+    def uudecode():
+        for line in uu_lines:
+            prog.uudecode(line)
+
+    def checksum():
+        for block in blocks:
+            prog.sum(block)
+
+    def uuencode():
+        for block in blocks:
+            prog.write_ram_block(0, block)
+
+    def find_flash_sector():
+        for addr in range(0, len(image), 256):
+            prog.find_flash_sector(addr % flash_size)
+
+    def bytestr():
+        for addr in range(0, len(image), ram_block):
+            prog.bytestr(0xff, ram_block)
+
+    def verify_compare():
+        prog.diff_ranges(0, image, expected, [])
+
+    return [
+        ("ihex_parse", size, lambda: ihex.ihex(hexfile)),
+        ("ihex_flatten", len(image), ih.flatten),
+        ("insert_csum", len(image), lambda: prog.insert_csum(image)),
+        ("uudecode", len(image), uudecode),
+        ("sum", len(image), checksum),
+        ("uuencode", len(image), uuencode),
+        ("find_flash_sector", len(image), find_flash_sector),
+        ("bytestr", len(image), bytestr),
+        ("verify_compare", len(image), verify_compare),
+    ]
+
+
+# run all benchmarks whose name contains name_filter, returns a dict of
+# name to bytes per second
+def run(name_filter=None):
+    # insert_csum logs every checksum it inserts
+    nxpprog.log = lambda str: None
+
+    prog = nxpprog.nxpprog(bench_cpu, NullDevice(), 0, 0, connect=False)
+    prog.init_banks()
+
+    results = {}
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for size in image_sizes:
+            for kind in image_kinds:
+                segments = image_segments(size, kind)
+                hexfile = os.path.join(tmpdir, "%s%d.hex" % (kind, size))
+                ihex.write(hexfile, segments)
+                for (name, count, fn) in benchmarks(prog, hexfile, segments):
+                    key = "%s/%s/%dk" % (name, kind, size // 1024)
+                    if name_filter and name_filter not in key:
+                        continue
+                    results[key] = count / measure(fn)
+                    sys.stdout.write("%-36s %12.0f B/s\n" %
+                            (key, results[key]))
+                    sys.stdout.flush()
+    finally:
+        shutil.rmtree(tmpdir)
+    return results
+
+
+# the benchmarks slower than the baseline by more than threshold, as a
+# list of (name, bytes per second, baseline bytes per second)
+def regressions(results, baseline, threshold):
+    slow = []
+    for (name, rate) in sorted(results.items()):
+        base = baseline.get(name)
+        if base and rate < base * (1 - threshold):
+            slow.append((name, rate, base))
+    return slow
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    save = False
+    baseline_file = baseline_default
+    threshold = threshold_default
+    name_filter = None
+
+    optlist, args = getopt.getopt(argv[1:], '',
+            ['save', 'baseline=', 'threshold=', 'filter='])
+    for o, a in optlist:
+        if o == "--save":
+            save = True
+        elif o == "--baseline":
+            baseline_file = a
+        elif o == "--threshold":
+            threshold = float(a)
+        elif o == "--filter":
+            name_filter = a
+
+    results = run(name_filter)
+
+    if save:
+        baseline = {}
+        if os.path.exists(baseline_file):
+            baseline = json.load(open(baseline_file, "r"))
+        baseline.update(results)
+        fd = open(baseline_file, "w")
+        json.dump(baseline, fd, indent=1, sort_keys=True)
+        fd.write("\n")
+        fd.close()
+        sys.stdout.write("Saved baseline to %s\n" % baseline_file)
+        return 0
+
+    if not os.path.exists(baseline_file):
+        sys.stdout.write("No baseline in %s, run with --save to create one\n"
+                % baseline_file)
+        return 1
+
+    baseline = json.load(open(baseline_file, "r"))
+    slow = regressions(results, baseline, threshold)
+    for (name, rate, base) in slow:
+        sys.stdout.write("%s regressed: %.0f B/s, baseline %.0f B/s "
+                "(%.0f%%)\n" % (name, rate, base, 100.0 * rate / base - 100))
+    if slow:
+        return 1
+    sys.stdout.write("No regressions beyond %.0f%% of the baseline\n" %
+            (threshold * 100))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,303 @@
+#!/usr/bin/python3
+#
+# Link calibration and performance profiles.
+#
+# nxpprog.py --calibrate <serial device> sweeps the link settings one at a
+# time: baud rate, low latency mode, xonxoff, pipelining and the transfer
+# block size, each with the best values found so far for the others. Every
+# setting is measured by writing a test pattern to the free ram of the
+# target and reading it back in small R commands, the flash is not
+# touched. The fastest setting without errors wins and the result is
+# stored as a profile keyed by the usb id of the serial adapter and the
+# cpu. Later sessions with the same adapter and cpu pick the profile up for
+# every setting not given on the command line.
+
+import binascii
+import json
+import os
+import re
+import time
+
+import nxpprog
+
+profiles_default = os.path.join(os.path.expanduser("~"),
+        ".nxpprog_profiles.json")
+
+# a setting with more link errors per transfer than this is not used
+max_error_rate = 0.01
+
+# bytes read back with each R command
+read_size = 256
+
+
+class CalibrationError(Exception):
+    pass
+
+
+def raise_error(str):
+    raise CalibrationError(str)
+
+
+# the usb vendor and product id of the adapter behind a serial port, as
+# "usb:vvvv:pppp", or the port name itself for other ports
+def adapter_id(port):
+    try:
+        from serial.tools import list_ports
+    except ImportError:
+        return port
+
+    path = os.path.realpath(port)
+    for info in list_ports.comports():
+        if os.path.realpath(info[0]) != path:
+            continue
+        m = re.search(r"VID:PID=([0-9A-Fa-f]{4}):([0-9A-Fa-f]{4})", info[2])
+        if m:
+            return "usb:%s:%s" % (m.group(1).lower(), m.group(2).lower())
+    return port
+
+
+def profile_key(adapter, cpu):
+    return "%s/%s" % (adapter, cpu)
+
+
+# the profiles in filename, a file that cannot be read or parsed is
+# ignored as every session looks it up
+def load_profiles(filename):
+    if not os.path.exists(filename):
+        return {}
+    try:
+        profiles = json.load(open(filename, "r"))
+    except (ValueError, OSError) as e:
+        nxpprog.log("Ignoring profiles in %s: %s" % (filename, e))
+        return {}
+    if not isinstance(profiles, dict):
+        nxpprog.log("Ignoring profiles in %s: not a JSON object" % filename)
+        return {}
+    return profiles
+
+
+# the file is replaced in one step so an interrupted save leaves the old
+# profiles in place
+def save_profile(filename, adapter, cpu, profile):
+    profiles = load_profiles(filename)
+    profiles[profile_key(adapter, cpu)] = profile
+    tmp = "%s.%d.tmp" % (filename, os.getpid())
+    fd = open(tmp, "w")
+    try:
+        json.dump(profiles, fd, indent=1, sort_keys=True)
+        fd.write("\n")
+        fd.close()
+        os.replace(tmp, filename)
+    except Exception:
+        fd.close()
+        os.remove(tmp)
+        raise
+
+
+# the stored profile of adapter and cpu or None
+def lookup(filename, adapter, cpu):
+    return load_profiles(filename).get(profile_key(adapter, cpu))
+
+
+# sets the link settings of a session, the LinkController does the baud
+# rate changes
+class LinkSettings(object):
+    def __init__(self, prog, baud):
+        self.prog = prog
+        self.link = nxpprog.LinkController(prog, baud)
+        self.current = {
+            "baud": baud,
+            "low_latency": False,
+            "xonxoff": False,
+            "pipeline": prog.pipeline,
+            "block_size": prog.uu_block_size,
+        }
+
+    def set(self, name, value):
+        if self.current.get(name) == value:
+            return
+        prog = self.prog
+        if name == "baud":
+            self.link.set_baud(value)
+        elif name == "low_latency":
+            if value:
+                prog.device.set_low_latency()
+            else:
+                prog.device.restore_latency()
+        elif name == "xonxoff":
+            prog.device.set_xonxoff(value)
+        elif name == "pipeline":
+            prog.pipeline = value
+        elif name == "block_size":
+            prog.uu_block_size = value
+        self.current[name] = value
+
+    def apply(self, settings):
+        for name in ("baud", "low_latency", "xonxoff", "pipeline",
+                "block_size"):
+            if name in settings:
+                self.set(name, settings[name])
+
+
+# the settings to sweep as a list of (name, candidates)
+def candidates(prog, baud):
+    device = prog.device
+    sweep = []
+    if hasattr(device, "set_baud"):
+        sweep.append(("baud", [b for b in sorted(nxpprog.LinkController.bauds)
+            if b >= baud]))
+    if hasattr(device, "set_low_latency") and not device.url:
+        sweep.append(("low_latency", [False, True]))
+    # xon and xoff characters in binary data would be taken for flow control
+    if hasattr(device, "set_xonxoff") and not prog.binary_transfer():
+        sweep.append(("xonxoff", [False, True]))
+    # binary data is never pipelined, see write_ram_binary
+    if not prog.echo_on and not prog.binary_transfer():
+        sweep.append(("pipeline", [False, True]))
+    if not prog.binary_transfer():
+        sweep.append(("block_size", sorted(nxpprog.LinkController.block_sizes,
+            reverse=True)))
+    return sweep
+
+
+# write the pattern to ram and read it back rounds times, returns the
+# goodput in bytes per second and the link errors per transfer. The W or R
+# command in progress is kept in pending as (command, byte count) for
+# resync to finish when the measurement fails.
+def measure(prog, addr, pattern, rounds=2, pending=None):
+    if pending is None:
+        pending = {}
+    counters = prog.counters
+    errors = counters["resends"] + counters["timeouts"] + counters["retries"]
+    transfers = 0
+    # one W command per block so the one in progress is known
+    if prog.binary_transfer():
+        block_size = len(pattern)
+    else:
+        block_size = prog.uu_block_size
+    start = time.time()
+    for r in range(0, rounds):
+        for i in range(0, len(pattern), block_size):
+            block = pattern[i:i + block_size]
+            pending["transfer"] = ("W", len(block))
+            prog.write_ram_data(addr + i, block)
+            transfers += 1
+        for i in range(0, len(pattern), read_size):
+            expected = pattern[i:i + read_size]
+            pending["transfer"] = ("R", len(expected))
+            data = prog.read_block(addr + i, len(expected))
+            pending["transfer"] = None
+            if data != expected:
+                raise CalibrationError("ram read back differs at 0x%x" %
+                        (addr + i))
+            transfers += 1
+    pending["transfer"] = None
+    elapsed = time.time() - start
+    errors = counters["resends"] + counters["timeouts"] + \
+            counters["retries"] - errors
+    return (2 * rounds * len(pattern) / elapsed, float(errors) / transfers)
+
+
+# get the target back to taking commands after a failed measurement, it
+# may still be inside the W or R command of pending. An R transfer is
+# acknowledged. A W transfer is fed lines of zeros until it answers, once
+# it asks for the block again a block of zeros ends it. The target has to
+# answer a command afterwards, otherwise CalibrationError is raised.
+def resync(prog, pending):
+    def drain():
+        while prog.dev_read(256, .2):
+            pass
+
+    drain()
+    transfer = pending.get("transfer")
+    pending["transfer"] = None
+    if transfer and transfer[0] == "R" and not prog.binary_transfer():
+        prog.dev_writeln(prog.OK)
+        drain()
+    elif transfer and transfer[0] == "W":
+        count = transfer[1]
+        if prog.binary_transfer():
+            # the line end finishes whatever is taken for a command
+            prog.dev_write(prog.bytestr(0, count) + b'\r\n')
+        else:
+            zeros = binascii.b2a_uu(prog.bytestr(0, prog.uu_line_size))
+            status = None
+            # the target is never more than a group and its checksum away
+            # from answering
+            for i in range(0, 21):
+                prog.dev_write(zeros)
+                status = prog.dev_readline(.2)
+                if status:
+                    break
+            if status == prog.RESEND:
+                prog.dev_write(prog.uu_frame(prog.bytestr(0, count)))
+                prog.dev_readline(.2)
+        drain()
+
+    prog.isp_command("U 23130")
+
+
+# sweep the link settings of a connected session and return the best
+# profile found, the session is left with its settings
+def calibrate(prog, baud, size=2048):
+    (ram_start, ram_end) = prog.ram_range()
+    size = min(size, ram_end - ram_start) & ~3
+    pattern = os.urandom(size)
+
+    settings = LinkSettings(prog, baud)
+    best = dict(settings.current)
+    best_goodput = 0
+    best_error_rate = 0
+
+    old_panic = nxpprog.panic
+    nxpprog.panic = raise_error
+    try:
+        for (name, values) in candidates(prog, baud):
+            for value in values:
+                trial = dict(best)
+                trial[name] = value
+                if trial == best and best_goodput:
+                    # measured already
+                    continue
+                pending = {}
+                try:
+                    settings.apply(trial)
+                    (goodput, error_rate) = measure(prog, ram_start, pattern,
+                            pending=pending)
+                except CalibrationError as e:
+                    nxpprog.log("Calibrate: %s %s failed: %s" %
+                            (name, value, e))
+                    # get back to settings that worked
+                    try:
+                        resync(prog, pending)
+                        settings.apply(best)
+                    except CalibrationError as e:
+                        raise CalibrationError("lost the target at %s %s, "
+                                "reset it: %s" % (name, value, e))
+                    if name == "baud":
+                        # higher rates will not do any better
+                        break
+                    continue
+                nxpprog.log("Calibrate: %s %s: %.0f bytes/s, %.3f errors "
+                        "per transfer" % (name, value, goodput, error_rate))
+                if error_rate <= max_error_rate and goodput > best_goodput:
+                    best = trial
+                    best_goodput = goodput
+                    best_error_rate = error_rate
+            settings.apply(best)
+    finally:
+        nxpprog.panic = old_panic
+
+    profile = dict(best)
+    profile["goodput"] = round(best_goodput)
+    profile["error_rate"] = best_error_rate
+    profile["calibrated"] = time.time()
+    return profile
+
+
+# use the settings of profile for the session, except those in keep
+def use_profile(prog, baud, profile, keep=()):
+    settings = LinkSettings(prog, baud)
+    settings.apply(dict([(name, value) for (name, value) in profile.items()
+        if name in settings.current and name not in keep]))
+    return settings.current
@@ -0,0 +1,328 @@
+#!/usr/bin/python3
+#
+# Fault injection runs of nxpprog against the ispsim bootloader.
+#
+# FaultDevice sits between nxpprog and a device and drops, corrupts and
+# duplicates bytes and lines, forces RESEND answers by spoiling the
+# checksum lines of written blocks and delays reads. The harness programs,
+# reads and verifies an image with faults injected at a range of rates,
+# many trials each, and reports how often the operation completed with
+# the right result and the effective throughput of the completed trials.
+# Time is the modelled time of the simulator, so a run takes seconds and
+# gives the same result for the same seed.
+#
+# nxpfault.py [--cpu=<cpu>] [--size=<bytes>] [--trials=<n>]
+#             [--rates=<rate>,...] [--faults=<fault>,...] [--delay=<s>]
+#             [--jitter=<s>] [--baud=<baud>] [--adapt] [--seed=<n>]
+#             [--json]
+
+import getopt
+import json
+import math
+import random
+import sys
+
+import ispsim
+import nxpprog
+
+# faults and what their rate is the probability of
+fault_kinds = {
+        "drop_byte": "a byte is lost",
+        "corrupt_byte": "a bit of a byte flips",
+        "drop_line": "a line is lost",
+        "dup_line": "a line is received twice",
+        "resend": "the target answers a written block with RESEND",
+        "delay": "a read is delayed by --delay seconds",
+}
+
+operations = ("program", "read", "verify")
+
+rates_default = (0, 1e-5, 1e-4, 1e-3, 1e-2)
+delay_default = .5
+
+
+class FaultError(Exception):
+    pass
+
+
+# wraps a device and injects faults into the traffic in both directions.
+# rates maps fault kinds to probabilities, faults are only injected while
+# active is set. sleep is called with the seconds a read is delayed.
+class FaultDevice(object):
+    def __init__(self, device, rates, seed=None, delay=delay_default,
+            jitter=0, sleep=None):
+        self._device = device
+        self.rates = rates
+        self.random = random.Random(seed)
+        self.delay = delay
+        self.jitter = jitter
+        self.sleep = sleep
+        self.active = False
+
+        # the faults injected by kind
+        self.injected = dict([(kind, 0) for kind in fault_kinds])
+        # the last line written, to tell checksum lines from other lines
+        self._last_line = b''
+
+    def __getattr__(self, name):
+        return getattr(self._device, name)
+
+    def _rate(self, kind):
+        if not self.active:
+            return 0
+        return self.rates.get(kind, 0)
+
+    def _hit(self, kind):
+        rate = self._rate(kind)
+        if rate and self.random.random() < rate:
+            self.injected[kind] += 1
+            return True
+        return False
+
+    # the positions in count bytes hit by a fault of rate, drawn from the
+    # gaps between faults instead of one random number per byte
+    def _positions(self, kind, count):
+        rate = self._rate(kind)
+        positions = []
+        if not rate:
+            return positions
+        pos = -1
+        while True:
+            if rate >= 1:
+                pos += 1
+            else:
+                pos += 1 + int(math.log(1 - self.random.random()) /
+                        math.log(1 - rate))
+            if pos >= count:
+                break
+            positions.append(pos)
+        self.injected[kind] += len(positions)
+        return positions
+
+    def _bytes(self, data):
+        if not self.active:
+            return data
+        data = bytearray(data)
+        for pos in self._positions("corrupt_byte", len(data)):
+            data[pos] ^= 1 << self.random.randrange(8)
+        for pos in reversed(self._positions("drop_byte", len(data))):
+            del data[pos]
+        return bytes(data)
+
+    def _lines(self, data):
+        lines = []
+        for line in data.splitlines(True):
+            if self._hit("drop_line"):
+                continue
+            lines.append(line)
+            if self._hit("dup_line"):
+                lines.append(line)
+        return b''.join(lines)
+
+    # a uuencoded data line, its first character encodes its length
+    def _is_uu_line(self, line):
+        line = line.rstrip(b'\r\n')
+        if not line:
+            return False
+        count = (line[0] - 32) % 64
+        return 0 < count <= 45 and len(line) == 1 + (count + 2) // 3 * 4
+
+    # spoil the checksum lines following uuencoded data so the target asks
+    # for the block again
+    def _resends(self, data):
+        lines = []
+        for line in data.splitlines(True):
+            if line.rstrip(b'\r\n').isdigit() and \
+                    self._is_uu_line(self._last_line) and \
+                    self._hit("resend"):
+                line = b'1' + line
+            self._last_line = line
+            lines.append(line)
+        return b''.join(lines)
+
+    def _read_delay(self):
+        seconds = 0
+        if self._hit("delay"):
+            seconds += self.delay
+        if self.active and self.jitter:
+            seconds += self.random.uniform(0, self.jitter)
+        if seconds and self.sleep:
+            self.sleep(seconds)
+
+    def write(self, data):
+        if self.active:
+            data = self._bytes(self._lines(self._resends(data)))
+        self._device.write(data)
+
+    def read(self, size, timeout=None):
+        self._read_delay()
+        return self._bytes(self._device.read(size, timeout))
+
+    def readline(self, timeout=None):
+        self._read_delay()
+        line = self._device.readline(timeout)
+        if not self.active:
+            return line
+        if self._hit("drop_line"):
+            return ''
+        return self._bytes(line.encode("UTF-8")).decode("UTF-8", "ignore")
+
+
+def raise_error(str):
+    raise FaultError(str)
+
+
+# run one operation with faults injected at rate, returns a dict with the
+# outcome of the trial
+def trial(operation, cpu, image, rate, kinds, seed, delay, jitter, baud,
+        adapt):
+    # a trial that failed may have left panic swapped by nxpprog
+    nxpprog.panic = raise_error
+
+    sim = ispsim.IspSimulator(cpu)
+    device = FaultDevice(sim, dict([(kind, rate) for kind in kinds]), seed,
+            delay, jitter, lambda seconds: sim.account("delay_time", seconds))
+    prog = nxpprog.nxpprog(cpu, device, baud, 12000)
+    if adapt:
+        prog.link = nxpprog.LinkController(prog)
+
+    image = prog.insert_csum(image)
+    if operation != "program":
+        prog.prog_image(image, 0)
+
+    start = sim.report(baud)["total"].get("seconds", 0)
+    device.active = True
+    result = { "completed": False, "undetected": False }
+    try:
+        if operation == "program":
+            ok = prog.prog_image(image, 0)
+            correct = sim.mem_read(0, len(image)) == image
+        elif operation == "read":
+            data = prog.read_block(0, len(image))
+            ok = True
+            correct = data == image
+        else:
+            ok = prog.verify_image(0, image)
+            correct = True
+        result["completed"] = bool(ok) and correct
+        # reported as done but the flash or data is wrong
+        result["undetected"] = bool(ok) and not correct
+    except FaultError as e:
+        result["error"] = str(e)
+    except Exception as e:
+        # a fault that got past the checks of nxpprog, the run goes on
+        result["error"] = "%s: %s" % (e.__class__.__name__, e)
+    device.active = False
+
+    result["seconds"] = sim.report(baud)["total"].get("seconds", 0) - start
+    result["injected"] = sum(device.injected.values())
+    for key in ("retries", "resends", "timeouts"):
+        result[key] = prog.counters[key]
+    return result
+
+
+# all trials of all operations and rates, returns a list of summary rows
+def run(cpu, size, trials, rates, kinds, seed, delay, jitter, baud, adapt):
+    rng = random.Random(seed)
+    image = bytes(bytearray(rng.randrange(256) for i in range(size)))
+
+    rows = []
+    for operation in operations:
+        for rate in rates:
+            results = []
+            for t in range(0, trials):
+                results.append(trial(operation, cpu, image, rate, kinds,
+                    seed + t, delay, jitter, baud, adapt))
+            completed = [r for r in results if r["completed"]]
+            seconds = sum([r["seconds"] for r in completed])
+            rows.append({
+                "operation": operation,
+                "rate": rate,
+                "trials": trials,
+                "completed": len(completed),
+                "undetected": len([r for r in results if r["undetected"]]),
+                "throughput": size * len(completed) / seconds
+                        if seconds else 0,
+                "injected": sum([r["injected"] for r in results]),
+                "resends": sum([r["resends"] for r in results]),
+                "timeouts": sum([r["timeouts"] for r in results]),
+            })
+    return rows
+
+
+def print_rows(rows):
+    sys.stdout.write("%-8s %8s %9s %10s %11s %8s %8s %8s\n" % ("op", "rate",
+        "complete", "undetected", "B/s", "faults", "resends", "timeouts"))
+    for row in rows:
+        sys.stdout.write("%-8s %8g %8.0f%% %10d %11.0f %8d %8d %8d\n" % (
+            row["operation"], row["rate"],
+            100.0 * row["completed"] / row["trials"], row["undetected"],
+            row["throughput"], row["injected"], row["resends"],
+            row["timeouts"]))
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    cpu = "lpc1768"
+    size = 16 * 1024
+    trials = 10
+    rates = rates_default
+    kinds = sorted(fault_kinds.keys())
+    delay = delay_default
+    jitter = 0
+    baud = 115200
+    adapt = False
+    seed = 1
+    as_json = False
+
+    optlist, args = getopt.getopt(argv[1:], '',
+            ['cpu=', 'size=', 'trials=', 'rates=', 'faults=', 'delay=',
+                'jitter=', 'baud=', 'adapt', 'seed=', 'json'])
+    for o, a in optlist:
+        if o == "--cpu":
+            cpu = a
+        elif o == "--size":
+            size = int(a, 0)
+        elif o == "--trials":
+            trials = int(a)
+        elif o == "--rates":
+            rates = [float(r) for r in a.split(',')]
+        elif o == "--faults":
+            kinds = a.split(',')
+            for kind in kinds:
+                if kind not in fault_kinds:
+                    nxpprog.panic("Unknown fault %s, one of %s" %
+                            (kind, ', '.join(sorted(fault_kinds))))
+        elif o == "--delay":
+            delay = float(a)
+        elif o == "--jitter":
+            jitter = float(a)
+        elif o == "--baud":
+            baud = int(a)
+        elif o == "--adapt":
+            adapt = True
+        elif o == "--seed":
+            seed = int(a)
+        elif o == "--json":
+            as_json = True
+
+    if cpu not in nxpprog.cpu_parms:
+        nxpprog.panic("Unknown cpu %s" % cpu)
+
+    # the progress messages of nxpprog are not of interest
+    nxpprog.log = lambda str: None
+
+    rows = run(cpu, size, trials, rates, kinds, seed, delay, jitter, baud,
+            adapt)
+    if as_json:
+        json.dump(rows, sys.stdout, indent=1)
+        sys.stdout.write("\n")
+    else:
+        print_rows(rows)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
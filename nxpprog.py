@@ -33,6 +33,8 @@ import socket
 import time
 
 import ihex
+import elf
+import srec
 
 CMD_SUCCESS = 0
 INVALID_COMMAND = 1
@@ -94,6 +96,20 @@ flash_sector_lpc11xx = (
         4, 4, 4, 4, 4, 4, 4, 4,
         )
 
+# flash sector sizes for lpc81x processors
+flash_sector_lpc81x = (
+        1, 1, 1, 1, 1, 1, 1, 1,
+        1, 1, 1, 1, 1, 1, 1, 1,
+        )
+
+# flash sector sizes for lpc11u6x processors
+flash_sector_lpc11u6x = (
+        4, 4, 4, 4, 4, 4, 4, 4,
+        4, 4, 4, 4, 4, 4, 4, 4,
+        4, 4, 4, 4, 4, 4, 4, 4,
+        32, 32, 32, 32, 32,
+        )
+
 # flash sector sizes for lpc18xx processors
 flash_sector_lpc18xx = (
                         8, 8, 8, 8, 8, 8, 8, 8,
@@ -104,49 +120,73 @@ flash_sector_lpc18xx = (
 flash_prog_buffer_base_default = 0x40001000
 flash_prog_buffer_size_default = 4096
 
+# the isp handler uses the first 0x200 bytes of ram for its variables and
+# the top 32 bytes plus up to 256 bytes of stack below them, the rest is
+# free for code loaded with --ram
+ram_base_default = 0x40000000
+ram_isp_low = 0x200
+ram_isp_high = 32 + 256
+
+# the ASYNC_LOW_LATENCY flag of the linux serial_struct and the index of
+# the flags in it when read as an array of ints
+ASYNC_LOW_LATENCY = 0x2000
+serial_struct_flags = 4
+
+# file name extensions of S-record files
+srec_extensions = (".srec", ".s19", ".s28", ".s37", ".mot")
+
 # cpu parameter table
 cpu_parms = {
         # 128k flash
         "lpc2364" : {
             "flash_sector" : flash_sector_lpc23xx,
+            "ram_size" : 8 * 1024,
             "flash_sector_count": 11,
             "devid": 369162498
         },
         # 256k flash
         "lpc2365" : {
             "flash_sector" : flash_sector_lpc23xx,
+            "ram_size" : 32 * 1024,
             "flash_sector_count": 15,
             "devid": 369158179
         },
         "lpc2366" : {
             "flash_sector" : flash_sector_lpc23xx,
+            "ram_size" : 32 * 1024,
             "flash_sector_count": 15,
             "devid": 369162531
         },
         # 512k flash
         "lpc2367" : {
             "flash_sector" : flash_sector_lpc23xx,
+            "ram_size" : 32 * 1024,
             "devid": 369158181
         },
         "lpc2368" : {
             "flash_sector" : flash_sector_lpc23xx,
+            "ram_size" : 32 * 1024,
             "devid": 369162533
         },
         "lpc2377" : {
             "flash_sector" : flash_sector_lpc23xx,
+            "ram_size" : 32 * 1024,
             "devid": 385935397
         },
         "lpc2378" : {
             "flash_sector" : flash_sector_lpc23xx,
+            "ram_size" : 32 * 1024,
             "devid": 385940773
         },
         "lpc2387" : {
             "flash_sector" : flash_sector_lpc23xx,
+            "ram_size" : 64 * 1024,
             "devid": 402716981
 
         },
         "lpc2388" : {
             "flash_sector" : flash_sector_lpc23xx,
+            "ram_size" : 64 * 1024,
             "devid": 402718517
         },
         # lpc21xx
@@ -154,83 +194,103 @@ cpu_parms = {
         "lpc2141": {
             "devid": 196353,
             "flash_sector": flash_sector_lpc23xx,
+            "ram_size": 8 * 1024,
             "flash_sector_count": 8,
         },
         "lpc2142": {
             "flash_sector": flash_sector_lpc23xx,
+            "ram_size": 16 * 1024,
             "flash_sector_count": 9,
             "devid": 196369,
         },
         "lpc2144": {
             "flash_sector": flash_sector_lpc23xx,
+            "ram_size": 16 * 1024,
             "flash_sector_count": 11,
             "devid": 196370,
         },
         "lpc2146": {
             "flash_sector": flash_sector_lpc23xx,
+            "ram_size": 32 * 1024,
             "flash_sector_count": 15,
             "devid": 196387,
         },
         "lpc2148": {
             "flash_sector": flash_sector_lpc23xx,
+            "ram_size": 32 * 1024,
             "flash_sector_count": 27,
             "devid": 196389,
         },
         "lpc2109" : {
             "flash_sector": flash_sector_lpc21xx_64,
+            "ram_size": 8 * 1024,
             "devid": 33685249
         },
         "lpc2119" : {
             "flash_sector": flash_sector_lpc21xx_128,
+            "ram_size": 16 * 1024,
             "devid": 33685266
         },
         "lpc2129" : {
             "flash_sector": flash_sector_lpc21xx_256,
+            "ram_size": 16 * 1024,
             "devid": 33685267
         },
         "lpc2114" : {
             "flash_sector" : flash_sector_lpc21xx_128,
+            "ram_size" : 16 * 1024,
             "devid": 16908050
         },
         "lpc2124" : {
             "flash_sector" : flash_sector_lpc21xx_256,
+            "ram_size" : 16 * 1024,
             "devid": 16908051
         },
         "lpc2194" : {
             "flash_sector" : flash_sector_lpc21xx_256,
+            "ram_size" : 16 * 1024,
             "devid": 50462483
         },
         "lpc2292" : {
             "flash_sector" : flash_sector_lpc21xx_256,
+            "ram_size" : 16 * 1024,
             "devid": 67239699
         },
         "lpc2294" : {
             "flash_sector" : flash_sector_lpc21xx_256,
+            "ram_size" : 16 * 1024,
             "devid": 84016915
         },
         # lpc22xx
         "lpc2212" : {
-            "flash_sector" : flash_sector_lpc21xx_128
+            "flash_sector" : flash_sector_lpc21xx_128,
+            "ram_size" : 16 * 1024,
         },
         "lpc2214" : {
-            "flash_sector" : flash_sector_lpc21xx_256
+            "flash_sector" : flash_sector_lpc21xx_256,
+            "ram_size" : 16 * 1024,
         },
         # lpc24xx
         "lpc2458" : {
             "flash_sector" : flash_sector_lpc23xx,
+            "ram_size" : 64 * 1024,
             "devid": 352386869,
         },
         "lpc2468" : {
             "flash_sector" : flash_sector_lpc23xx,
+            "ram_size" : 64 * 1024,
             "devid": 369164085,
         },
         "lpc2478" : {
             "flash_sector" : flash_sector_lpc23xx,
+            "ram_size" : 64 * 1024,
             "devid": 386006837,
         },
         # lpc17xx
         "lpc1769" : {
             "flash_sector" : flash_sector_lpc17xx,
+            "ram_base" : 0x10000000,
+            "ram_size" : 32 * 1024,
             "flash_prog_buffer_base" : 0x10000200,
             "csum_vec": 7,
             "devid": 0x26113f37,
@@ -238,6 +298,8 @@ cpu_parms = {
         },
         "lpc1768" : {
             "flash_sector" : flash_sector_lpc17xx,
+            "ram_base" : 0x10000000,
+            "ram_size" : 32 * 1024,
             "flash_prog_buffer_base" : 0x10001000,
             "csum_vec": 7,
             "devid": 0x26013f37,
@@ -245,6 +307,8 @@ cpu_parms = {
         },
         "lpc1767" : {
             "flash_sector" : flash_sector_lpc17xx,
+            "ram_base" : 0x10000000,
+            "ram_size" : 32 * 1024,
             "flash_prog_buffer_base" : 0x10001000,
             "csum_vec": 7,
             "devid": 0x26012837,
@@ -252,6 +316,8 @@ cpu_parms = {
         },
         "lpc1766" : {
             "flash_sector" : flash_sector_lpc17xx,
+            "ram_base" : 0x10000000,
+            "ram_size" : 32 * 1024,
             "flash_prog_buffer_base" : 0x10001000,
             "csum_vec": 7,
             "devid": 0x26013f33,
@@ -259,6 +325,8 @@ cpu_parms = {
         },
         "lpc1765" : {
             "flash_sector" : flash_sector_lpc17xx,
+            "ram_base" : 0x10000000,
+            "ram_size" : 32 * 1024,
             "flash_prog_buffer_base" : 0x10001000,
             "csum_vec": 7,
             "devid": 0x26013733,
@@ -266,6 +334,8 @@ cpu_parms = {
         },
         "lpc1764" : {
             "flash_sector" : flash_sector_lpc17xx,
+            "ram_base" : 0x10000000,
+            "ram_size" : 16 * 1024,
             "flash_prog_buffer_base" : 0x10001000,
             "csum_vec": 7,
             "devid": 0x26011922,
@@ -273,6 +343,8 @@ cpu_parms = {
         },
         "lpc1763" : {
             "flash_sector" : flash_sector_lpc17xx,
+            "ram_base" : 0x10000000,
+            "ram_size" : 32 * 1024,
             "flash_prog_buffer_base" : 0x10001000,
             "csum_vec": 7,
             "devid": 0x26012033,
@@ -280,6 +352,8 @@ cpu_parms = {
         },
         "lpc1759" : {
             "flash_sector" : flash_sector_lpc17xx,
+            "ram_base" : 0x10000000,
+            "ram_size" : 32 * 1024,
             "flash_prog_buffer_base" : 0x10001000,
             "csum_vec": 7,
             "devid": 0x25113737,
@@ -287,6 +361,8 @@ cpu_parms = {
         },
         "lpc1758" : {
             "flash_sector" : flash_sector_lpc17xx,
+            "ram_base" : 0x10000000,
+            "ram_size" : 32 * 1024,
             "flash_prog_buffer_base" : 0x10001000,
             "csum_vec": 7,
             "devid": 0x25013f37,
@@ -294,6 +370,8 @@ cpu_parms = {
         },
         "lpc1756" : {
             "flash_sector" : flash_sector_lpc17xx,
+            "ram_base" : 0x10000000,
+            "ram_size" : 16 * 1024,
             "flash_prog_buffer_base" : 0x10001000,
             "csum_vec": 7,
             "devid": 0x25011723,
@@ -301,6 +379,8 @@ cpu_parms = {
         },
         "lpc1754" : {
             "flash_sector" : flash_sector_lpc17xx,
+            "ram_base" : 0x10000000,
+            "ram_size" : 16 * 1024,
             "flash_prog_buffer_base" : 0x10001000,
             "csum_vec": 7,
             "devid": 0x25011722,
@@ -308,6 +388,8 @@ cpu_parms = {
         },
         "lpc1752" : {
             "flash_sector" : flash_sector_lpc17xx,
+            "ram_base" : 0x10000000,
+            "ram_size" : 16 * 1024,
             "flash_prog_buffer_base" : 0x10001000,
             "csum_vec": 7,
             "devid": 0x25001121,
@@ -315,6 +397,8 @@ cpu_parms = {
         },
         "lpc1751" : {
             "flash_sector" : flash_sector_lpc17xx,
+            "ram_base" : 0x10000000,
+            "ram_size" : 8 * 1024,
             "flash_prog_buffer_base" : 0x10001000,
             "csum_vec": 7,
             "devid": 0x25001110,
@@ -322,13 +406,57 @@ cpu_parms = {
         },
         "lpc1114" : {
             "flash_sector" : flash_sector_lpc11xx,
+            "ram_base" : 0x10000000,
+            "ram_size" : 8 * 1024,
             "flash_prog_buffer_base" : 0x10000400,
             "devid": 0x0444102B,
-            "flash_prog_buffer_size" : 1024
+            "flash_prog_buffer_size" : 1024,
+            "cpu_type": "thumb",
+        },
+        # the lpc8xx and lpc11u6x isp transfers W and R data in binary,
+        # without uuencoding and checksums, and reads the crc32 of memory
+        # with S
+        "lpc811" : {
+            "flash_sector" : flash_sector_lpc81x,
+            "flash_sector_count": 8,
+            "ram_base" : 0x10000000,
+            "ram_size" : 2 * 1024,
+            "flash_prog_buffer_base" : 0x10000400,
+            "flash_prog_buffer_size" : 256,
+            "csum_vec": 7,
+            "devid": 0x8110,
+            "cpu_type": "thumb",
+            "transfer": "binary",
+            "read_crc": True,
+        },
+        "lpc812" : {
+            "flash_sector" : flash_sector_lpc81x,
+            "ram_base" : 0x10000000,
+            "ram_size" : 4 * 1024,
+            "flash_prog_buffer_base" : 0x10000400,
+            "flash_prog_buffer_size" : 256,
+            "csum_vec": 7,
+            "devid": 0x8120,
+            "cpu_type": "thumb",
+            "transfer": "binary",
+            "read_crc": True,
+        },
+        "lpc11u68" : {
+            "flash_sector" : flash_sector_lpc11u6x,
+            "ram_base" : 0x10000000,
+            "ram_size" : 32 * 1024,
+            "flash_prog_buffer_base" : 0x10001000,
+            "csum_vec": 7,
+            "devid": 0x7C00,
+            "cpu_type": "thumb",
+            "transfer": "binary",
+            "read_crc": True,
         },
         # lpc18xx
         "lpc1817" : {
             "flash_sector" : flash_sector_lpc18xx,
+            "ram_base" : 0x10000000,
+            "ram_size" : 32 * 1024,
             "flash_bank_addr": (0x1a000000, 0x1b000000),
             "flash_prog_buffer_base" : 0x10081000,
             "devid": (0xF001DB3F, 0),
@@ -338,13 +466,17 @@ cpu_parms = {
         },
         "lpc1832" : {
             "flash_sector" : flash_sector_lpc18xx,
-            "flash_bank_addr": (0x1a000000),
+            "ram_base" : 0x10000000,
+            "ram_size" : 32 * 1024,
+            "flash_bank_addr": (0x1a000000,),
             "flash_prog_buffer_base" : 0x10081000,
             "csum_vec": 7,
             "cpu_type": "thumb",
         },
         "lpc1833" : {
             "flash_sector" : flash_sector_lpc18xx,
+            "ram_base" : 0x10000000,
+            "ram_size" : 32 * 1024,
             "flash_sector_count": 11,
             "flash_bank_addr": (0x1a000000, 0x1b000000),
             "flash_prog_buffer_base" : 0x10081000,
@@ -354,6 +486,8 @@ cpu_parms = {
         },
         "lpc1837" : {
             "flash_sector" : flash_sector_lpc18xx,
+            "ram_base" : 0x10000000,
+            "ram_size" : 32 * 1024,
             "flash_bank_addr": (0x1a000000, 0x1b000000),
             "flash_prog_buffer_base" : 0x10081000,
             "devid": (0xf001da30, 0),
@@ -362,6 +496,8 @@ cpu_parms = {
         },
         "lpc1853" : {
             "flash_sector" : flash_sector_lpc18xx,
+            "ram_base" : 0x10000000,
+            "ram_size" : 32 * 1024,
             "flash_sector_count": 11,
             "flash_bank_addr": (0x1a000000, 0x1b000000),
             "flash_prog_buffer_base" : 0x10081000,
@@ -371,6 +507,8 @@ cpu_parms = {
         },
         "lpc1857" : {
             "flash_sector" : flash_sector_lpc18xx,
+            "ram_base" : 0x10000000,
+            "ram_size" : 32 * 1024,
             "flash_bank_addr": (0x1a000000, 0x1b000000),
             "flash_prog_buffer_base" : 0x10081000,
             "devid": (0xf001d830, 0x44),
@@ -410,8 +548,40 @@ def syntax():
 {0} --start=<addr> <serial device> : start the device at <addr>.
 {0} --read=<file> --addr=<address> --len=<length> <serial device>:
             read length bytes from address and dump them to a file.
+{0} --patch --addr=<address> <serial device> <image_file> : write the
+            image into flash keeping the rest of the sectors it falls in.
+            The sectors are read, merged, erased, written back and
+            compared. The device is not started. The old contents are
+            saved to a hex file first, which is kept if the patch fails.
+{0} --patch --backup=<file> --addr=<address> <serial device> <image_file>:
+            patch and keep the old contents of the sectors in file.
+{0} --batch=<file> <serial device> : run the steps in file, or stdin
+            for -, in one session and print the result of each as JSON.
+            Steps are read-serial, read-range <addr> <len> <file>,
+            blank-check, program-image <file> [<addr>],
+            verify <file> [<addr>], patch <file> <addr> and start [<addr>].
+{0} --dump=<file> <serial device> : read all flash sectors that are not
+            blank and write them to an intel hex (.hex), S-record (.srec,
+            .s19) or binary file. Binary files start at the flash base and
+            have holes where sectors are blank.
 {0} --serialnumber <serial device> : get the device serial number
 {0} --list : list supported processors.
+{0} --report=<db> : print throughput per port and cpu recorded by --stats.
+{0} --scan [<port glob> ...] : look for devices in isp mode on all matching
+            serial ports at once and print the cpu, device id and serial
+            number of each as JSON. Searches /dev/serial/by-id, ttyUSB and
+            ttyACM ports by default.
+{0} --manifest=<file> <serial device> : program all images listed in a
+            JSON or TOML manifest in one session.
+{0} --ram <serial device> <image_file> : load image file into ram and
+            run it without touching the flash. The image runs from its
+            entry point, the --start address or its reset vector.
+{0} --fleet=<file> <image_file> : program all Ethernet ISP targets
+            listed in file, one ip address[:port] per line, at once and
+            print the result of each as JSON.
+{0} --plan --cpu=<cpu> <image_file> : don't program, print the command
+            sequence, traffic and estimated time of programming the image
+            (or the images of --manifest) as JSON.
 options:
     --cpu=<cpu> : set the cpu type.
     --oscfreq=<freq> : set the oscillator frequency.
@@ -424,37 +594,103 @@ options:
     --eraseonly : don't program, just erase. Implies --eraseall.
     --eraseall : erase all flash not just the area written to.
     --blankcheck : don't program, just check that the flash is blank.
-    --filetype=[ihex|bin] : set filetype to intel hex format or raw binary.
-    --bank=[0|1] : select bank for devices with flash banks.
+    --filetype=[ihex|srec|bin|elf] : set filetype to intel hex format,
+            S-record, raw binary or ELF.
+    --bank=[0|1] : select bank for devices with flash banks. When
+            programming an image this selects the bank to boot from.
     --port=<udp port> : UDP port number to use (default 41825).
-    --mac=<mac address> : MAC address to associate IP address with.\
+    --mac=<mac address> : MAC address to associate IP address with.
+    --turnaround=<ms> : response latency of the link assumed by --plan
+            (default 2).
+    --pipeline : send short commands back to back without waiting for
+            each status line and send uuencoded ram data along with its
+            W command. Binary ram data always waits for the W status.
+    --lowlatency : on linux set the serial port to low latency mode and
+            the latency timer of usb serial adapters to 1 ms while
+            programming. Needs write access to the sysfs latency_timer.
+    --adaptive : when RESENDs and timeouts pile up use smaller transfer
+            blocks, xonxoff and lower baud rates instead of failing.
+    --capture=<file> : record all traffic with the device to a file.
+    --stats=<db> : record timing, throughput and link errors of the session
+            in an SQLite database.
+    --inject=<addr>:<hex> : write the bytes given in hex at addr in place
+            of the image data there, for unit specific data such as serial
+            numbers. Can be given more than once.
+    --station : program every board as soon as its serial port shows up,
+            resetting it with the control lines, then verify and start it.
+            Boards are programmed in parallel, a port is programmed again
+            after it has gone away. Runs until interrupted.
+    --watch=<glob> : the ports --station watches (default
+            /dev/serial/by-id/*). Can be given more than once.
+    --units=<file> : unit data for --station, one line of <addr>:<hex>
+            items per board. Each board gets the next line written into
+            the image, the line of a board that failed goes to the next.
+    --calibrate : measure the link with ram writes and reads at the
+            candidate baud rates, latency, xonxoff, pipelining and block
+            size settings and store the best as the profile of the serial
+            adapter and cpu. Later sessions use the profile for the
+            settings not given as options.
+    --profiles=<file> : the profile file (default ~/.nxpprog_profiles.json).
+    --noprofile : don't use a stored profile.
+    --replay : <serial device> is a file written with --capture which is
+            played back instead of talking to a device.
+    --replaytiming : replay with the timing of the captured session.\
 """.format(os.path.basename(sys.argv[0])))
 
 class SerialDevice(object):
-    def __init__(self, device, baud, xonxoff=False, control=False):
-        # Create the Serial object without port to avoid automatic opening
-        self._serial = serial.Serial(port=None, baudrate=baud)
+    # longest write the round trip is timed from
+    rtt_write_max = 64
+
+    def __init__(self, device, baud, xonxoff=False, control=False, timeout=5):
+        # a pyserial url such as rfc2217://host:port or socket://host:port
+        # reaches the device through a network serial server
+        self.url = "://" in device
+
+        if self.url:
+            self._serial = serial.serial_for_url(device, baudrate=baud,
+                    do_not_open=True)
+            self._serial.open()
+            self._serial.setRTS(0)
+            self._serial.setDTR(0)
+        else:
+            # Create the Serial object without port to avoid automatic opening
+            self._serial = serial.Serial(port=None, baudrate=baud)
 
-        # Disable RTS and DRT to avoid automatic reset to ISP mode (use --control for explicit reset)
-        self._serial.setRTS(0)
-        self._serial.setDTR(0)
+            # Disable RTS and DRT to avoid automatic reset to ISP mode (use --control for explicit reset)
+            self._serial.setRTS(0)
+            self._serial.setDTR(0)
 
-        # Select and open the port after RTS and DTR are set to zero
-        self._serial.setPort(device)
-        self._serial.open()
+            # Select and open the port after RTS and DTR are set to zero
+            self._serial.port = device
+            self._serial.open()
 
-        # set a two second timeout just in case there is nothing connected
+        # set a five second timeout just in case there is nothing connected
         # or the device is in the wrong mode.
         # This timeout is too short for slow baud rates but who wants to
         # use them?
-        self._serial.setTimeout(5)
+        self._serial.timeout = timeout
         # device wants Xon Xoff flow control
         if xonxoff:
-            self._serial.setXonXoff(1)
+            self._serial.xonxoff = True
 
         # reset pin is controlled by DTR implying int0 is controlled by RTS
         self.reset_pin = "dtr"
 
+        # data received ahead of the line returned by readline
+        self._rxbuf = b''
+        # data written since the last read, sent in one go before reading
+        self._txbuf = b''
+
+        # settings changed by set_low_latency, put back on close
+        self._serial_flags = None
+        self._latency_timer = None
+
+        # smoothed time from a write to the first byte of the answer. Short
+        # timeouts are stretched to a multiple of it so they still work
+        # over slow network links.
+        self.rtt = 0
+        self._write_time = None
+
         if control:
             self.isp_mode()
 
@@ -486,33 +722,175 @@ class SerialDevice(object):
         else:
             self._serial.setRTS(level)
 
+    def close(self):
+        self.flush()
+        self.restore_latency()
+        self._serial.close()
+
+    # Linux only: make the serial driver pass on received data at once
+    # (ASYNC_LOW_LATENCY) and set the latency timer of usb serial adapters
+    # that have one to 1 ms, when permitted. The old settings are put back
+    # on close or exit.
+    def set_low_latency(self):
+        import array
+        import atexit
+        import fcntl
+        import termios
+
+        if self.url:
+            log("Low latency mode is not available for %s" %
+                    self._serial.port)
+            return False
+
+        changed = False
+        buf = array.array('i', [0] * 32)
+        try:
+            fcntl.ioctl(self._serial.fileno(), termios.TIOCGSERIAL, buf)
+            flags = buf[serial_struct_flags]
+            buf[serial_struct_flags] = flags | ASYNC_LOW_LATENCY
+            fcntl.ioctl(self._serial.fileno(), termios.TIOCSSERIAL, buf)
+            self._serial_flags = flags
+            changed = True
+        except (IOError, OSError, AttributeError) as e:
+            log("Cannot set ASYNC_LOW_LATENCY: %s" % e)
+
+        name = os.path.basename(os.path.realpath(self._serial.port))
+        path = "/sys/bus/usb-serial/devices/%s/latency_timer" % name
+        if os.path.exists(path):
+            try:
+                old = open(path, "r").read().strip()
+                fd = open(path, "w")
+                fd.write("1")
+                fd.close()
+                self._latency_timer = (path, old)
+                changed = True
+            except (IOError, OSError) as e:
+                log("Cannot set the latency timer: %s" % e)
+
+        if changed:
+            atexit.register(self.restore_latency)
+        return changed
+
+    def restore_latency(self):
+        import array
+        import fcntl
+        import termios
+
+        if self._serial_flags is not None and self._serial.isOpen():
+            buf = array.array('i', [0] * 32)
+            try:
+                fcntl.ioctl(self._serial.fileno(), termios.TIOCGSERIAL, buf)
+                buf[serial_struct_flags] = self._serial_flags
+                fcntl.ioctl(self._serial.fileno(), termios.TIOCSSERIAL, buf)
+            except (IOError, OSError) as e:
+                log("Cannot restore the serial flags: %s" % e)
+            self._serial_flags = None
+
+        if self._latency_timer:
+            (path, old) = self._latency_timer
+            try:
+                fd = open(path, "w")
+                fd.write(old)
+                fd.close()
+            except (IOError, OSError) as e:
+                log("Cannot restore the latency timer: %s" % e)
+            self._latency_timer = None
+
+    def set_baud(self, baud):
+        self.flush()
+        self._serial.baudrate = baud
+
+    def set_xonxoff(self, xonxoff):
+        self.flush()
+        self._serial.xonxoff = bool(xonxoff)
+
+    # writes to a url are kept until the next read so a command and its
+    # data go out in one packet, local ports take them at once
     def write(self, data):
+        if self.url:
+            self._txbuf += data
+        else:
+            self._send(data)
+
+    def flush(self):
+        if self._txbuf:
+            self._send(self._txbuf)
+            self._txbuf = b''
+
+    # the round trip is only timed from short command lines, the time a
+    # large frame takes to go out would be counted in with it
+    def _send(self, data):
         self._serial.write(data)
+        if len(data) <= self.rtt_write_max:
+            self._write_time = time.time()
+        else:
+            self._write_time = None
+
+    def _timeout(self, timeout):
+        return max(timeout, 4 * self.rtt)
+
+    def _read(self, size):
+        data = self._serial.read(size)
+        if data and self._write_time:
+            sample = time.time() - self._write_time
+            self.rtt = sample if not self.rtt else \
+                    .875 * self.rtt + .125 * sample
+            self._write_time = None
+        return data
+
+    def read(self, size, timeout=None):
+        self.flush()
+
+        data = self._rxbuf[:size]
+        self._rxbuf = self._rxbuf[size:]
+        if len(data) == size:
+            return data
+
+        if timeout:
+            ot = self._serial.timeout
+            self._serial.timeout = self._timeout(timeout)
+
+        data += self._read(size - len(data))
+
+        if timeout:
+            self._serial.timeout = ot
+
+        return data
 
     def readline(self, timeout=None):
+        self.flush()
+
         if timeout:
-            ot = self._serial.getTimeout()
-            self._serial.setTimeout(timeout)
+            ot = self._serial.timeout
+            self._serial.timeout = self._timeout(timeout)
 
-        line = b''
         while True:
-            c = self._serial.read(1)
-            if not c:
+            self._rxbuf = self._rxbuf.lstrip(b'\r\n')
+            end = len(self._rxbuf)
+            for c in (b'\r', b'\n'):
+                i = self._rxbuf.find(c)
+                if i >= 0 and i < end:
+                    end = i
+            if end < len(self._rxbuf):
+                line = self._rxbuf[:end]
+                # consume the whole line end, binary data may follow it
+                if self._rxbuf[end:end + 1] == b'\r' and \
+                        end + 1 == len(self._rxbuf):
+                    self._rxbuf += self._read(1)
+                if self._rxbuf[end:end + 2] == b'\r\n':
+                    end += 1
+                self._rxbuf = self._rxbuf[end + 1:]
                 break
-            if c == b'\r':
-                if not line:
-                    continue
-                else:
-                    break
-            if c == b'\n':
-                if not line:
-                    continue
-                else:
-                    break
-            line += c
+            # take all that has arrived, at least one byte
+            data = self._read(max(1, self._serial.inWaiting()))
+            if not data:
+                line = self._rxbuf
+                self._rxbuf = b''
+                break
+            self._rxbuf += data
 
         if timeout:
-            self._serial.setTimeout(ot)
+            self._serial.timeout = ot
 
         return line.decode("UTF-8", "ignore")
 
@@ -540,10 +918,40 @@ class UdpDevice(object):
 
         self._sock.bind(('', self._udp_port))
 
+        # data received but not yet consumed by read
+        self._rxbuf = b''
+
     def write(self, data):
-        self._sock.sendto(data, (self._inet_addr, self._udp_port))
+        # one datagram per line, a block written at once is split up again
+        for line in data.splitlines(True):
+            self._sock.sendto(line, (self._inet_addr, self._udp_port))
+
+    def read(self, size, timeout=None):
+        if timeout:
+            ot = self._sock.gettimeout()
+            self._sock.settimeout(timeout)
+
+        while len(self._rxbuf) < size:
+            try:
+                data, addr = self._sock.recvfrom(2048)
+            except Exception as e:
+                break
+            self._rxbuf += data
+
+        if timeout:
+            self._sock.settimeout(ot)
+
+        data = self._rxbuf[:size]
+        self._rxbuf = self._rxbuf[size:]
+        return data
 
     def readline(self, timeout=None):
+        # serve a line left over from a bulk read first
+        self._rxbuf = self._rxbuf.lstrip(b'\r\n')
+        if self._rxbuf:
+            line, sep, self._rxbuf = self._rxbuf.partition(b'\n')
+            return line.decode("UTF-8", "ignore").replace('\r','')
+
         if timeout:
             ot = self._sock.gettimeout()
             self._sock.settimeout(timeout)
@@ -558,10 +966,379 @@ class UdpDevice(object):
 
         return line.decode("UTF-8", "ignore").replace('\r','').replace('\n','')
 
+# Capture files hold every write to and read from a device. After the
+# magic string each record is a type byte (w: write, l: readline,
+# r: read), the time in seconds since the start of the capture as a double,
+# the size a read asked for (0 for the other records) and the data length,
+# followed by the data. Version 1 captures have no read size.
+capture_magic = b'NXPCAP2\n'
+capture_record = struct.Struct("<cdII")
+capture_magic_v1 = b'NXPCAP1\n'
+capture_record_v1 = struct.Struct("<cdI")
+
+# the records of a capture file as (type, time, read size, data), the read
+# size is None for version 1 captures
+def read_capture(filename):
+    fd = open(filename, "rb")
+    magic = fd.read(len(capture_magic))
+    if magic == capture_magic:
+        record = capture_record
+    elif magic == capture_magic_v1:
+        record = capture_record_v1
+    else:
+        panic("%s is not a capture file" % filename)
+    records = []
+    while True:
+        hdr = fd.read(record.size)
+        if len(hdr) < record.size:
+            break
+        if record is capture_record:
+            (kind, stamp, size, length) = record.unpack(hdr)
+        else:
+            (kind, stamp, length) = record.unpack(hdr)
+            size = None
+        records.append((kind, stamp, size, fd.read(length)))
+    fd.close()
+    return records
+
+# wraps a device and records all traffic to a capture file
+class CaptureDevice(object):
+    def __init__(self, device, filename):
+        import atexit
+
+        self._device = device
+        self._fd = open(filename, "wb")
+        self._fd.write(capture_magic)
+        self._t0 = time.monotonic()
+        atexit.register(self.close)
+
+    def __getattr__(self, name):
+        # everything but the traffic goes straight to the device
+        return getattr(self._device, name)
+
+    def _record(self, kind, data, size=0):
+        self._fd.write(capture_record.pack(kind, time.monotonic() - self._t0,
+            size, len(data)))
+        self._fd.write(data)
+
+    def close(self):
+        if not self._fd.closed:
+            self._fd.close()
+
+    def write(self, data):
+        self._record(b'w', data)
+        self._device.write(data)
+
+    def read(self, size, timeout=None):
+        data = self._device.read(size, timeout)
+        self._record(b'r', data, size)
+        return data
+
+    def readline(self, timeout=None):
+        line = self._device.readline(timeout)
+        self._record(b'l', line.encode("UTF-8"))
+        return line
+
+# plays a capture file back in place of a device. The writes and the sizes
+# of the reads must match the capture, with timing the reads are delayed
+# until they happened in the captured session.
+class ReplayDevice(object):
+    def __init__(self, filename, timing=False):
+        self._records = read_capture(filename)
+        self._index = 0
+        self._timing = timing
+        self._t0 = time.monotonic()
+
+    # the read size and data of the next record, which must be of kind
+    def _next(self, kind):
+        if self._index >= len(self._records):
+            panic("Replay: end of capture")
+        (rkind, stamp, size, data) = self._records[self._index]
+        if rkind != kind:
+            panic("Replay: session diverged at record %d, expected %s got %s"
+                    % (self._index, rkind.decode(), kind.decode()))
+        self._index += 1
+        if self._timing:
+            delay = stamp - (time.monotonic() - self._t0)
+            if delay > 0:
+                time.sleep(delay)
+        return (size, data)
+
+    def write(self, data):
+        if self._next(b'w')[1] != data:
+            panic("Replay: session diverged at record %d, written data "
+                    "differs" % (self._index - 1))
+
+    def read(self, size, timeout=None):
+        (captured, data) = self._next(b'r')
+        # version 1 captures only show reads of more than was asked for
+        if captured is None:
+            captured = max(size, len(data))
+        if captured != size:
+            panic("Replay: session diverged at record %d, read %d bytes "
+                    "instead of %d" % (self._index - 1, size, captured))
+        return data
+
+    def readline(self, timeout=None):
+        return self._next(b'l')[1].decode("UTF-8")
+
+    # nothing is buffered
+    def flush(self):
+        pass
+
+# Drives the link more gently when it gets noisy instead of failing the
+# session. The RESENDs and timeouts of every written block are tracked over
+# a window of blocks; when the error rate goes above max_error_rate the
+# next step is taken: a smaller transfer block, xonxoff flow control, then
+# a lower baud rate set with the B command. After clean_blocks blocks
+# without errors the last step is undone.
+class LinkController(object):
+    # transfer block sizes, multiples of the uuencoded line size and of 4
+    block_sizes = (900, 540, 360, 180)
+    bauds = (460800, 230400, 115200, 57600, 38400, 19200, 9600)
+    window = 16
+    max_error_rate = 0.1
+    clean_blocks = 64
+    # resends of a single block before giving up
+    max_resends = 10
+
+    def __init__(self, prog, baud=None):
+        self.prog = prog
+        self.baud = baud
+        self.xonxoff = False
+        self.history = []
+        self.clean = 0
+        # steps taken, undone last first
+        self.steps = []
+
+        self.payload = 0
+        self.start_time = time.time()
+        self.start_counters = dict(prog.counters)
+
+    def errors(self):
+        return self.prog.counters["resends"] + self.prog.counters["timeouts"]
+
+    # called after every transfer block with the number of errors it took
+    def block_done(self, size, errors):
+        self.payload += size
+        self.history.append(errors)
+        self.history = self.history[-self.window:]
+
+        if errors:
+            self.clean = 0
+        else:
+            self.clean += 1
+
+        if len(self.history) == self.window and \
+                sum(self.history) > self.max_error_rate * self.window:
+            if self.degrade():
+                self.history = []
+        elif self.clean >= self.clean_blocks and self.steps:
+            self.recover()
+            self.clean = 0
+
+    def can_change_baud(self):
+        return self.baud and hasattr(self.prog.device, "set_baud")
+
+    def lower_baud(self):
+        for baud in self.bauds:
+            if baud < self.baud:
+                return baud
+        return None
+
+    def set_baud(self, baud):
+        self.prog.isp_command("B %d 1" % baud)
+        # the target answers at the old rate before it switches
+        time.sleep(.05)
+        self.prog.device.set_baud(baud)
+        self.baud = baud
+
+    def degrade(self):
+        prog = self.prog
+        size = prog.uu_block_size
+        smaller = [b for b in self.block_sizes if b < size]
+        if smaller:
+            self.steps.append(("block", size))
+            prog.uu_block_size = smaller[0]
+            log("Link: %d errors in %d blocks, block size %d" %
+                    (sum(self.history), len(self.history), smaller[0]))
+            return True
+
+        if not self.xonxoff and hasattr(prog.device, "set_xonxoff") and \
+                not prog.binary_transfer():
+            self.steps.append(("xonxoff", False))
+            prog.device.set_xonxoff(True)
+            self.xonxoff = True
+            log("Link: %d errors in %d blocks, enabling xonxoff" %
+                    (sum(self.history), len(self.history)))
+            return True
+
+        if self.can_change_baud() and self.lower_baud():
+            self.steps.append(("baud", self.baud))
+            log("Link: %d errors in %d blocks, baud %d" %
+                    (sum(self.history), len(self.history), self.lower_baud()))
+            self.set_baud(self.lower_baud())
+            return True
+
+        return False
+
+    def recover(self):
+        (step, value) = self.steps.pop()
+        if step == "block":
+            self.prog.uu_block_size = value
+            log("Link: clean, block size %d" % value)
+        elif step == "xonxoff":
+            self.prog.device.set_xonxoff(False)
+            self.xonxoff = False
+            log("Link: clean, disabling xonxoff")
+        elif step == "baud":
+            log("Link: clean, baud %d" % value)
+            self.set_baud(value)
+
+    # effective goodput and link state of the session so far
+    def report(self):
+        elapsed = time.time() - self.start_time
+        counters = self.prog.counters
+        return {
+            "payload_bytes": self.payload,
+            "seconds": elapsed,
+            "goodput": self.payload / elapsed if elapsed else 0,
+            "resends": counters["resends"] - self.start_counters["resends"],
+            "timeouts": counters["timeouts"] - self.start_counters["timeouts"],
+            "block_size": self.prog.uu_block_size,
+            "baud": self.baud,
+            "xonxoff": self.xonxoff,
+        }
+
+
+# The sector plan of an image worked out once, with the vector checksum
+# inserted and the ram blocks framed for transfer, to program many boards
+# with. personalize returns a copy with per unit data patched in in which
+# only the ram blocks under the patches are framed again, together with the
+# block holding the vector table when the patches touch it.
+class PreparedImage(object):
+    def __init__(self, prog, segments=None):
+        self.prog = prog
+        self.ram_block = prog.get_cpu_parm("flash_prog_buffer_size",
+                flash_prog_buffer_size_default)
+        self.runs = []
+        # ram_frames of the blocks by flash address
+        self.frames = {}
+        if segments is None:
+            return
+
+        self.runs = prog.sector_plan(prog.bootable_segments(segments),
+                self.ram_block)
+        for (bank, start_sector, end_sector, blocks) in self.runs:
+            for (addr, block) in blocks:
+                self.frames[addr] = prog.ram_frames(block)
+
+    # the blocks to program as (address, data) segments
+    def segments(self):
+        return [block for run in self.runs for block in run[3]]
+
+    # a copy with the (address, data) patches applied, the patches have
+    # to be inside the sectors of the image
+    def personalize(self, patches):
+        prog = self.prog
+        offsets = prog.sector_offsets()
+
+        unit = PreparedImage(prog)
+        unit.runs = [(bank, s, e, list(blocks))
+                for (bank, s, e, blocks) in self.runs]
+        unit.frames = dict(self.frames)
+
+        changed = set()
+        for (addr, data) in patches:
+            pos = 0
+            while pos < len(data):
+                a = addr + pos
+                bank = prog.find_flash_bank(a)
+                sector = prog.find_flash_sector(a)
+                run = None
+                for r in unit.runs:
+                    if r[0] == bank and r[1] <= sector <= r[2]:
+                        run = r
+                if sector < 0 or run is None:
+                    panic("Unit data at 0x%x is outside the image" % a)
+
+                # the ram blocks of a run are aligned to its start
+                base = prog.flash_bank_base(bank)
+                run_addr = base + offsets[run[1]]
+                run_end = base + offsets[run[2] + 1]
+                block_addr = a - (a - run_addr) % self.ram_block
+                blocks = run[3]
+                index = 0
+                while index < len(blocks) and blocks[index][0] < block_addr:
+                    index += 1
+                if index < len(blocks) and blocks[index][0] == block_addr:
+                    block = bytearray(blocks[index][1])
+                else:
+                    # a block left out as blank
+                    block = bytearray(prog.bytestr(0xff,
+                        min(self.ram_block, run_end - block_addr)))
+                    blocks.insert(index, (block_addr, b''))
+
+                count = min(len(data) - pos, block_addr + len(block) - a)
+                block[a - block_addr:a - block_addr + count] = \
+                        data[pos:pos + count]
+                # the vector checksum covers the first 8 words
+                if block_addr == base and a < base + 32:
+                    block = prog.insert_csum(bytes(block))
+                blocks[index] = (block_addr, bytes(block))
+                changed.add(block_addr)
+                pos += count
+
+        for run in unit.runs:
+            for (addr, block) in run[3]:
+                if addr in changed:
+                    unit.frames[addr] = prog.ram_frames(block)
+        return unit
+
+
+# the name of the cpu with the device id read with the J command or None
+def cpu_from_devid(devid):
+    for dcpu in cpu_parms.keys():
+        cpu_devid = cpu_parms[dcpu].get("devid")
+        if not cpu_devid:
+            continue
+
+        # mask devid word1
+        devid_word1_mask = cpu_parms[dcpu].get("devid_word1_mask")
+        if devid_word1_mask and isinstance(devid, tuple) and devid[0] == cpu_devid[0] and (devid[1] & devid_word1_mask) == (cpu_devid[1] & devid_word1_mask):
+            return dcpu
+
+        if devid == cpu_devid:
+            return dcpu
+
+    return None
+
+
+def format_devid(devid):
+    if isinstance(devid, tuple):
+        return ' '.join(["0x%x" % d for d in devid])
+    return "0x%x" % devid
+
+
 class nxpprog:
-    def __init__(self, cpu, device, baud, osc_freq, xonxoff=False, control=False, address=None, verify=False):
+    def __init__(self, cpu, device, baud, osc_freq, xonxoff=False, control=False, address=None, verify=False, capture=None, connect=True):
         self.echo_on = True
         self.verify = verify
+        # send short commands back to back, see isp_pipeline
+        self.pipeline = False
+
+        # link statistics for the session
+        self.counters = {
+            "tx_bytes": 0,
+            "rx_bytes": 0,
+            "retries": 0,
+            "resends": 0,
+            "timeouts": 0,
+        }
+        # device id read during autodetection
+        self.devid = None
+        # optional LinkController
+        self.link = None
         self.OK = 'OK'
         self.RESEND = 'RESEND'
         self.sync_str = 'Synchronized'
@@ -573,16 +1350,43 @@ class nxpprog:
         self.uu_line_size = 45
         # uuencoded block length
         self.uu_block_size = self.uu_line_size * 20
+        # seconds to wait for the status of a ram write after sending its
+        # checksum line again, the target only has a short line to take
+        self.csum_resend_timeout = .5
+
+        # largest read issued when verifying and the largest gap between
+        # two pieces of an image that are still read together
+        self.verify_read_size = 64 * 1024
+        self.verify_gap = 1024
+        # (address, length) ranges that differed in the last verify
+        self.mismatches = []
 
         if address:
             self.device = UdpDevice(address)
-        else:
+        elif isinstance(device, str):
             self.device = SerialDevice(device, baud, xonxoff, control)
+        else:
+            # an already opened device such as the ispsim bootloader
+            # simulator
+            self.device = device
+
+        if capture:
+            self.device = CaptureDevice(self.device, capture)
 
         self.cpu = cpu
 
+        # without connect only the device is set up, the caller does the
+        # sync and can use the commands that don't depend on the cpu type
+        if not connect:
+            self.banks = 0
+            self.sector_commands_need_bank = False
+            return
+
         self.connection_init(osc_freq)
+        self.init_banks()
 
+    def init_banks(self):
+        # base addresses of the flash banks, 0 for single bank devices
         self.banks = self.get_cpu_parm("flash_bank_addr", 0)
 
         if self.banks == 0:
@@ -595,46 +1399,47 @@ class nxpprog:
 
         if self.cpu == "autodetect":
             devid = self.get_devid()
-            for dcpu in cpu_parms.keys():
-                cpu_devid = cpu_parms[dcpu].get("devid")
-                if not cpu_devid:
-                    continue
-
-                # mask devid word1
-                devid_word1_mask = cpu_parms[dcpu].get("devid_word1_mask")
-                if devid_word1_mask and isinstance(devid, tuple) and devid[0] == cpu_devid[0] and (devid[1] & devid_word1_mask) == (cpu_devid[1] & devid_word1_mask):
-                    log("Detected %s" % dcpu)
-                    self.cpu = dcpu
-                    break
-
-                if devid == cpu_devid:
-                    log("Detected %s" % dcpu)
-                    self.cpu = dcpu
-                    break
-            if self.cpu == "autodetect":
-                panic("Cannot autodetect from device id %d(0x%x), set cpu name manually" %
-                        (devid, devid))
+            self.devid = devid
+            dcpu = cpu_from_devid(devid)
+            if not dcpu:
+                panic("Cannot autodetect from device id %s, set cpu name manually" %
+                        format_devid(devid))
+            log("Detected %s" % dcpu)
+            self.cpu = dcpu
 
         # unlock write commands
         self.isp_command("U 23130")
 
 
     def dev_write(self, data):
+        self.counters["tx_bytes"] += len(data)
         self.device.write(data)
 
     def dev_writeln(self, data):
         data = data.encode('UTF-8') + b'\r\n'
         # print('> ' + data)
+        self.counters["tx_bytes"] += len(data)
         self.device.write(data)
 
     def dev_readline(self, timeout=None):
         data = self.device.readline(timeout)
         # print('< ' + data)
+        if data:
+            self.counters["rx_bytes"] += len(data) + 2
+        return data
+
+    def dev_read(self, size, timeout=None):
+        data = self.device.read(size, timeout)
+        # print('< ' + repr(data))
+        self.counters["rx_bytes"] += len(data)
+        if len(data) < size:
+            self.counters["timeouts"] += 1
         return data
 
     def errexit(self, str, status):
         if not status:
             panic("%s: timeout" % str)
+            return
         err = int(status)
         if err != 0:
             error_desc = [
@@ -679,11 +1484,48 @@ class nxpprog:
             status = self.dev_readline()
             if status:
                 break
+            self.counters["timeouts"] += 1
+            if retry > 0:
+                self.counters["retries"] += 1
         self.errexit("'%s' error" % cmd, status)
 
         return status
 
 
+    # Send a list of commands back to back and match the status lines
+    # afterwards instead of waiting for each one. This is only done when
+    # enabled, with echo off and for commands that answer with a status line
+    # only (P, E, C, M, ...). The target does not read its uart buffer
+    # while C or E work on the flash, so nothing is sent past the first of
+    # them. Returns the number of leading commands which succeeded; the
+    # caller issues the rest with isp_command which then reports or handles
+    # the failure as usual.
+    def isp_pipeline(self, cmds):
+        for i in range(0, len(cmds)):
+            if cmds[i].split()[0] in ("C", "E"):
+                cmds = cmds[:i + 1]
+                break
+
+        if not self.pipeline or self.echo_on or len(cmds) < 2:
+            return 0
+
+        self.dev_write(''.join([cmd + '\r\n' for cmd in cmds]).encode('UTF-8'))
+
+        done = 0
+        for cmd in cmds:
+            status = self.dev_readline()
+            if status != str(CMD_SUCCESS):
+                break
+            done += 1
+
+        if done < len(cmds):
+            # throw away whatever the rest of the commands answered
+            while self.dev_readline(.1):
+                pass
+
+        return done
+
+
     def sync(self, osc):
         self.dev_write(b'?')
         s = self.dev_readline()
@@ -740,34 +1582,61 @@ class nxpprog:
 
 
     def sum(self, data):
-        s = 0
         if isinstance(data, str):
+            s = 0
             for ch in data:
                 s += ord(ch)
-        else:
-            for i in data:
-                s += i
-        return s
-
-
-    def write_ram_block(self, addr, data):
-        data_len = len(data)
-
-        for i in range(0, data_len, self.uu_line_size):
-            c_line_size = data_len - i
-            if c_line_size > self.uu_line_size:
-                c_line_size = self.uu_line_size
-            block = data[i:i+c_line_size]
-            bstr = binascii.b2a_uu(block)
-            self.dev_write(bstr)
-
-        retry = 3
-        while retry > 0:
-            retry -= 1
-            self.dev_writeln('%s' % self.sum(data))
-            status = self.dev_readline()
+            return s
+        return sum(data)
+
+
+    # the uuencoded lines of data followed by the checksum line, framed so
+    # the whole block goes out with one write
+    def uu_frame(self, data):
+        lines = []
+        for i in range(0, len(data), self.uu_line_size):
+            lines.append(binascii.b2a_uu(data[i:i + self.uu_line_size]))
+        lines.append(('%s\r\n' % self.sum(data)).encode('UTF-8'))
+        return b''.join(lines)
+
+    # send one block of data, frame is its uu_frame if already prepared.
+    # prepare is called while the block is on the wire, before waiting for
+    # the checksum status. A W command given in command is sent together
+    # with the data instead of waiting for its status first.
+    def write_ram_block(self, addr, data, frame=None, prepare=None,
+            command=None):
+        if frame is None:
+            frame = self.uu_frame(data)
+        if command:
+            self.dev_writeln(command)
+        self.dev_write(frame)
+
+        if prepare:
+            prepare()
+
+        if command:
+            self.errexit("'%s' error" % command, self.dev_readline())
+
+        # lost lines leave the target waiting for more, every checksum line
+        # sent again stands in for one of them. The target is never more
+        # than a group of 20 lines and its checksum behind, with the link
+        # controller it is fed until it answers instead of giving up after
+        # the third try. The status after a resent checksum line is waited
+        # for shortly, 22 full timeouts would stall the block for minutes.
+        retry = 22 if self.link else 3
+        timeout = None
+        while True:
+            status = self.dev_readline(timeout)
             if status:
                 break
+            timeout = self.csum_resend_timeout
+            self.counters["timeouts"] += 1
+            retry -= 1
+            if retry == 0:
+                break
+            self.counters["retries"] += 1
+            # the checksum may have been lost, send it again
+            self.dev_writeln('%s' % self.sum(data))
         if not status:
             return "timeout"
         if status == self.RESEND:
@@ -778,101 +1647,273 @@ class nxpprog:
         # unknown status result
         panic(status)
 
+    # number of bytes a uuencoded line holding count data bytes takes up on
+    # the wire, including the length character and the <CR><LF> terminator
+    def uu_wire_len(self, count):
+        return 1 + (count + 3 - 1) // 3 * 4 + 2
+
+    # the data of a uuencoded line and None, or None and what is wrong
+    # with the line when it was damaged on the way
     def uudecode(self, line):
+        if not line:
+            return (None, "Error in line length")
+
         # uu encoded data has an encoded length first
-        linelen = ord(line[0]) - 32
+        linelen = (line[0] - 32) % 64
 
         uu_linelen = (linelen + 3 - 1) // 3 * 4
 
         if uu_linelen + 1 != len(line):
-            panic("Error in line length")
-
-        # pure python implementation - if this was C we would
-        # use bitshift operations here
-        decoded = ""
-        for i in range(1, len(line), 4):
-            c = 0
-            for j in line[i: i + 4]:
-                ch = ord(j) - 32
-                ch %= 64
-                c = c * 64 + ch
-            s = []
-            for j in range(0, 3):
-                s.append(c % 256)
-                c = c // 256
-            for j in reversed(s):
-                decoded = decoded + chr(j)
-
-        # only return real data
-        return decoded[0:linelen]
+            return (None, "Error in line length")
+
+        try:
+            return (binascii.a2b_uu(line), None)
+        except (binascii.Error, ValueError) as e:
+            return (None, "Error in line encoding: %s" % e)
+
+
+    # read one group of up to 20 uuencoded lines holding data_len bytes.
+    # The length of every line follows from data_len so the whole group is
+    # fetched with a single read instead of one readline per line. Returns
+    # the data and None, or None and what went wrong.
+    def read_uu_group(self, data_len):
+        line_lens = []
+        for i in range(0, data_len, self.uu_line_size):
+            line_lens.append(min(self.uu_line_size, data_len - i))
+
+        wire_len = 0
+        for count in line_lens:
+            wire_len += self.uu_wire_len(count)
+
+        buf = self.dev_read(wire_len)
+        # a line feed may be left over from the preceding status line
+        skip = len(buf) - len(buf.lstrip(b'\r\n'))
+        while skip:
+            buf = buf[skip:]
+            more = self.dev_read(skip)
+            buf += more
+            skip = len(buf) - len(buf.lstrip(b'\r\n'))
+            if not more:
+                break
+
+        if len(buf) != wire_len:
+            return (None, "Read timeout: got %d of %d bytes" %
+                    (len(buf), wire_len))
+
+        data = []
+        pos = 0
+        for count in line_lens:
+            end = pos + self.uu_wire_len(count) - 2
+            if buf[end:end + 2] != b'\r\n':
+                return (None, "Error in line framing at offset %d" % pos)
+            (line, err) = self.uudecode(buf[pos:end])
+            if err:
+                return (None, err)
+            data.append(line)
+            pos = end + 2
+
+        return (b''.join(data), None)
+
+    # read a group together with its checksum line, returns the data and
+    # None, or None and what went wrong. The checksum line is read even
+    # when the group was damaged so the target can be asked for it again.
+    def read_uu_checked(self, data_len):
+        (data, err) = self.read_uu_group(data_len)
+        s = self.dev_readline()
+        if err:
+            return (None, err)
+        if not s.isdigit() or int(s) != self.sum(data):
+            return (None, "Checksum mismatch on read got %s expected 0x%x" %
+                    (s, self.sum(data)))
+        return (data, None)
 
 
+    # cpus with a binary transfer mode send W and R data as is, without
+    # uuencoding and checksum lines
+    def binary_transfer(self):
+        return self.get_cpu_parm("transfer", "uuencode") == "binary"
+
+    def read_binary(self, addr, data_len, fd=None):
+        self.isp_command("R %d %d" % ( addr, data_len ))
+
+        data = self.dev_read(data_len)
+        if len(data) != data_len:
+            panic("Read timeout: got %d of %d bytes" % (len(data), data_len))
+
+        if fd:
+            fd.write(data)
+            return None
+        return data
+
     def read_block(self, addr, data_len, fd=None):
+        if self.binary_transfer():
+            return self.read_binary(addr, data_len, fd)
+
         self.isp_command("R %d %d" % ( addr, data_len ))
 
-        expected_lines = (data_len + self.uu_line_size - 1) // self.uu_line_size
+        group_size = self.uu_line_size * 20
 
-        data = ""
-        for i in range(0, expected_lines, 20):
-            lines = expected_lines - i
-            if lines > 20:
-                lines = 20
-            cdata = ""
-            for i in range(0, lines):
-                line = self.dev_readline()
+        if self.link:
+            errors = self.link.errors()
 
-                decoded = self.uudecode(line)
+        data = []
+        for i in range(0, data_len, group_size):
+            count = min(group_size, data_len - i)
+            (cdata, err) = self.read_uu_checked(count)
 
-                cdata += decoded
+            if self.link:
+                # ask for the group again instead of giving up
+                retry = self.link.max_resends
+                while err and retry > 0:
+                    retry -= 1
+                    log("Resending: %s" % err)
+                    self.counters["resends"] += 1
+                    self.dev_writeln(self.RESEND)
+                    (cdata, err) = self.read_uu_checked(count)
 
-            s = self.dev_readline()
+            if err:
+                panic(err)
 
-            if int(s) != self.sum(cdata):
-                panic("Checksum mismatch on read got 0x%x expected 0x%x" % (int(s), self.sum(data)))
-            else:
-                self.dev_writeln(self.OK)
+            # acknowledge straight away so the target can start sending the
+            # next group while this one is stored
+            self.dev_writeln(self.OK)
 
             if fd:
                 fd.write(cdata)
             else:
-                data += cdata
+                data.append(cdata)
+
+        # the link is only changed between commands, not in the middle of
+        # the R transfer
+        if self.link:
+            self.link.block_done(data_len, self.link.errors() - errors)
 
         if fd:
             return None
         else:
-            return data
+            return b''.join(data)
+
+    # the data follows the W command in one piece, there is no status
+    # after it
+    # the data is only sent once W is accepted, even with pipelining. The
+    # target would take it for commands otherwise.
+    def write_ram_binary(self, addr, data):
+        self.isp_command("W %d %d" % ( addr, len(data) ))
+        self.dev_write(data)
+
+    # the frames of data for write_ram_data by (offset, size), None for
+    # binary transfers which need no framing
+    def ram_frames(self, data):
+        if self.binary_transfer():
+            return None
+        frames = {}
+        for i in range(0, len(data), self.uu_block_size):
+            block = data[i:i + self.uu_block_size]
+            frames[(i, len(block))] = self.uu_frame(block)
+        return frames
+
+    # write data to ram in blocks. Each block is framed while the one
+    # before it is on the wire, so the link doesn't idle between blocks.
+    # frames are the ram_frames of data if they are prepared already.
+    def write_ram_data(self, addr, data, frames=None):
+        if self.binary_transfer():
+            self.write_ram_binary(addr, data)
+            return
 
-    def write_ram_data(self, addr, data):
         image_len = len(data)
-        for i in range(0, image_len, self.uu_block_size):
-
+        # frames of upcoming blocks by (offset, size)
+        prepared = dict(frames or {})
+        i = 0
+        while i < image_len:
+            # the block size may be changed by the link controller
             a_block_size = image_len - i
             if a_block_size > self.uu_block_size:
                 a_block_size = self.uu_block_size
 
-            self.isp_command("W %d %d" % ( addr, a_block_size ))
+            block = data[i : i + a_block_size]
+            frame = prepared.pop((i, a_block_size), None)
+            if frame is None:
+                frame = self.uu_frame(block)
+
+            def prepare(next_i=i + a_block_size):
+                if next_i < image_len:
+                    size = min(image_len - next_i, self.uu_block_size)
+                    if (next_i, size) in prepared:
+                        return
+                    prepared[(next_i, size)] = \
+                            self.uu_frame(data[next_i : next_i + size])
+
+            if self.link:
+                errors = self.link.errors()
+                retry = self.link.max_resends
+            else:
+                retry = 3
+
+            # with pipelining the data follows the W command without
+            # waiting a round trip for its status
+            command = "W %d %d" % ( addr, a_block_size )
+            if not self.pipeline or self.echo_on:
+                self.isp_command(command)
+                command = None
 
-            retry = 3
             while retry > 0:
                 retry -= 1
-                err = self.write_ram_block(addr, data[i : i + a_block_size])
+                err = self.write_ram_block(addr, block, frame, prepare,
+                        command)
+                prepare = None
+                command = None
                 if not err:
                     break
                 elif err != "resend":
                     panic("Write error: %s" % err)
                 else:
                     log("Resending")
+                    self.counters["resends"] += 1
+            if err:
+                panic("Write error: too many resends")
+
+            if self.link:
+                self.link.block_done(a_block_size, self.link.errors() - errors)
 
             addr += a_block_size
+            i += a_block_size
+
+
+    def flash_sector_count(self):
+        return self.get_cpu_parm("flash_sector_count",
+            len(self.get_cpu_parm("flash_sector")))
+
+
+    def flash_bank_size(self):
+        table = self.get_cpu_parm("flash_sector")
+        return 1024 * sum(table[:self.flash_sector_count()])
+
+
+    # the flash bank an address belongs to, always 0 for devices without
+    # flash banks and -1 if the address isn't in any bank
+    def find_flash_bank(self, addr):
+        if self.banks == 0:
+            return 0
+        bank_size = self.flash_bank_size()
+        for bank in range(0, len(self.banks)):
+            if addr >= self.banks[bank] and \
+                    addr < self.banks[bank] + bank_size:
+                return bank
+        return -1
+
+
+    def flash_bank_base(self, bank):
+        if self.banks == 0:
+            return 0
+        return self.banks[bank]
 
 
     def find_flash_sector(self, addr):
         table = self.get_cpu_parm("flash_sector")
-        flash_base_addr = self.get_cpu_parm("flash_bank_addr", 0)
-        if flash_base_addr == 0:
-            faddr = 0
-        else:
-            faddr = flash_base_addr[0] # fix to have a current flash bank
+        bank = self.find_flash_bank(addr)
+        if bank < 0:
+            return -1
+        faddr = self.flash_bank_base(bank)
         for i in range(0, len(table)):
             n_faddr = faddr + table[i] * 1024
             if addr >= faddr and addr < n_faddr:
@@ -921,53 +1962,104 @@ class nxpprog:
         return image
 
 
-    def prepare_flash_sectors(self, start_sector, end_sector):
+    # format a P, E or I sector command, adding the bank number for
+    # devices with flash banks
+    def sector_command(self, cmd, start_sector, end_sector, bank=0):
         if self.sector_commands_need_bank:
-            self.isp_command("P %d %d 0" % (start_sector, end_sector))
+            return "%s %d %d %d" % (cmd, start_sector, end_sector, bank)
         else:
-            self.isp_command("P %d %d" % (start_sector, end_sector))
+            return "%s %d %d" % (cmd, start_sector, end_sector)
 
 
-    def erase_sectors(self, start_sector, end_sector, verify=False):
-        self.prepare_flash_sectors(start_sector, end_sector)
+    def prepare_flash_sectors(self, start_sector, end_sector, bank=0):
+        self.isp_command(self.sector_command("P", start_sector, end_sector,
+                bank))
 
-        log("Erasing flash sectors %d-%d" % (start_sector, end_sector))
 
+    def erase_sectors(self, start_sector, end_sector, verify=False, bank=0):
         if self.sector_commands_need_bank:
-            self.isp_command("E %d %d 0" % (start_sector, end_sector))
+            log("Erasing flash sectors %d-%d in bank %d" %
+                    (start_sector, end_sector, bank))
         else:
-            self.isp_command("E %d %d" % (start_sector, end_sector))
+            log("Erasing flash sectors %d-%d" % (start_sector, end_sector))
+
+        cmds = [self.sector_command("P", start_sector, end_sector, bank),
+                self.sector_command("E", start_sector, end_sector, bank)]
+        done = self.isp_pipeline(cmds)
+        for cmd in cmds[done:]:
+            self.isp_command(cmd)
 
         if verify:
             log("Blank checking sectors %d-%d" % (start_sector, end_sector))
-            self.blank_check_sectors(start_sector, end_sector)
+            self.blank_check_sectors(start_sector, end_sector, bank)
 
 
-    def blank_check_sectors(self, start_sector, end_sector):
+    def blank_check_sectors(self, start_sector, end_sector, bank=0):
+        for i in range(start_sector, end_sector+1):
+            self.sector_blank(i, bank)
+
+
+    # blank check one sector, returns True when it is blank. Sectors that
+    # are not blank are logged unless quiet is set.
+    def sector_blank(self, sector, bank=0, quiet=False):
         global panic
         old_panic = panic
-        panic = log
-        for i in range(start_sector, end_sector+1):
-            if self.sector_commands_need_bank:
-                cmd = ("I %d %d 0" % (i, i))
-            else:
-                cmd = ("I %d %d" % (i, i))
-            result = self.isp_command(cmd)
-            if result == str(CMD_SUCCESS):
-                pass
-            elif result == str(SECTOR_NOT_BLANK):
-                self.dev_readline() # offset
-                self.dev_readline() # content
-            else:
-                self.errexit("'%s' error" % cmd, status)
+        panic = (lambda str: None) if quiet else log
+        cmd = self.sector_command("I", sector, sector, bank)
+        result = self.isp_command(cmd)
         panic = old_panic
+        if result == str(CMD_SUCCESS):
+            return True
+        elif result == str(SECTOR_NOT_BLANK):
+            self.dev_readline() # offset
+            self.dev_readline() # content
+            return False
+        else:
+            self.errexit("'%s' error" % cmd, result)
+
+
+    # read the contents of all flash sectors that are not blank, returns
+    # a list of (address, data) segments. Blank sectors are found with the
+    # I command and not read.
+    def dump_flash(self):
+        table = self.get_cpu_parm("flash_sector")
+        sector_count = self.flash_sector_count()
+
+        segments = []
+        blank = 0
+        for bank in range(0, self.flash_bank_count()):
+            addr = self.flash_bank_base(bank)
+            # (address, length) runs of adjacent populated sectors
+            runs = []
+            for sector in range(0, sector_count):
+                size = table[sector] * 1024
+                if self.sector_blank(sector, bank, True):
+                    blank += 1
+                elif runs and runs[-1][0] + runs[-1][1] == addr:
+                    runs[-1] = (runs[-1][0], runs[-1][1] + size)
+                else:
+                    runs.append((addr, size))
+                addr += size
+
+            for (run_addr, length) in runs:
+                log("Reading %d bytes from 0x%x" % (length, run_addr))
+                segments.append((run_addr, self.read_block(run_addr, length)))
+
+        log("Skipped %d of %d blank sectors" %
+                (blank, sector_count * self.flash_bank_count()))
+        return segments
 
 
     def erase_flash_range(self, start_addr, end_addr, verify=False):
+        bank = self.find_flash_bank(start_addr)
+        if bank != self.find_flash_bank(end_addr):
+            panic("Flash range 0x%x-0x%x is not within one flash bank" %
+                    (start_addr, end_addr))
+
         start_sector = self.find_flash_sector(start_addr)
         end_sector = self.find_flash_sector(end_addr)
 
-        self.erase_sectors(start_sector, end_sector, verify)
+        self.erase_sectors(start_sector, end_sector, verify, bank)
 
 
     def get_cpu_parm(self, key, default=None):
@@ -983,43 +2075,273 @@ class nxpprog:
             panic("No value for required cpu parameter %s" % key)
 
 
+    def flash_bank_count(self):
+        if self.banks == 0:
+            return 1
+        return len(self.banks)
+
+
     def erase_all(self, verify=False):
-        end_sector = self.get_cpu_parm("flash_sector_count",
-            len(self.get_cpu_parm("flash_sector"))) - 1
+        end_sector = self.flash_sector_count() - 1
 
-        self.erase_sectors(0, end_sector, verify)
+        for bank in range(0, self.flash_bank_count()):
+            self.erase_sectors(0, end_sector, verify, bank)
 
 
     def blank_check_all(self):
-        end_sector = self.get_cpu_parm("flash_sector_count",
-            len(self.get_cpu_parm("flash_sector"))) - 1
+        end_sector = self.flash_sector_count() - 1
 
-        self.blank_check_sectors(0, end_sector)
+        for bank in range(0, self.flash_bank_count()):
+            self.blank_check_sectors(0, end_sector, bank)
 
 
-    def prog_image(self, image, flash_addr_base=0,
-            erase_all=False, verify=False):
+    # if the image starts at the start of a flash bank then make it bootable
+    # by inserting a checksum at the right place in the vector table
+    def bootable_image(self, image, flash_addr_base):
+        if self.banks == 0:
+            if flash_addr_base == 0:
+                image = self.insert_csum(image)
+        elif flash_addr_base in self.banks:
+            image = self.insert_csum(image)
+        return image
+
+
+    # the offsets of the flash sectors from the start of a bank, followed
+    # by the bank size
+    def sector_offsets(self):
+        table = self.get_cpu_parm("flash_sector")
+        offsets = [0]
+        for size in table[:self.flash_sector_count()]:
+            offsets.append(offsets[-1] + 1024 * size)
+        return offsets
+
+
+    # Merge a list of (address, data) segments into a plan of runs of
+    # adjacent flash sectors, a list of (bank, start_sector, end_sector,
+    # blocks) tuples. Every sector holding data appears once. blocks are the
+    # (address, data) pieces of ram_block size to copy into the run; bytes
+    # not covered by any segment are 0xff and blocks holding nothing else
+    # are left out as erasing the sectors took care of them.
+    def sector_plan(self, segments, ram_block):
+        offsets = self.sector_offsets()
+
+        sectors = {}
+        last_end = None
+        for (addr, data) in sorted(segments, key=lambda x: x[0]):
+            if last_end is not None and addr < last_end:
+                panic("Overlapping image data at 0x%x" % addr)
+            last_end = addr + len(data)
+
+            bank = self.find_flash_bank(addr)
+            if bank < 0:
+                panic("Image data at 0x%x is not in flash" % addr)
+            if bank != self.find_flash_bank(last_end - 1):
+                panic("Image data at 0x%x crosses a flash bank boundary" %
+                        addr)
+            base = self.flash_bank_base(bank)
+
+            pos = 0
+            while pos < len(data):
+                sector = self.find_flash_sector(addr + pos)
+                if sector < 0:
+                    panic("Image data at 0x%x is not in flash" % (addr + pos))
+                start = base + offsets[sector]
+                end = base + offsets[sector + 1]
+                buf = sectors.get((bank, sector))
+                if buf is None:
+                    buf = bytearray(self.bytestr(0xff, end - start))
+                    sectors[(bank, sector)] = buf
+                count = min(len(data) - pos, end - (addr + pos))
+                offset = addr + pos - start
+                buf[offset:offset + count] = data[pos:pos + count]
+                pos += count
+
+        plan = []
+        for (bank, sector) in sorted(sectors.keys()):
+            if plan and plan[-1][0] == bank and plan[-1][2] == sector - 1:
+                plan[-1][2] = sector
+                plan[-1][3].append(sectors[(bank, sector)])
+            else:
+                plan.append([bank, sector, sector, [sectors[(bank, sector)]]])
+
+        runs = []
+        for (bank, start_sector, end_sector, bufs) in plan:
+            run_addr = self.flash_bank_base(bank) + offsets[start_sector]
+            run = b''.join(bufs)
+            blocks = []
+            for i in range(0, len(run), ram_block):
+                block = run[i:i + ram_block]
+                if block.count(b'\xff') != len(block):
+                    blocks.append((run_addr + i, block))
+            runs.append((bank, start_sector, end_sector, blocks))
+
+        return runs
+
+
+    # apply bootable_image to every segment
+    def bootable_segments(self, segments):
+        return [(addr, self.bootable_image(data, addr))
+                for (addr, data) in segments]
+
+
+    # program a list of (address, data) segments, which may come from
+    # several images and be spread over several flash banks, in one
+    # session. Every sector is erased once and written once.
+    def prog_segments(self, segments, erase_all=False, verify=False):
+        ram_block = self.get_cpu_parm("flash_prog_buffer_size",
+                flash_prog_buffer_size_default)
+
+        plan = self.sector_plan(self.bootable_segments(segments), ram_block)
+
+        if erase_all:
+            self.erase_all(verify)
+        else:
+            for (bank, start_sector, end_sector, blocks) in plan:
+                self.erase_sectors(start_sector, end_sector, verify, bank)
+
+        success = True
+        for (bank, start_sector, end_sector, blocks) in plan:
+            if not self.prog_blocks(blocks, bank, verify):
+                success = False
+
+        return success
+
+
+    # program an image prepared with PreparedImage
+    def prog_prepared(self, prepared, erase_all=False, verify=False):
+        if erase_all:
+            self.erase_all(verify)
+        else:
+            for (bank, start_sector, end_sector, blocks) in prepared.runs:
+                self.erase_sectors(start_sector, end_sector, verify, bank)
+
+        success = True
+        for (bank, start_sector, end_sector, blocks) in prepared.runs:
+            if not self.prog_blocks(blocks, bank, verify, prepared.frames):
+                success = False
+
+        return success
+
+
+    # Write a list of (address, data) segments into flash without losing
+    # the rest of the sectors they fall in: the sectors are read, merged
+    # with the new data, erased and written back and the result compared
+    # with M. Sectors whose contents don't change are left alone.
+    def patch_segments(self, segments, backup=None):
         global panic
+        offsets = self.sector_offsets()
+
+        def raise_error(str):
+            raise PatchError(str)
+
+        # the current contents of every sector touched by the segments
+        sectors = {}
+        for (addr, data) in segments:
+            bank = self.find_flash_bank(addr)
+            if bank < 0 or bank != self.find_flash_bank(addr + len(data) - 1):
+                panic("Patch data at 0x%x is not in one flash bank" % addr)
+            base = self.flash_bank_base(bank)
+            for sector in range(self.find_flash_sector(addr),
+                    self.find_flash_sector(addr + len(data) - 1) + 1):
+                if (bank, sector) in sectors:
+                    continue
+                start = base + offsets[sector]
+                size = offsets[sector + 1] - offsets[sector]
+                if self.sector_blank(sector, bank, True):
+                    current = self.bytestr(0xff, size)
+                else:
+                    log("Reading %d bytes from 0x%x" % (size, start))
+                    current = self.read_block(start, size)
+                sectors[(bank, sector)] = (start, current, bytearray(current))
+
+        for (addr, data) in segments:
+            for (start, current, buf) in sectors.values():
+                lo = max(addr, start)
+                hi = min(addr + len(data), start + len(buf))
+                if lo < hi:
+                    buf[lo - start:hi - start] = data[lo - addr:hi - addr]
+
+        merged = []
+        originals = []
+        for key in sorted(sectors.keys()):
+            (start, current, buf) = sectors[key]
+            if bytes(buf) == current:
+                log("Sector %d at 0x%x is unchanged" % (key[1], start))
+                continue
+            originals.append((start, current))
+            data = bytes(buf)
+            # keep the image bootable when the vector table is patched
+            if start == self.flash_bank_base(key[0]) and \
+                    [a for (a, d) in segments if a < start + 32 and
+                        a + len(d) > start]:
+                data = self.bootable_image(data, start)
+            merged.append((start, data))
+
+        ram_block = self.get_cpu_parm("flash_prog_buffer_size",
+                flash_prog_buffer_size_default)
+        plan = self.sector_plan(merged, ram_block)
+        if not plan:
+            return True
+
+        # the sectors are gone once erased, keep them in a file until they
+        # are written back. A backup file that was not asked for is removed
+        # again after a successful patch.
+        keep = backup is not None
+        if not keep:
+            backup = time.strftime("nxpprog-patch-%Y%m%d-%H%M%S.hex")
+        save_image(backup, originals, base=self.flash_bank_base(0))
+        log("Saved the old contents of the sectors to %s" % backup)
+
+        for (bank, start_sector, end_sector, blocks) in plan:
+            self.erase_sectors(start_sector, end_sector, False, bank)
+
+        # a failed write is erased and written once more. Errors end the
+        # try they happen in, carrying on after them could compare stale
+        # ram with what it was copied to.
         success = True
+        old_panic = panic
+        panic = raise_error
+        try:
+            for (bank, start_sector, end_sector, blocks) in plan:
+                for attempt in range(0, 2):
+                    try:
+                        if attempt:
+                            log("Writing sectors %d to %d again" %
+                                    (start_sector, end_sector))
+                            self.erase_sectors(start_sector, end_sector,
+                                    False, bank)
+                        if self.prog_blocks(blocks, bank, True):
+                            break
+                    except PatchError as e:
+                        log("Writing sectors %d to %d failed: %s" %
+                                (start_sector, end_sector, e))
+                else:
+                    success = False
+        finally:
+            panic = old_panic
 
-        # the base address of the ram block to be written to flash
-        ram_addr = self.get_cpu_parm("flash_prog_buffer_base",
-                flash_prog_buffer_base_default)
+        if not success:
+            log("The old contents of the sectors are in %s" % backup)
+        elif not keep:
+            os.remove(backup)
+
+        return success
+
+
+    def prog_image(self, image, flash_addr_base=0,
+            erase_all=False, verify=False):
         # the size of the ram block to be written to flash
         # 256 | 512 | 1024 | 4096
         ram_block = self.get_cpu_parm("flash_prog_buffer_size",
                 flash_prog_buffer_size_default)
 
-        # if the image starts at the start of a flash bank then make it bootable
-        # by inserting a checksum at the right place in the vector table
-        if self.banks == 0:
-            if flash_addr_base == 0:
-                image = self.insert_csum(image)
-        elif flash_addr_base in self.banks:
-            image = self.insert_csum(image)
+        bank = self.find_flash_bank(flash_addr_base)
+
+        image = self.bootable_image(image, flash_addr_base)
 
         image_len = len(image)
         # pad to a multiple of ram_block size with 0xff
+        pad_count = 0
         pad_count_rem = image_len % ram_block
         if pad_count_rem != 0:
             pad_count = ram_block - pad_count_rem
@@ -1033,35 +2355,55 @@ class nxpprog:
         else:
             self.erase_flash_range(flash_addr_base, flash_addr_base + image_len - 1, verify)
 
+        blocks = []
         for image_index in range(0, image_len, ram_block):
-            a_ram_block = image_len - image_index
-            if a_ram_block > ram_block:
-                a_ram_block = ram_block
+            blocks.append((flash_addr_base + image_index,
+                    image[image_index: image_index + ram_block]))
+
+        return self.prog_blocks(blocks, bank, verify)
+
+
+    # write a list of (flash address, data) blocks of at most the ram block
+    # size to already erased flash in bank through the ram buffer. frames
+    # holds the ram_frames of blocks by flash address if prepared already.
+    def prog_blocks(self, blocks, bank=0, verify=False, frames=None):
+        global panic
+        success = True
 
-            flash_addr_start = image_index + flash_addr_base
+        # the base address of the ram block to be written to flash
+        ram_addr = self.get_cpu_parm("flash_prog_buffer_base",
+                flash_prog_buffer_base_default)
+
+        for (flash_addr_start, block) in blocks:
+            a_ram_block = len(block)
             flash_addr_end = flash_addr_start + a_ram_block - 1
 
             log("Writing %d bytes to 0x%x" % (a_ram_block, flash_addr_start))
 
-            self.write_ram_data(ram_addr,
-                    image[image_index: image_index + a_ram_block])
+            self.write_ram_data(ram_addr, block,
+                    frames.get(flash_addr_start) if frames else None)
 
             s_flash_sector = self.find_flash_sector(flash_addr_start)
 
             e_flash_sector = self.find_flash_sector(flash_addr_end)
 
-            self.prepare_flash_sectors(s_flash_sector, e_flash_sector)
+            # prepare, copy ram to flash and optionally compare ram and
+            # flash. M is only sent once C is done.
+            cmds = [self.sector_command("P", s_flash_sector, e_flash_sector,
+                        bank),
+                    "C %d %d %d" % (flash_addr_start, ram_addr, a_ram_block)]
+            if verify:
+                cmds.append("M %d %d %d" %
+                        (flash_addr_start, ram_addr, a_ram_block))
+            done = self.isp_pipeline(cmds)
 
-            # copy ram to flash
-            self.isp_command("C %d %d %d" %
-                    (flash_addr_start, ram_addr, a_ram_block))
+            for cmd in cmds[done:2]:
+                self.isp_command(cmd)
 
-            # optionally compare ram and flash
-            if verify:
+            if verify and done < 3:
                 old_panic = panic
                 panic = log
-                result = self.isp_command("M %d %d %d" %
-                                          (flash_addr_start, ram_addr, a_ram_block))
+                result = self.isp_command(cmds[2])
                 panic = old_panic
                 if result == str(CMD_SUCCESS):
                     pass
@@ -1069,61 +2411,192 @@ class nxpprog:
                     self.dev_readline() # offset
                     success = False
                 else:
-                    self.errexit("'%s' error" % cmd, status)
+                    self.errexit("'M' error", result)
 
         return success
 
 
     def verify_image(self, flash_addr_base, image):
-        success = True
-
-        image_length = len(image)
-        start_addr = flash_addr_base
-        end_addr = flash_addr_base + image_length
-
-        start_sector = self.find_flash_sector(start_addr)
-        end_sector = self.find_flash_sector(end_addr)
-
-        table = self.get_cpu_parm("flash_sector")
-        flash_base_addr = self.get_cpu_parm("flash_bank_addr", 0)
-        if flash_base_addr == 0:
-            faddr = 0
-        else:
-            faddr = flash_base_addr[0] # fix to have a current flash bank
-
-        index = 0
-        sector = start_sector
-        while sector <= end_sector:
-            start_of_sector = faddr + 1024 * sum(table[:sector])
-            end_of_sector = faddr + 1024 * sum(table[:sector+1])
-
-            start = start_addr if start_of_sector < start_addr else start_of_sector
-            end = end_addr if end_of_sector > end_addr else end_of_sector
-            length = 4 * ((end - start) // 4)
-
-            log("Verify sector %i: Reading %d bytes from 0x%x" % (sector, length, start))
-            data = self.read_block(start, length)
-            if isinstance(image[0], int):
-                data = [ord(x) for x in data]
-
-            if len(data) != length:
-                panic("Verify failed! lengths differ")
-
-            for (i, (x, y)) in enumerate(zip(data, image[index:index+(end-start)])):
-                if x != y:
-                    log("Verify failed! content differ at location 0x%x" % (faddr + i))
-                    success = False
-                    break
-
-            index = index + length
-            sector = sector + 1
-
-        return success
-
-
-    def start(self, addr=0):
-        mode = self.get_cpu_parm("cpu_type", "arm")
-        # start image at address 0
+        return self.verify_segments([(flash_addr_base, image)])
+
+
+    # add the (address, length) ranges where data differs from expected to
+    # the list ranges, merging adjacent ones
+    def diff_ranges(self, addr, data, expected, ranges):
+        if data == expected:
+            return
+        step = 256
+        for i in range(0, len(expected), step):
+            a = data[i:i + step]
+            b = expected[i:i + step]
+            if a == b:
+                continue
+            for j in range(0, len(b)):
+                if j < len(a) and a[j] == b[j]:
+                    continue
+                x = addr + i + j
+                if ranges and ranges[-1][0] + ranges[-1][1] == x:
+                    ranges[-1] = (ranges[-1][0], ranges[-1][1] + 1)
+                else:
+                    ranges.append((x, 1))
+
+
+    # Read back the flash under a list of (address, data) segments and
+    # return every range, as (address, length), where it differs. Segments
+    # close to each other in the same bank are read together and the reads
+    # cross sector boundaries, up to verify_read_size bytes per R command.
+    def verify_map(self, segments):
+        spans = []
+        for (addr, data) in sorted(segments, key=lambda x: x[0]):
+            if not data:
+                continue
+            bank = self.find_flash_bank(addr)
+            if spans and spans[-1][0] == bank and \
+                    addr - spans[-1][2] <= self.verify_gap:
+                spans[-1][2] = max(spans[-1][2], addr + len(data))
+                spans[-1][3].append((addr, data))
+            else:
+                spans.append([bank, addr, addr + len(data), [(addr, data)]])
+
+        ranges = []
+        for (bank, start, end, span_segments) in spans:
+            # R works on whole words
+            start -= start % 4
+            end += (4 - end % 4) % 4
+
+            for read_addr in range(start, end, self.verify_read_size):
+                length = min(self.verify_read_size, end - read_addr)
+                log("Verify: reading %d bytes from 0x%x" % (length, read_addr))
+                data = self.read_block(read_addr, length)
+                if len(data) != length:
+                    panic("Verify failed! lengths differ")
+
+                for (addr, expected) in span_segments:
+                    lo = max(addr, read_addr)
+                    hi = min(addr + len(expected), read_addr + length)
+                    if lo >= hi:
+                        continue
+                    self.diff_ranges(lo,
+                            data[lo - read_addr:hi - read_addr],
+                            expected[lo - addr:hi - addr], ranges)
+
+        return ranges
+
+
+    # the crc32 the target computes of count bytes at addr with the S
+    # command, None if it refuses the command
+    def read_crc(self, addr, count):
+        global panic
+        old_panic = panic
+        panic = log
+        status = self.isp_command("S %d %d" % (addr, count))
+        panic = old_panic
+        if status != str(CMD_SUCCESS):
+            return None
+        crc = self.dev_readline()
+        if not crc:
+            panic("'S' error: timeout")
+        return int(crc)
+
+
+    # Compare the flash under a list of (address, data) segments with the
+    # crc32 the target computes of it, one S command per sector. Returns
+    # the segments which still have to be read back: the sectors whose crc
+    # differs and the unaligned ends of the segments, S works on words only.
+    # If the target doesn't know the command everything is read back.
+    def verify_crc(self, segments):
+        offsets = self.sector_offsets()
+
+        readback = []
+        for (addr, data) in segments:
+            start = (addr + 3) & ~3
+            end = (addr + len(data)) & ~3
+            if start >= end:
+                readback.append((addr, data))
+                continue
+            if start > addr:
+                readback.append((addr, data[:start - addr]))
+            if end < addr + len(data):
+                readback.append((end, data[end - addr:]))
+
+            while start < end:
+                sector = self.find_flash_sector(start)
+                if sector < 0:
+                    chunk_end = end
+                else:
+                    bank_base = self.flash_bank_base(
+                            self.find_flash_bank(start))
+                    chunk_end = min(end, bank_base + offsets[sector + 1])
+                expected = data[start - addr:chunk_end - addr]
+
+                crc = self.read_crc(start, len(expected))
+                if crc is None:
+                    log("Verify: crc not supported, reading back")
+                    return segments
+                if crc != binascii.crc32(expected) & 0xffffffff:
+                    log("Verify: crc of %d bytes at 0x%x differs, "
+                            "reading back" % (len(expected), start))
+                    readback.append((start, expected))
+                start = chunk_end
+
+        return readback
+
+
+    def verify_segments(self, segments):
+        segments = self.bootable_segments(segments)
+        # only some isps have the crc command, on lpc18xx S selects the
+        # boot bank
+        if self.get_cpu_parm("read_crc", False):
+            segments = self.verify_crc(segments)
+        self.mismatches = self.verify_map(segments)
+
+        for (addr, length) in self.mismatches:
+            log("Verify failed! content differs at 0x%x-0x%x (%d bytes)" %
+                    (addr, addr + length - 1, length))
+
+        return not self.mismatches
+
+
+    # the (start, end) addresses of the ram not used by the isp handler
+    def ram_range(self):
+        base = self.get_cpu_parm("ram_base", ram_base_default)
+        size = self.get_cpu_parm("ram_size")
+        return (base + ram_isp_low, base + size - ram_isp_high)
+
+
+    # write segments to ram for running them with start. The segments have
+    # to fit into the free ram and start on a word boundary.
+    def load_ram(self, segments):
+        (ram_start, ram_end) = self.ram_range()
+
+        for (addr, data) in segments:
+            end = addr + len(data)
+            if addr < ram_start or end > ram_end:
+                panic("Image at 0x%x-0x%x does not fit into free ram "
+                        "0x%x-0x%x" % (addr, end - 1, ram_start, ram_end - 1))
+            if addr % 4:
+                panic("Image address 0x%x is not word aligned" % addr)
+
+        for (addr, data) in segments:
+            # ram can only be written in words
+            if len(data) % 4:
+                data = data + self.bytestr(0, 4 - len(data) % 4)
+            log("Writing %d bytes to ram at 0x%x" % (len(data), addr))
+            self.write_ram_data(addr, data)
+
+            if self.verify:
+                if self.read_block(addr, len(data)) != data:
+                    panic("Verify failed! ram at 0x%x differs" % addr)
+
+
+    # start code at addr. An odd address or mode "thumb" starts in thumb
+    # mode, otherwise the mode is the one the cpu boots in.
+    def start(self, addr=0, mode=None):
+        if addr & 1:
+            mode = "thumb"
+            addr &= ~1
+        if not mode:
+            mode = self.get_cpu_parm("cpu_type", "arm")
         if mode == "arm":
             m = "A"
         elif mode == "thumb":
@@ -1134,10 +2607,18 @@ class nxpprog:
         self.isp_command("G %d %s" % (addr, m))
 
 
+    # the average round trip time of a command in seconds
+    def command_rtt(self, count=10):
+        start = time.time()
+        for i in range(0, count):
+            self.isp_command("U 23130")
+        return (time.time() - start) / count
+
+
     def select_bank(self, bank):
         status = self.isp_command("S %d" % bank)
 
-        if status == self.OK:
+        if status == str(CMD_SUCCESS):
             return 1
 
         return 0
@@ -1158,12 +2639,320 @@ class nxpprog:
 
     def get_serial_number(self):
         self.isp_command("N")
+        return self.read_serial_number()
+
+    def read_serial_number(self):
         id1 = self.dev_readline()
         id2 = self.dev_readline(.2)
         id3 = self.dev_readline(.2)
         id4 = self.dev_readline(.2)
         return ' '.join([id1, id2, id3, id4])
 
+    # the serial number or None, for parts without the N command. The
+    # scan asks for it from several threads at once, so panic is caught
+    # here instead of being swapped.
+    def find_serial_number(self):
+        try:
+            return self.get_serial_number()
+        except SystemExit:
+            return None
+
+
+def image_filetype(filename, filetype="autodetect"):
+    if filetype != "autodetect":
+        return filetype
+    if filename.endswith('hex'):
+        return "ihex"
+    if os.path.splitext(filename)[1] in srec_extensions:
+        return "srec"
+    if filename.endswith('.elf') or \
+            open(filename, "rb").read(4) == b"\x7fELF":
+        return "elf"
+    return "bin"
+
+
+# the entry point of an image file, None when the file format has none
+def image_entry(filename, filetype="autodetect"):
+    filetype = image_filetype(filename, filetype)
+
+    if filetype == "ihex":
+        return ihex.ihex(filename).start_addr
+    elif filetype == "srec":
+        return srec.srec(filename).start_addr
+    elif filetype == "elf":
+        return elf.elf(filename).start_addr
+    return None
+
+
+# load an image file and return it as a list of (address, data) segments.
+# flash_addr_base is the address of binary images, hex files carry their
+# own addresses.
+def load_image(filename, filetype="autodetect", flash_addr_base=0):
+    filetype = image_filetype(filename, filetype)
+
+    if filetype == "ihex":
+        ih = ihex.ihex(filename)
+        return ih.segments()
+    elif filetype == "srec":
+        return srec.srec(filename).segments()
+    elif filetype == "elf":
+        return elf.elf(filename).segments()
+    else:
+        image = open(filename, "rb").read()
+        return [(flash_addr_base, image)]
+
+
+# write a list of (address, data) segments to a file. Binary files start
+# at base and leave holes where there is no data.
+def save_image(filename, segments, filetype="autodetect", base=0):
+    if filetype == "autodetect":
+        if filename.endswith('hex'):
+            filetype = "ihex"
+        elif os.path.splitext(filename)[1] in srec_extensions:
+            filetype = "srec"
+        else:
+            filetype = "bin"
+
+    if filetype == "ihex":
+        ihex.write(filename, segments)
+    elif filetype == "srec":
+        srec.write(filename, segments)
+    elif filetype == "bin":
+        fd = open(filename, "wb")
+        end = 0
+        for (addr, data) in segments:
+            fd.seek(addr - base)
+            fd.write(data)
+            end = addr - base + len(data)
+        fd.truncate(end)
+        fd.close()
+    else:
+        panic("Cannot write %s files" % filetype)
+
+
+# load all images listed in a manifest and return their data as one list
+# of (address, data) segments. The manifest is a JSON file, or a TOML file
+# when the name ends in .toml, with a list of images:
+#
+#   { "images": [ { "file": "boot.hex" },
+#                 { "file": "app.bin", "addr": "0x8000" },
+#                 { "file": "config.bin", "addr": 491520, "format": "bin" } ] }
+#
+# addr is the address of binary images, format is ihex, srec, bin or elf
+# and is guessed from the file name when left out. File names are
+# relative to the manifest.
+def load_manifest(filename):
+    if filename.endswith(".toml"):
+        try:
+            import tomllib
+        except ImportError:
+            panic("Reading TOML manifests needs python 3.11 or later")
+        manifest = tomllib.load(open(filename, "rb"))
+    else:
+        import json
+        manifest = json.load(open(filename, "r"))
+
+    images = manifest.get("images")
+    if not images:
+        panic("No images in manifest %s" % filename)
+
+    segments = []
+    for entry in images:
+        if "file" not in entry:
+            panic("Manifest entry without file name in %s" % filename)
+        addr = entry.get("addr", 0)
+        if isinstance(addr, str):
+            addr = int(addr, 0)
+        filetype = entry.get("format", "autodetect")
+        if filetype not in ("autodetect", "ihex", "srec", "bin", "elf"):
+            panic("Invalid format for %s: %s" % (entry["file"], filetype))
+        path = os.path.join(os.path.dirname(filename), entry["file"])
+        for (seg_addr, data) in load_image(path, filetype, addr):
+            segments.append((seg_addr, data, entry["file"]))
+
+    segments.sort(key=lambda x: x[0])
+    for i in range(1, len(segments)):
+        (prev_addr, prev_data, prev_file) = segments[i - 1]
+        (seg_addr, data, seg_file) = segments[i]
+        if seg_addr < prev_addr + len(prev_data):
+            panic("%s overlaps %s at 0x%x" % (seg_file, prev_file, seg_addr))
+
+    return [(seg_addr, data) for (seg_addr, data, seg_file) in segments]
+
+
+# unit data given as <addr>:<hex>, returns (addr, data)
+def parse_unit_data(arg):
+    try:
+        (addr, data) = arg.split(':', 1)
+        return (int(addr, 0), binascii.unhexlify(data))
+    except (ValueError, TypeError, binascii.Error):
+        panic("Invalid unit data: %s" % arg)
+
+
+# read a units file, the unit data of one board per line as <addr>:<hex>
+# items separated by spaces. Empty lines and lines starting with # are
+# ignored.
+def load_units(filename):
+    units = []
+    for line in open(filename, "r"):
+        items = line.split('#')[0].split()
+        if items:
+            units.append([parse_unit_data(item) for item in items])
+    if not units:
+        panic("No units in %s" % filename)
+    return units
+
+
+class PatchError(Exception):
+    pass
+
+
+class BatchError(Exception):
+    pass
+
+
+# run the steps of a batch script against one session, one step per line:
+#
+#   read-serial
+#   read-range <address> <length> <file>
+#   blank-check
+#   program-image <file> [<address>]
+#   verify <file> [<address>]
+#   patch <file> <address>
+#   start [<address>]
+#
+# Addresses are only needed for binary files, start defaults to the start
+# of the flash. Empty lines and lines starting with # are skipped. The
+# result of every step is written to out as a line of JSON. The script
+# stops at the first step that fails, returns True when all succeeded.
+def run_batch(prog, fd, out, filetype="autodetect"):
+    import json
+    import shlex
+    global panic
+
+    def addr_arg(args, i, default=0):
+        return int(args[i], 0) if len(args) > i else default
+
+    def raise_error(str):
+        raise BatchError(str)
+
+    step = 0
+    for line in fd:
+        args = shlex.split(line, comments=True)
+        if not args:
+            continue
+        step += 1
+        op = args.pop(0)
+        result = { "step": step, "op": op, "args": args, "result": "ok" }
+        start_time = time.time()
+
+        old_panic = panic
+        panic = raise_error
+        try:
+            if op == "read-serial":
+                result["serial"] = prog.get_serial_number()
+            elif op == "read-range":
+                if len(args) != 3:
+                    panic("read-range needs an address, length and file")
+                fd_out = open(args[2], "wb")
+                prog.read_block(int(args[0], 0), int(args[1], 0), fd_out)
+                fd_out.close()
+            elif op == "blank-check":
+                not_blank = []
+                for bank in range(0, prog.flash_bank_count()):
+                    for sector in range(0, prog.flash_sector_count()):
+                        if not prog.sector_blank(sector, bank, True):
+                            not_blank.append([bank, sector])
+                result["not_blank"] = not_blank
+                if not_blank:
+                    result["result"] = "failed"
+            elif op in ("program-image", "verify", "patch"):
+                if not args:
+                    panic("%s needs a file" % op)
+                segments = load_image(args[0], filetype, addr_arg(args, 1))
+                if op == "program-image":
+                    success = prog.prog_segments(segments)
+                elif op == "verify":
+                    success = prog.verify_segments(segments)
+                    result["mismatches"] = [["0x%x" % a, n]
+                            for (a, n) in prog.mismatches]
+                else:
+                    success = prog.patch_segments(segments)
+                if not success:
+                    result["result"] = "failed"
+            elif op == "start":
+                prog.start(addr_arg(args, 0, prog.flash_bank_base(0)))
+            else:
+                panic("Unknown batch operation %s" % op)
+        except Exception as e:
+            # a BatchError from panic, bad files or arguments
+            result["result"] = "error"
+            result["error"] = str(e)
+        finally:
+            panic = old_panic
+
+        result["seconds"] = round(time.time() - start_time, 3)
+        out.write(json.dumps(result) + "\n")
+        out.flush()
+        if result["result"] != "ok":
+            return False
+
+    return True
+
+
+# default serial ports searched by --scan
+scan_ports_default = ("/dev/serial/by-id/*", "/dev/ttyUSB*", "/dev/ttyACM*")
+
+# look for a device in isp mode on a serial port, returns a dict with the
+# port and either the cpu, device id and serial number or an error
+def scan_port(port, baud, osc_freq, timeout=.1, control=False):
+    entry = { "port": port }
+    device = None
+    try:
+        device = SerialDevice(port, baud, control=control, timeout=timeout)
+        prog = nxpprog("autodetect", device, baud, osc_freq, connect=False)
+        prog.sync(osc_freq)
+        devid = prog.get_devid()
+        entry["devid"] = format_devid(devid)
+        entry["cpu"] = cpu_from_devid(devid)
+        entry["serial"] = prog.find_serial_number()
+    except SystemExit:
+        entry["error"] = "no device in isp mode"
+    except Exception as e:
+        entry["error"] = str(e)
+    if device:
+        device.close()
+    return entry
+
+
+# probe all ports matching the glob patterns at the same time, returns a
+# list of scan_port results
+def scan(patterns, baud, osc_freq, timeout=.1, control=False):
+    import glob
+    import threading
+
+    ports = []
+    for pattern in patterns:
+        for port in sorted(glob.glob(pattern)):
+            # by-id links and the devices they point to are the same port
+            if os.path.realpath(port) not in \
+                    [os.path.realpath(p) for p in ports]:
+                ports.append(port)
+
+    results = {}
+    def probe(port):
+        results[port] = scan_port(port, baud, osc_freq, timeout, control)
+
+    threads = []
+    for port in ports:
+        thread = threading.Thread(target=probe, args=(port,))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    return [results[port] for port in ports]
+
 
 def main(argv=None):
     if argv is None:
@@ -1190,12 +2979,41 @@ def main(argv=None):
     udp = False
     port = -1
     mac = "" # "0C-1D-12-E0-1F-10"
+    plan = False
+    turnaround = 2 # ms
+    capture = None
+    replay = False
+    replay_timing = False
+    pipeline = False
+    manifest = None
+    stats_db = None
+    adaptive = False
+    scan_mode = False
+    ram = False
+    fleet = None
+    dump = None
+    low_latency = False
+    patch = False
+    backup = None
+    batch = None
+    inject = []
+    station = False
+    watch = []
+    units = None
+    calibrate = False
+    profiles = None
+    use_profile = True
 
     optlist, args = getopt.getopt(argv[1:], '',
             ['cpu=', 'oscfreq=', 'baud=', 'addr=', 'start=',
                 'filetype=', 'bank=', 'read=', 'len=', 'serialnumber',
                 'udp', 'port=', 'mac=', 'verify', 'verifyonly', 'blankcheck',
-                'xonxoff', 'eraseall', 'eraseonly', 'list', 'control'])
+                'xonxoff', 'eraseall', 'eraseonly', 'list', 'control',
+                'plan', 'turnaround=', 'capture=', 'replay', 'replaytiming',
+                'pipeline', 'manifest=', 'stats=', 'report=', 'adaptive',
+                'scan', 'ram', 'fleet=', 'dump=', 'lowlatency', 'patch',
+                'batch=', 'calibrate', 'profiles=', 'noprofile', 'inject=',
+                'station', 'watch=', 'units=', 'backup='])
 
     for o, a in optlist:
         if o == "--list":
@@ -1229,7 +3047,7 @@ def main(argv=None):
             control = True
         elif o == "--filetype":
             filetype = a
-            if not ( filetype == "bin" or filetype == "ihex" ):
+            if filetype not in ("bin", "ihex", "srec", "elf"):
                 panic("Invalid filetype: %s" % filetype)
         elif o == "--start":
             start = True
@@ -1253,15 +3071,133 @@ def main(argv=None):
             port = int(a)
         elif o == "--mac":
             mac = a
+        elif o == "--plan":
+            plan = True
+        elif o == "--turnaround":
+            turnaround = float(a)
+        elif o == "--capture":
+            capture = a
+        elif o == "--pipeline":
+            pipeline = True
+        elif o == "--manifest":
+            manifest = a
+        elif o == "--stats":
+            stats_db = a
+        elif o == "--adaptive":
+            adaptive = True
+        elif o == "--scan":
+            scan_mode = True
+        elif o == "--ram":
+            ram = True
+        elif o == "--fleet":
+            fleet = a
+        elif o == "--dump":
+            dump = a
+        elif o == "--lowlatency":
+            low_latency = True
+        elif o == "--patch":
+            patch = True
+        elif o == "--backup":
+            backup = a
+        elif o == "--batch":
+            batch = a
+        elif o == "--inject":
+            inject.append(parse_unit_data(a))
+        elif o == "--units":
+            units = a
+        elif o == "--station":
+            station = True
+        elif o == "--watch":
+            watch.append(a)
+        elif o == "--calibrate":
+            calibrate = True
+        elif o == "--profiles":
+            profiles = a
+        elif o == "--noprofile":
+            use_profile = False
+        elif o == "--report":
+            import nxpstats
+            nxpstats.report(a, sys.stdout)
+            sys.exit(0)
+        elif o == "--replay":
+            replay = True
+        elif o == "--replaytiming":
+            replay = True
+            replay_timing = True
         else:
             panic("Unhandled option: %s" % o)
 
-    if cpu != "autodetect" and not cpu_parms.has_key(cpu):
+    if cpu != "autodetect" and cpu not in cpu_parms:
         panic("Unsupported cpu %s" % cpu)
 
-    if len(args) == 0:
+    if scan_mode:
+        import json
+
+        inventory = scan(args or scan_ports_default, baud, osc_freq,
+                control=control)
+        json.dump(inventory, sys.stdout, indent=1)
+        sys.stdout.write("\n")
+        return 0
+
+    if len(args) == 0 and not ((plan or fleet or station) and manifest):
         syntax()
 
+    if plan:
+        import json
+        import ispsim
+
+        if cpu == "autodetect":
+            panic("--plan needs the cpu type set with --cpu")
+        if manifest:
+            segments = load_manifest(manifest)
+        else:
+            segments = load_image(args[-1], filetype, flash_addr_base)
+        report = ispsim.plan(cpu, segments, baud, osc_freq, udp, erase_all,
+                verify, model={ "turnaround": turnaround / 1000.0 },
+                pipeline=pipeline)
+        json.dump(report, sys.stdout, indent=1)
+        sys.stdout.write("\n")
+        return 0
+
+    if fleet:
+        import json
+        import udpfleet
+
+        if manifest:
+            segments = load_manifest(manifest)
+        else:
+            if len(args) != 1:
+                syntax()
+            segments = load_image(args[0], filetype, flash_addr_base)
+        targets = udpfleet.UdpFleet(segments, cpu, osc_freq,
+                port if port >= 0 else 41825, erase_all, verify)
+        for (ip, target_port) in udpfleet.load_fleet(fleet):
+            targets.add(ip, target_port)
+        results = targets.run()
+        targets.close()
+        json.dump(results, sys.stdout, indent=1)
+        sys.stdout.write("\n")
+        failed = [r for r in results if r["result"] != "ok"]
+        return 1 if failed else 0
+
+    if units and not station:
+        panic("--units needs --station")
+
+    if station:
+        import nxpstation
+
+        if manifest:
+            segments = load_manifest(manifest)
+        else:
+            if len(args) != 1:
+                syntax()
+            segments = load_image(args[0], filetype, flash_addr_base)
+        board_station = nxpstation.Station(segments,
+                watch or nxpstation.watch_default, cpu, baud, osc_freq,
+                xonxoff, erase_all, units=load_units(units) if units else None)
+        (ok, failed) = board_station.run()
+        return 1 if failed else 0
+
     device = args[0]
 
     if udp:
@@ -1293,56 +3229,235 @@ def main(argv=None):
     else:
         log("cpu=%s oscfreq=%d device=%s baud=%d" % (cpu, osc_freq, device, baud))
 
-    prog = nxpprog(cpu, device, baud, osc_freq, xonxoff, control, (device, port, mac) if udp else None, verify)
-
-    if erase_only:
-        prog.erase_all(verify)
-    elif blank_check:
-        prog.blank_check_all()
-    elif start:
-        prog.start(startaddr)
-    elif select_bank:
-        prog.select_bank(bank)
-    elif get_serial_number:
-        sn = prog.get_serial_number()
-        sys.stdout.write(sn)
-    elif read:
-        if not readlen:
-            panic("Read length is 0")
-        fd = open(readfile, "w")
-        prog.read_block(flash_addr_base, readlen, fd)
-        fd.close()
-    else:
-        if len(args) != 2:
-            syntax()
-
-        filename = args[1]
-
-        if filetype == "autodetect":
-            filetype = "ihex" if filename.endswith('hex') else "bin"
+    port_name = device if not udp else "%s:%d" % (device, port)
+
+    if replay:
+        log("Replaying %s" % device)
+        device = ReplayDevice(device, replay_timing)
+        udp = False
+
+    # statistics of this session for --stats
+    session = {
+        "port": port_name,
+        "cpu": cpu,
+        "baud": baud if not udp else None,
+        "udp": udp,
+        "result": "error",
+        "bytes": 0,
+    }
+    phases = {}
+    prog = None
+    session_start = time.time()
+
+    try:
+        start_time = time.time()
+        prog = nxpprog(cpu, device, baud, osc_freq, xonxoff, control, (device, port, mac) if udp else None, verify, capture)
+        prog.pipeline = pipeline
+        # xon and xoff characters in binary data would be taken for flow
+        # control
+        if xonxoff and prog.binary_transfer() and \
+                hasattr(prog.device, "set_xonxoff"):
+            log("Disabling xonxoff for the binary transfers of %s" %
+                    prog.cpu)
+            prog.device.set_xonxoff(False)
+        if adaptive:
+            prog.link = LinkController(prog, None if udp else baud)
+        phases["sync"] = time.time() - start_time
+        if low_latency:
+            if not hasattr(prog.device, "set_low_latency"):
+                log("Low latency mode needs a serial device")
+            else:
+                before = prog.command_rtt()
+                if prog.device.set_low_latency():
+                    after = prog.command_rtt()
+                    log("Command round trip %.1f ms, %.1f ms in low "
+                            "latency mode" % (before * 1000, after * 1000))
+        if (calibrate or use_profile) and not udp and not replay:
+            import nxpcalib
+
+            if not profiles:
+                profiles = nxpcalib.profiles_default
+            adapter = nxpcalib.adapter_id(port_name)
+            if calibrate:
+                try:
+                    profile = nxpcalib.calibrate(prog, baud)
+                except nxpcalib.CalibrationError as e:
+                    panic("Calibration failed: %s" % e)
+                session["operation"] = "calibrate"
+                session["result"] = "ok"
+                nxpcalib.save_profile(profiles, adapter, prog.cpu, profile)
+                log("Saved the profile of %s with %s to %s: baud %d, "
+                        "%d bytes/s" % (adapter, prog.cpu, profiles,
+                            profile["baud"], profile["goodput"]))
+                return 0
+
+            profile = nxpcalib.lookup(profiles, adapter, prog.cpu)
+            if profile:
+                # the options given take precedence
+                given = [o for (o, a) in optlist]
+                keep = [name for (name, option) in (("baud", "--baud"),
+                    ("xonxoff", "--xonxoff"), ("low_latency", "--lowlatency"),
+                    ("pipeline", "--pipeline")) if option in given]
+                if prog.link:
+                    keep.append("block_size")
+                settings = nxpcalib.use_profile(prog, baud, profile, keep)
+                log("Using the profile of %s with %s: baud %d, "
+                        "block size %d%s%s%s" % (adapter, prog.cpu,
+                            settings["baud"], settings["block_size"],
+                            ", low latency" if settings["low_latency"] else "",
+                            ", xonxoff" if settings["xonxoff"] else "",
+                            ", pipelining" if settings["pipeline"] else ""))
+                baud = settings["baud"]
+                session["baud"] = baud
+                if prog.link:
+                    prog.link.baud = baud
+
+        session["cpu"] = prog.cpu
+        session["devid"] = prog.devid
+        if stats_db and not get_serial_number:
+            # the statistics do without it on parts that have no N command
+            session["serial"] = prog.find_serial_number()
 
-        if filetype == "ihex":
-            ih = ihex.ihex(filename)
-            (flash_addr_base, image) = ih.flatten()
+        success = True
+        if ram:
+            if len(args) != 2:
+                syntax()
+            segments = load_image(args[1], filetype, flash_addr_base)
+            session["operation"] = "ram"
+            session["bytes"] = sum([len(data) for (addr, data) in segments])
+
+            if not start:
+                startaddr = image_entry(args[1], filetype)
+            if startaddr is None:
+                (startaddr, data) = segments[0]
+                if prog.get_cpu_parm("cpu_type", "arm") == "thumb" and \
+                        len(data) >= 8:
+                    # cortex-m images start with the vector table
+                    startaddr = struct.unpack("<I", data[4:8])[0]
+
+            start_time = time.time()
+            prog.load_ram(segments)
+            phases["ram"] = time.time() - start_time
+            log("Starting image in ram at 0x%x" % startaddr)
+            prog.start(startaddr)
+        elif batch:
+            session["operation"] = "batch"
+            fd = sys.stdin if batch == "-" else open(batch, "r")
+            success = run_batch(prog, fd, sys.stdout, filetype)
+        elif erase_only:
+            session["operation"] = "erase"
+            prog.erase_all(verify)
+        elif blank_check:
+            session["operation"] = "blankcheck"
+            prog.blank_check_all()
+        elif start:
+            session["operation"] = "start"
+            prog.start(startaddr)
+        elif select_bank and len(args) == 1:
+            session["operation"] = "bank"
+            prog.select_bank(bank)
+        elif get_serial_number:
+            session["operation"] = "serialnumber"
+            sn = prog.get_serial_number()
+            session["serial"] = sn
+            sys.stdout.write(sn)
+        elif dump:
+            session["operation"] = "dump"
+            start_time = time.time()
+            segments = prog.dump_flash()
+            phases["dump"] = time.time() - start_time
+            session["bytes"] = sum([len(data) for (addr, data) in segments])
+            save_image(dump, segments, filetype,
+                    prog.flash_bank_base(0))
+        elif read:
+            if not readlen:
+                panic("Read length is 0")
+            session["operation"] = "read"
+            session["bytes"] = readlen
+            start_time = time.time()
+            fd = open(readfile, "wb")
+            prog.read_block(flash_addr_base, readlen, fd)
+            fd.close()
+            phases["read"] = time.time() - start_time
+        elif patch:
+            if len(args) != 2:
+                syntax()
+            segments = load_image(args[1], filetype, flash_addr_base)
+            session["operation"] = "patch"
+            session["bytes"] = sum([len(data) for (addr, data) in segments])
+            start_time = time.time()
+            success = prog.patch_segments(segments, backup)
+            elapsed = time.time() - start_time
+            phases["patch"] = elapsed
+            log("Patched %s in %.1f seconds" % ("successfully" if success else "with errors", elapsed))
         else:
-            image = open(filename, "rb").read()
-
-        if not verify_only:
-            start = time.time()
-            success = prog.prog_image(image, flash_addr_base, erase_all, verify)
-            stop = time.time()
-            elapsed = stop - start
-            log("Programmed %s in %.1f seconds" % ("successfully" if success else "with errors", elapsed))
+            if manifest:
+                if len(args) != 1:
+                    syntax()
+                segments = load_manifest(manifest)
+            else:
+                if len(args) != 2:
+                    syntax()
+                segments = load_image(args[1], filetype, flash_addr_base)
+            flash_addr_base = segments[0][0]
+            session["operation"] = "verify" if verify_only else "program"
+            session["bytes"] = sum([len(data) for (addr, data) in segments])
+
+            prepared = None
+            if inject:
+                prepared = PreparedImage(prog, segments).personalize(inject)
+                segments = prepared.segments()
+
+            if not verify_only:
+                start_time = time.time()
+                if prepared:
+                    success = prog.prog_prepared(prepared, erase_all, verify)
+                else:
+                    success = prog.prog_segments(segments, erase_all, verify)
+                elapsed = time.time() - start_time
+                phases["program"] = elapsed
+                log("Programmed %s in %.1f seconds" % ("successfully" if success else "with errors", elapsed))
 
-        if verify:
-            start = time.time()
-            success = prog.verify_image(flash_addr_base, image)
-            stop = time.time()
-            elapsed = stop - start
-            log("Verified %s in %.1f seconds" % ("successfully" if success else "with errors", elapsed))
-
-        if not verify_only:
-            prog.start(flash_addr_base)
+            if verify:
+                start_time = time.time()
+                if not prog.verify_segments(segments):
+                    success = False
+                elapsed = time.time() - start_time
+                phases["verify"] = elapsed
+                log("Verified %s in %.1f seconds" % ("successfully" if success else "with errors", elapsed))
+
+            if not verify_only:
+                start_time = time.time()
+                if select_bank:
+                    # boot from the selected bank
+                    prog.select_bank(bank)
+                    flash_addr_base = prog.flash_bank_base(bank)
+                prog.start(flash_addr_base)
+                phases["start"] = time.time() - start_time
+
+        if prog.link:
+            report = prog.link.report()
+            log("Link: %d bytes in %.1f seconds, goodput %d bytes/s, "
+                    "%d resends, %d timeouts" % (report["payload_bytes"],
+                        report["seconds"], report["goodput"],
+                        report["resends"], report["timeouts"]))
+
+        session["result"] = "ok" if success else "failed"
+    finally:
+        # send what is still buffered, such as the last OK of a read
+        if prog and hasattr(prog.device, "flush"):
+            prog.device.flush()
+        if stats_db:
+            import nxpstats
+
+            session["started"] = session_start
+            session["duration"] = time.time() - session_start
+            if prog:
+                for key in nxpstats.counter_columns:
+                    session[key] = prog.counters[key]
+            nxpstats.record(stats_db, session, phases)
+
+    return 0 if success else 1
 
 
 if __name__ == '__main__':
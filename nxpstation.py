@@ -0,0 +1,259 @@
+#!/usr/bin/python3
+#
+# Hot-plug programming station.
+#
+# nxpprog.py --station image.hex watches the serial ports matching --watch
+# (default /dev/serial/by-id/*) and programs every board as soon as its
+# port shows up: reset into isp mode with the control lines, sync, program,
+# verify and start. Each board gets its own process so a board is loaded
+# while others are still being programmed, a process rather than a thread
+# as a session changes the module globals of nxpprog. With --cpu the image
+# is prepared once before any board shows up and every session inherits
+# it, otherwise each session prepares it. A board that is done is left alone
+# until its port goes away, the next board on that port is programmed
+# again. The state of every board is logged as it changes and the result
+# of each board is printed as a line of JSON.
+#
+# With --units every board gets the unit data of the next line of the
+# units file patched into the prepared image, only the transfer blocks
+# under it are encoded again. The unit of a board that failed is handed to
+# the next board, boards showing up when all units are used are skipped.
+
+import glob
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import time
+
+import nxpprog
+
+watch_default = ("/dev/serial/by-id/*",)
+
+
+class StationBoard(object):
+    def __init__(self, port):
+        self.port = port
+        self.name = os.path.basename(port)
+        # waiting, sync, program, start, done, failed or skipped
+        self.state = "waiting"
+        self.appeared = time.time()
+        self.process = None
+        # set once the result of its session has been collected
+        self.reported = False
+        # the number and data of its unit with units
+        self.unit = None
+
+
+class Station(object):
+    def __init__(self, segments, patterns=watch_default, cpu="autodetect",
+            baud=115200, osc_freq=16000, xonxoff=False, erase_all=False,
+            verify=True, start=True, settle=.5, poll=.2, out=sys.stdout,
+            units=None):
+        self.segments = segments
+        self.patterns = patterns
+        self.cpu = cpu
+        self.baud = baud
+        self.osc_freq = osc_freq
+        self.xonxoff = xonxoff
+        self.erase_all = erase_all
+        self.verify = verify
+        self.start = start
+        # seconds a new port is left to settle before it is opened
+        self.settle = settle
+        self.poll = poll
+        self.out = out
+
+        self.running = True
+        # boards by the device their port points to
+        self.boards = {}
+        # sessions are forked so they inherit the prepared image
+        self.context = multiprocessing.get_context("fork")
+        # the results of the sessions as (device, result)
+        self.results = self.context.Queue()
+        self.counts = { "ok": 0, "failed": 0 }
+
+        # the units not handed out yet as (number, unit data), and those
+        # of the boards in progress by number
+        self.use_units = units is not None
+        self.units = [(i + 1, unit) for (i, unit) in enumerate(units or [])]
+        self.assigned = {}
+
+        self.prepared = None
+        if cpu != "autodetect":
+            prog = nxpprog.nxpprog(cpu, None, baud, osc_freq, connect=False)
+            prog.init_banks()
+            self.prepared = nxpprog.PreparedImage(prog, segments)
+            # unit data outside the image would fail every board
+            for unit in units or []:
+                self.prepared.personalize(unit)
+
+    def stop(self):
+        self.running = False
+
+    # the ports present now by the device they point to
+    def ports(self):
+        ports = {}
+        for pattern in self.patterns:
+            for port in sorted(glob.glob(pattern)):
+                ports.setdefault(os.path.realpath(port), port)
+        return ports
+
+    def status(self, board, state, detail=""):
+        board.state = state
+        nxpprog.log("%s: %s%s" % (board.name, state,
+            " (%s)" % detail if detail else ""))
+
+    # one programming session, run in the process of the board
+    def program(self, path, board):
+        # stopping the station lets the boards being programmed finish
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        started = time.time()
+        result = { "port": board.port, "result": "failed" }
+        if board.unit:
+            result["unit"] = board.unit[0]
+        device = None
+        try:
+            self.status(board, "sync")
+            device = nxpprog.SerialDevice(board.port, self.baud, self.xonxoff,
+                    control=True)
+            prog = nxpprog.nxpprog(self.cpu, device, self.baud,
+                    self.osc_freq)
+            result["cpu"] = prog.cpu
+            # xon and xoff characters in binary data would be taken for
+            # flow control
+            if self.xonxoff and prog.binary_transfer():
+                device.set_xonxoff(False)
+
+            self.status(board, "program", prog.cpu)
+            prepared = self.prepared
+            if prepared is None:
+                prepared = nxpprog.PreparedImage(prog, self.segments)
+            if board.unit:
+                prepared = prepared.personalize(board.unit[1])
+            # with verify every block is compared with M as it is written,
+            # reading the flash back afterwards would only repeat that
+            success = prog.prog_prepared(prepared, self.erase_all,
+                    self.verify)
+
+            if success and self.start:
+                self.status(board, "start")
+                prog.start(self.segments[0][0])
+
+            if success:
+                result["result"] = "ok"
+        except SystemExit:
+            # the reason has been logged by panic already
+            result["error"] = "session failed"
+        except Exception as e:
+            result["error"] = str(e)
+        finally:
+            if device:
+                try:
+                    device.close()
+                except Exception:
+                    pass
+
+        result["seconds"] = round(time.time() - started, 3)
+        self.results.put((path, result))
+
+    # a board is finished with once the result of its session is in, or
+    # collect reported its process dead without one. Until then a result
+    # may still be on its way and must not be taken for that of the next
+    # board on the port.
+    def finished(self, board):
+        return board.process is None or board.reported
+
+    # give board the next unit, False when all are used
+    def hand_out(self, board):
+        if not self.units:
+            return False
+        board.unit = self.units.pop(0)
+        self.assigned[board.unit[0]] = board.unit[1]
+        return True
+
+    # report the results of finished sessions, and sessions whose process
+    # died without posting one as failed
+    def collect(self):
+        while True:
+            try:
+                (path, result) = self.results.get_nowait()
+            except queue.Empty:
+                break
+            self.report(path, result)
+
+        for (path, board) in list(self.boards.items()):
+            process = board.process
+            if board.reported or process is None or process.is_alive() or \
+                    process.exitcode == 0:
+                continue
+            result = { "port": board.port, "result": "failed",
+                    "error": "session died with exit code %d" %
+                        process.exitcode, "seconds": 0 }
+            if board.unit:
+                result["unit"] = board.unit[0]
+            self.report(path, result)
+
+    def report(self, path, result):
+        self.counts[result["result"]] += 1
+        if "unit" in result:
+            unit = self.assigned.pop(result["unit"])
+            if result["result"] != "ok":
+                # the next board gets it
+                self.units.insert(0, (result["unit"], unit))
+        self.out.write(json.dumps(result) + "\n")
+        self.out.flush()
+        board = self.boards.get(path)
+        if board:
+            board.reported = True
+            self.status(board, "done" if result["result"] == "ok"
+                    else "failed", "%.1f seconds" % result["seconds"])
+
+    # watch the ports until stopped or interrupted, returns the number of
+    # boards programmed successfully and of those that failed
+    def run(self):
+        nxpprog.log("Station: watching %s" % ", ".join(self.patterns))
+        try:
+            while self.running:
+                present = self.ports()
+                now = time.time()
+
+                for (path, port) in present.items():
+                    board = self.boards.get(path)
+                    if board is None:
+                        board = StationBoard(port)
+                        self.boards[path] = board
+                        self.status(board, "waiting", "new port")
+                    elif board.process is None and \
+                            board.state == "waiting" and \
+                            now - board.appeared >= self.settle:
+                        if self.use_units and not self.hand_out(board):
+                            self.status(board, "skipped", "no unit data left")
+                            continue
+                        board.process = self.context.Process(
+                                target=self.program, args=(path, board))
+                        board.process.start()
+
+                self.collect()
+
+                for path in list(self.boards.keys()):
+                    board = self.boards[path]
+                    if path in present or not self.finished(board):
+                        continue
+                    # the next board on this port is programmed again
+                    nxpprog.log("%s: removed" % board.name)
+                    del self.boards[path]
+
+                time.sleep(self.poll)
+        except KeyboardInterrupt:
+            pass
+
+        for board in self.boards.values():
+            if board.process:
+                board.process.join()
+        self.collect()
+        nxpprog.log("Station: %d boards programmed, %d failed" %
+                (self.counts["ok"], self.counts["failed"]))
+        return (self.counts["ok"], self.counts["failed"])
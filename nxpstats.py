@@ -0,0 +1,131 @@
+#!/usr/bin/python3
+#
+# Programming session statistics.
+#
+# nxpprog.py --stats=<db> records every session into a local SQLite
+# database: where and what was programmed, how long each phase took, the
+# throughput and how often the link had to retry, resend or timed out.
+# nxpprog.py --report=<db> summarises the throughput per port and per cpu
+# so slow cables and adapters show up before they fail.
+
+import json
+import sqlite3
+import time
+
+schema = """
+create table if not exists session (
+    id integer primary key,
+    started real,
+    port text,
+    cpu text,
+    devid text,
+    serial text,
+    baud integer,
+    udp integer,
+    operation text,
+    result text,
+    duration real,
+    bytes integer,
+    bytes_per_sec real,
+    tx_bytes integer,
+    rx_bytes integer,
+    retries integer,
+    resends integer,
+    timeouts integer
+);
+create table if not exists phase (
+    session integer references session(id),
+    name text,
+    seconds real
+);
+"""
+
+# session columns filled in from the counters of an nxpprog object
+counter_columns = ("tx_bytes", "rx_bytes", "retries", "resends", "timeouts")
+
+
+def open_db(filename):
+    db = sqlite3.connect(filename)
+    db.executescript(schema)
+    return db
+
+
+# store one session. session is a dict with the session columns, phases
+# a dict of phase name to duration in seconds.
+def record(filename, session, phases):
+    db = open_db(filename)
+
+    session = dict(session)
+    session.setdefault("started", time.time())
+    if session.get("devid") is not None:
+        session["devid"] = json.dumps(session["devid"])
+    if session.get("bytes") and phases.get(session.get("operation")):
+        session["bytes_per_sec"] = \
+                session["bytes"] / phases[session["operation"]]
+
+    columns = sorted(session.keys())
+    cur = db.execute("insert into session (%s) values (%s)" %
+            (", ".join(columns), ", ".join(["?"] * len(columns))),
+            [session[c] for c in columns])
+    for (name, seconds) in phases.items():
+        db.execute("insert into phase (session, name, seconds) "
+                "values (?, ?, ?)", (cur.lastrowid, name, seconds))
+    db.commit()
+    db.close()
+
+
+# nearest rank percentile of a sorted list
+def percentile(values, p):
+    if not values:
+        return None
+    rank = int(round(p / 100.0 * len(values) + 0.5))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+# per key (port or cpu) session count, failure count, link error totals
+# and the p50 and p95 throughput of successful sessions
+def summary(filename, key):
+    db = open_db(filename)
+    rows = db.execute("select %s, result, bytes_per_sec, retries, "
+            "resends, timeouts from session" % key).fetchall()
+    db.close()
+
+    groups = {}
+    for (name, result, rate, retries, resends, timeouts) in rows:
+        group = groups.setdefault(name, { "sessions": 0, "failed": 0,
+            "retries": 0, "resends": 0, "timeouts": 0, "rates": [] })
+        group["sessions"] += 1
+        if result != "ok":
+            group["failed"] += 1
+        elif rate:
+            group["rates"].append(rate)
+        group["retries"] += retries or 0
+        group["resends"] += resends or 0
+        group["timeouts"] += timeouts or 0
+
+    result = []
+    for name in sorted(groups.keys(), key=str):
+        group = groups[name]
+        rates = sorted(group.pop("rates"))
+        group[key] = name
+        group["p50_bytes_per_sec"] = percentile(rates, 50)
+        group["p95_bytes_per_sec"] = percentile(rates, 95)
+        result.append(group)
+    return result
+
+
+def report(filename, fd):
+    for key in ("port", "cpu"):
+        fd.write("%-24s %8s %6s %10s %10s %7s %7s %8s\n" %
+                (key, "sessions", "failed", "p50 B/s", "p95 B/s", "retries",
+                    "resends", "timeouts"))
+        for group in summary(filename, key):
+            fd.write("%-24s %8d %6d %10s %10s %7d %7d %8d\n" %
+                    (group[key], group["sessions"], group["failed"],
+                        "%.0f" % group["p50_bytes_per_sec"]
+                            if group["p50_bytes_per_sec"] else "-",
+                        "%.0f" % group["p95_bytes_per_sec"]
+                            if group["p95_bytes_per_sec"] else "-",
+                        group["retries"], group["resends"],
+                        group["timeouts"]))
+        fd.write("\n")
@@ -0,0 +1,74 @@
+#!/usr/bin/python
+import binascii
+
+from ihex import data_rec, data_segments
+
+# reads and writes Motorola S-record files
+class srec:
+    # address length in bytes of the data and start records
+    DATA_ADDR_LEN = { "S1": 2, "S2": 3, "S3": 4 }
+    START_ADDR_LEN = { "S9": 2, "S8": 3, "S7": 4 }
+
+    def __init__(self, filename):
+        fd = open(filename, "r")
+
+        self.data = []
+
+        self.start_addr = None
+
+        line_no = 0
+        for line in fd:
+            l = line.strip()
+            line_no += 1
+            if not l:
+                continue
+            if l[0] != "S" or len(l) < 4 or len(l) % 2 != 0:
+                raise Exception("invalid record: line %d" % line_no)
+
+            rtype = l[0:2]
+            try:
+                rec = binascii.unhexlify(l[2:])
+            except (binascii.Error, TypeError):
+                raise Exception("invalid hex digits: line %d" % line_no)
+
+            if rec[0] != len(rec) - 1:
+                raise Exception("record length does not match: line %d" %
+                        line_no)
+            if sum(rec) % 0x100 != 0xff:
+                raise Exception("invalid checksum: line %d" % line_no)
+
+            if rtype in self.DATA_ADDR_LEN:
+                n = self.DATA_ADDR_LEN[rtype]
+                addr = int(binascii.hexlify(rec[1:1 + n]), 16)
+                self.data.append(data_rec(addr, bytes(rec[1 + n:-1])))
+            elif rtype in self.START_ADDR_LEN:
+                n = self.START_ADDR_LEN[rtype]
+                self.start_addr = int(binascii.hexlify(rec[1:1 + n]), 16)
+
+    def dump(self):
+        for d in self.data:
+            print(d)
+
+    # return the data as a sorted list of (address, data) tuples, one for
+    # each contiguous run of data
+    def segments(self):
+        return data_segments(self.data, "records")
+
+
+def record(rtype, addr, addr_len, data):
+    rec = bytes([addr_len + len(data) + 1]) + \
+            addr.to_bytes(addr_len, "big") + data
+    csum = 0xff - sum(rec) % 0x100
+    return "%s%s%02X\n" % (rtype, binascii.hexlify(rec).decode().upper(),
+            csum)
+
+
+# write a list of (address, data) segments as S3 records with 32 bit
+# addresses
+def write(filename, segments, start_addr=None, record_size=32):
+    fd = open(filename, "w")
+    for (addr, data) in segments:
+        for i in range(0, len(data), record_size):
+            fd.write(record("S3", addr + i, 4, data[i:i + record_size]))
+    fd.write(record("S7", start_addr or 0, 4, b''))
+    fd.close()
@@ -0,0 +1,96 @@
+# Batch scripts run against the ispsim bootloader, directly and through
+# the --batch option.
+
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import ihex
+import ispsim
+import nxpprog
+
+cpu = "lpc1768"
+
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        self.log = nxpprog.log
+        nxpprog.log = lambda str: None
+        self.dir = tempfile.mkdtemp()
+        self.sim = ispsim.IspSimulator(cpu)
+        self.image = bytes(bytearray(range(256))) * 16
+        self.good = self.path("good.hex")
+        ihex.write(self.good, [(0, self.image)])
+        self.bad = self.path("bad.hex")
+        ihex.write(self.bad, [(0x800, bytes(bytearray(range(255, -1, -1))))])
+
+    def tearDown(self):
+        nxpprog.log = self.log
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    # run the script, returns the result and the step results
+    def run_batch(self, script):
+        prog = nxpprog.nxpprog(cpu, self.sim, 115200, 12000)
+        out = io.StringIO()
+        success = nxpprog.run_batch(prog, io.StringIO(script), out)
+        return (success, [json.loads(l) for l in out.getvalue().splitlines()])
+
+    def test_steps(self):
+        (success, results) = self.run_batch(
+                "# program and check\n"
+                "program-image %s\n"
+                "verify %s\n"
+                "read-range 0x100 16 %s\n" % (self.good, self.good,
+                    self.path("range.bin")))
+        self.assertTrue(success)
+        self.assertEqual([r["result"] for r in results], ["ok"] * 3)
+        self.assertEqual(open(self.path("range.bin"), "rb").read(),
+                self.image[0x100:0x110])
+
+    def test_stops_at_the_first_failure(self):
+        (success, results) = self.run_batch(
+                "program-image %s\n"
+                "verify %s\n"
+                "read-serial\n" % (self.good, self.bad))
+        self.assertFalse(success)
+        self.assertEqual([r["result"] for r in results], ["ok", "failed"])
+        self.assertEqual(results[1]["mismatches"], [["0x800", 256]])
+
+    def test_error_stops_the_batch(self):
+        (success, results) = self.run_batch(
+                "verify %s\n"
+                "read-serial\n" % self.path("missing.hex"))
+        self.assertFalse(success)
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]["result"], "error")
+
+    def test_exit_status(self):
+        serial_device = nxpprog.SerialDevice
+        stdout = sys.stdout
+        nxpprog.SerialDevice = lambda port, *args, **kwargs: self.sim
+        sys.stdout = io.StringIO()
+        try:
+            for (script, status) in (("program-image %s\n" % self.good, 0),
+                    ("verify %s\n" % self.bad, 1)):
+                fd = open(self.path("batch.txt"), "w")
+                fd.write(script)
+                fd.close()
+                self.sim.reset(True)
+                self.assertEqual(nxpprog.main(["nxpprog.py", "--cpu=" + cpu,
+                    "--oscfreq=12000", "--noprofile",
+                    "--batch=" + self.path("batch.txt"), "/dev/ttyUSB0"]),
+                    status)
+        finally:
+            nxpprog.SerialDevice = serial_device
+            sys.stdout = stdout
+
+
+if __name__ == '__main__':
+    unittest.main()
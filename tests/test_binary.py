@@ -0,0 +1,61 @@
+# Sessions on cpus that transfer W and R data in binary, against the ispsim
+# bootloader.
+
+import unittest
+
+import ispsim
+import nxpcalib
+import nxpprog
+
+cpus = ("lpc811", "lpc812", "lpc11u68")
+
+
+class BinaryTest(unittest.TestCase):
+    def setUp(self):
+        self.log = nxpprog.log
+        nxpprog.log = lambda str: None
+        self.image = bytes(bytearray(range(256))) * 16
+
+    def tearDown(self):
+        nxpprog.log = self.log
+
+    def session(self, cpu, pipeline):
+        sim = ispsim.IspSimulator(cpu)
+        prog = nxpprog.nxpprog(cpu, sim, 115200, 12000)
+        prog.pipeline = pipeline
+        self.assertTrue(prog.binary_transfer())
+        return (sim, prog)
+
+    def test_program_read_and_verify(self):
+        for cpu in cpus:
+            for pipeline in (False, True):
+                (sim, prog) = self.session(cpu, pipeline)
+                self.assertTrue(prog.prog_segments([(0, self.image)],
+                    verify=True))
+                self.assertTrue(prog.verify_segments([(0, self.image)]))
+                self.assertEqual(prog.read_block(32, len(self.image) - 32),
+                        self.image[32:])
+                self.assertEqual(sim.mem_read(32, len(self.image) - 32),
+                        self.image[32:])
+
+    def test_rejected_write_sends_no_data(self):
+        for pipeline in (False, True):
+            (sim, prog) = self.session("lpc812", pipeline)
+            self.assertTrue(prog.prog_segments([(0, self.image)]))
+            # data that is a valid command when taken for one
+            data = b'P 0 0\r\nE 0 0\r\n\r\n'
+            self.assertRaises(SystemExit, prog.write_ram_data, 0x10000402,
+                    data)
+            self.assertNotIn("E 0 0", sim.commands)
+            self.assertEqual(sim.mem_read(32, len(self.image) - 32),
+                    self.image[32:])
+
+    def test_no_pipelining_candidate(self):
+        sim = ispsim.IspSimulator("lpc812", echo=False)
+        prog = nxpprog.nxpprog("lpc812", sim, 115200, 12000)
+        self.assertNotIn("pipeline",
+                [name for (name, values) in nxpcalib.candidates(prog, 115200)])
+
+
+if __name__ == '__main__':
+    unittest.main()
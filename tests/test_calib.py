@@ -0,0 +1,118 @@
+# Link calibration profiles and recovery from failed measurements, against
+# the ispsim bootloader.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import ispsim
+import nxpcalib
+import nxpprog
+
+cpu = "lpc1768"
+ram_addr = 0x10000000
+
+
+# loses the write of data number lose, counting writes of more than 100
+# bytes only
+class LosingDevice(object):
+    def __init__(self, device, lose):
+        self._device = device
+        self.lose = lose
+
+    def __getattr__(self, name):
+        return getattr(self._device, name)
+
+    def write(self, data):
+        if len(data) > 100:
+            self.lose -= 1
+            if self.lose == 0:
+                return
+        self._device.write(data)
+
+
+class ProfileTest(unittest.TestCase):
+    def setUp(self):
+        self.log = nxpprog.log
+        nxpprog.log = lambda str: None
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, "profiles.json")
+
+    def tearDown(self):
+        nxpprog.log = self.log
+        shutil.rmtree(self.dir)
+
+    def test_save_and_lookup(self):
+        nxpcalib.save_profile(self.filename, "usb:0403:6001", cpu,
+                { "baud": 230400 })
+        nxpcalib.save_profile(self.filename, "usb:0403:6001", "lpc1114",
+                { "baud": 57600 })
+        self.assertEqual(nxpcalib.lookup(self.filename, "usb:0403:6001", cpu),
+                { "baud": 230400 })
+        self.assertEqual(os.listdir(self.dir), ["profiles.json"])
+
+    def test_corrupt_file_is_ignored(self):
+        for text in ('{"usb:0403:6001/lpc1768": {"baud": 2', '[]', '\xff'):
+            fd = open(self.filename, "w")
+            fd.write(text)
+            fd.close()
+            self.assertEqual(nxpcalib.lookup(self.filename, "usb:0403:6001",
+                cpu), None)
+
+        nxpcalib.save_profile(self.filename, "usb:0403:6001", cpu,
+                { "baud": 230400 })
+        self.assertEqual(nxpcalib.lookup(self.filename, "usb:0403:6001", cpu),
+                { "baud": 230400 })
+
+
+class ResyncTest(unittest.TestCase):
+    def setUp(self):
+        self.log = nxpprog.log
+        self.panic = nxpprog.panic
+        nxpprog.log = lambda str: None
+        self.sim = ispsim.IspSimulator(cpu)
+        self.prog = nxpprog.nxpprog(cpu, self.sim, 115200, 12000)
+
+    def tearDown(self):
+        nxpprog.log = self.log
+        nxpprog.panic = self.panic
+
+    def assertTakesCommands(self):
+        data = os.urandom(256)
+        self.prog.write_ram_data(ram_addr, data)
+        self.assertEqual(self.prog.read_block(ram_addr, len(data)), data)
+
+    def test_inside_write(self):
+        self.prog.isp_command("W %d %d" % (ram_addr, 900))
+        self.prog.dev_write(self.prog.uu_frame(bytes(900))[:200])
+        nxpcalib.resync(self.prog, { "transfer": ("W", 900) })
+        self.assertTakesCommands()
+
+    def test_write_asked_for_again(self):
+        self.prog.isp_command("W %d %d" % (ram_addr, 248))
+        self.prog.dev_write(self.prog.uu_frame(bytes(248))[:-3] + b'9\r\n')
+        self.assertEqual(self.prog.dev_readline(), self.prog.RESEND)
+        nxpcalib.resync(self.prog, { "transfer": ("W", 248) })
+        self.assertTakesCommands()
+
+    def test_inside_read(self):
+        self.prog.isp_command("R %d %d" % (ram_addr, 256))
+        nxpcalib.resync(self.prog, { "transfer": ("R", 256) })
+        self.assertTakesCommands()
+
+    def test_calibrate_goes_on_after_a_failed_measurement(self):
+        messages = []
+        nxpprog.log = messages.append
+        self.prog.device = LosingDevice(self.sim, 12)
+        profile = nxpcalib.calibrate(self.prog, 115200)
+        failed = [m for m in messages if " failed: " in m]
+        self.assertEqual(len(failed), 1)
+        # the candidates after the failed one were measured
+        self.assertIn("block_size 180", messages[-1])
+        self.assertTrue(profile["goodput"] > 0)
+        self.assertTakesCommands()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+# Capturing a session against the ispsim bootloader and replaying it.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import ispsim
+import nxpprog
+
+cpu = "lpc1768"
+
+
+# answers every read with the same data
+class ReadingDevice(object):
+    def write(self, data):
+        pass
+
+    def read(self, size, timeout=None):
+        return b'abcd'
+
+    def readline(self, timeout=None):
+        return "0"
+
+
+class CaptureTest(unittest.TestCase):
+    def setUp(self):
+        self.log = nxpprog.log
+        nxpprog.log = lambda str: None
+        self.dir = tempfile.mkdtemp()
+        self.capture = os.path.join(self.dir, "session.cap")
+        self.image = bytes(bytearray(range(256))) * 16
+
+    def tearDown(self):
+        nxpprog.log = self.log
+        shutil.rmtree(self.dir)
+
+    # program, verify and read back, returns what was read
+    def session(self, prog):
+        self.assertTrue(prog.prog_segments([(0, self.image)], verify=True))
+        self.assertTrue(prog.verify_segments([(0, self.image)]))
+        return prog.read_block(0x100, 256)
+
+    def test_replay(self):
+        prog = nxpprog.nxpprog(cpu, ispsim.IspSimulator(cpu), 115200, 12000,
+                capture=self.capture)
+        captured = self.session(prog)
+        prog.device.close()
+
+        device = nxpprog.ReplayDevice(self.capture)
+        prog = nxpprog.nxpprog(cpu, device, 115200, 12000)
+        self.assertEqual(self.session(prog), captured)
+        device.flush()
+        # the whole capture was played
+        self.assertRaises(SystemExit, device.readline)
+
+    def test_diverged_write(self):
+        prog = nxpprog.nxpprog(cpu, ispsim.IspSimulator(cpu), 115200, 12000,
+                capture=self.capture)
+        prog.read_block(0x100, 256)
+        prog.device.close()
+
+        prog = nxpprog.nxpprog(cpu, nxpprog.ReplayDevice(self.capture),
+                115200, 12000)
+        self.assertRaises(SystemExit, prog.read_block, 0x100, 512)
+
+    def test_diverged_read_size(self):
+        device = nxpprog.CaptureDevice(ReadingDevice(), self.capture)
+        device.read(4)
+        device.read(16)
+        device.close()
+
+        device = nxpprog.ReplayDevice(self.capture)
+        self.assertEqual(device.read(4), b'abcd')
+        self.assertRaises(SystemExit, device.read, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+# Verifying flash with the crc32 of the S command against the ispsim
+# bootloader, reading back only what the crc can't vouch for.
+
+import unittest
+
+import ispsim
+import nxpprog
+
+cpu = "lpc812"
+
+
+# a part that refuses the S command
+class NoCrcSimulator(ispsim.IspSimulator):
+    cmd_S = None
+
+
+class CrcTest(unittest.TestCase):
+    def setUp(self):
+        self.log = nxpprog.log
+        nxpprog.log = lambda str: None
+        self.image = bytes(bytearray(range(256))) * 16
+
+    def tearDown(self):
+        nxpprog.log = self.log
+
+    def programmed(self, sim):
+        prog = nxpprog.nxpprog(cpu, sim, 115200, 12000)
+        self.assertTrue(prog.prog_segments([(0, self.image)]))
+        del sim.commands[:]
+        return prog
+
+    # the commands sent while verifying, by their letter
+    def verify(self, sim, prog):
+        success = prog.verify_segments([(0, self.image)])
+        commands = {}
+        for command in sim.commands:
+            commands.setdefault(command.split()[0], []).append(command)
+        return (success, commands)
+
+    def test_matching_crc_skips_the_readback(self):
+        sim = ispsim.IspSimulator(cpu)
+        prog = self.programmed(sim)
+        (success, commands) = self.verify(sim, prog)
+        self.assertTrue(success)
+        self.assertEqual(len(commands["S"]), len(self.image) // 1024)
+        self.assertNotIn("R", commands)
+
+    def test_corrupted_sector_is_read_back_alone(self):
+        sim = ispsim.IspSimulator(cpu)
+        prog = self.programmed(sim)
+        sim.flash[0][0x900] ^= 0xff
+        (success, commands) = self.verify(sim, prog)
+        self.assertFalse(success)
+        self.assertEqual(commands["R"], ["R 2048 1024"])
+        self.assertEqual(prog.mismatches, [(0x900, 1)])
+
+    def test_refused_crc_reads_everything_back(self):
+        sim = NoCrcSimulator(cpu)
+        prog = self.programmed(sim)
+        (success, commands) = self.verify(sim, prog)
+        self.assertTrue(success)
+        self.assertEqual(len(commands["S"]), 1)
+        self.assertEqual(sum([int(c.split()[2]) for c in commands["R"]]),
+                len(self.image))
+
+
+if __name__ == '__main__':
+    unittest.main()
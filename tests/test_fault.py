@@ -0,0 +1,44 @@
+# Trials of the fault injection harness.
+
+import unittest
+
+import nxpfault
+import nxpprog
+
+
+class FaultTest(unittest.TestCase):
+    def setUp(self):
+        self.log = nxpprog.log
+        self.panic = nxpprog.panic
+        self.read_block = nxpprog.nxpprog.read_block
+        nxpprog.log = lambda str: None
+
+    def tearDown(self):
+        nxpprog.log = self.log
+        nxpprog.panic = self.panic
+        nxpprog.nxpprog.read_block = self.read_block
+
+    def trial(self, operation, rate):
+        image = bytes(bytearray(range(256))) * 8
+        return nxpfault.trial(operation, "lpc1768", image, rate,
+                ["corrupt_byte"], 1, .5, 0, 115200, True)
+
+    def test_clean_trial(self):
+        result = self.trial("read", 0)
+        self.assertTrue(result["completed"])
+        self.assertEqual(result["injected"], 0)
+
+    def test_unexpected_error_fails_the_trial(self):
+        def read_block(prog, addr, data_len, fd=None):
+            raise ValueError("bad checksum line")
+        nxpprog.nxpprog.read_block = read_block
+        result = self.trial("read", 0)
+        self.assertFalse(result["completed"])
+        self.assertEqual(result["error"], "ValueError: bad checksum line")
+        # the next trial runs as usual
+        nxpprog.nxpprog.read_block = self.read_block
+        self.assertTrue(self.trial("read", 0)["completed"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+# Reading image files into (address, data) segments.
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+import elf
+import ihex
+import srec
+
+
+class ImageTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    # a 32 bit little endian ELF file with a PT_LOAD segment for every
+    # (address, data) tuple
+    def write_elf(self, name, loads):
+        phoff = 52
+        offset = phoff + 32 * len(loads)
+        header = b"\x7fELF\x01\x01\x01" + bytes(17) + \
+                struct.pack("<II10xHH6x", 0x1d, phoff, 32, len(loads))
+        phdrs = b''
+        data = b''
+        for (addr, load) in loads:
+            phdrs += struct.pack("<IIIIIIII", 1, offset + len(data), addr,
+                    addr, len(load), len(load), 5, 4)
+            data += load
+        fd = open(self.path(name), "wb")
+        fd.write(header + phdrs + data)
+        fd.close()
+        return self.path(name)
+
+    def test_data_segments(self):
+        records = [ihex.data_rec(0x10, b'\x03\x04'),
+                ihex.data_rec(0x0, b'\x01'), ihex.data_rec(0xe, b'\x02\x02')]
+        self.assertEqual(ihex.data_segments(records),
+                [(0x0, b'\x01'), (0xe, b'\x02\x02\x03\x04')])
+        records.append(ihex.data_rec(0x11, b'\x05'))
+        self.assertRaises(Exception, ihex.data_segments, records)
+
+    def test_ihex(self):
+        segments = [(0x0, os.urandom(100)), (0x1000, os.urandom(40))]
+        ihex.write(self.path("image.hex"), segments)
+        self.assertEqual(ihex.ihex(self.path("image.hex")).segments(),
+                segments)
+
+    def test_ihex_flatten(self):
+        ihex.write(self.path("image.hex"), [(0x10, b'\x01\x02'),
+            (0x14, b'\x03')])
+        self.assertEqual(ihex.ihex(self.path("image.hex")).flatten(),
+                (0x10, b'\x01\x02\xff\xff\x03'))
+
+    def test_srec(self):
+        segments = [(0x0, os.urandom(100)), (0x1000, os.urandom(40))]
+        srec.write(self.path("image.srec"), segments, 0x1d)
+        image = srec.srec(self.path("image.srec"))
+        self.assertEqual(image.segments(), segments)
+        self.assertEqual(image.start_addr, 0x1d)
+
+    def test_elf(self):
+        image = elf.elf(self.write_elf("image.elf",
+            [(0x100, b'\x05\x06'), (0x0, b'\x01\x02'), (0x2, b'\x03\x04')]))
+        self.assertEqual(image.start_addr, 0x1d)
+        self.assertEqual(image.segments(),
+                [(0x0, b'\x01\x02\x03\x04'), (0x100, b'\x05\x06')])
+
+    def test_elf_overlap(self):
+        image = elf.elf(self.write_elf("image.elf",
+            [(0x0, b'\x01\x02'), (0x1, b'\x03\x04')]))
+        self.assertRaises(Exception, image.segments)
+
+
+if __name__ == '__main__':
+    unittest.main()
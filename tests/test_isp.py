@@ -0,0 +1,87 @@
+# ISP commands of an nxpprog session against the ispsim bootloader.
+
+import unittest
+
+import ispsim
+import nxpprog
+
+
+# a part without the N command
+class NoSerialSimulator(ispsim.IspSimulator):
+    cmd_N = None
+
+    def close(self):
+        pass
+
+
+# keeps every write to the simulator
+class RecordingDevice(object):
+    def __init__(self, device):
+        self._device = device
+        self.writes = []
+
+    def __getattr__(self, name):
+        return getattr(self._device, name)
+
+    def write(self, data):
+        self.writes.append(data)
+        self._device.write(data)
+
+
+class IspTest(unittest.TestCase):
+    def setUp(self):
+        self.log = nxpprog.log
+        nxpprog.log = lambda str: None
+
+    def tearDown(self):
+        nxpprog.log = self.log
+
+    def test_serial_number(self):
+        prog = nxpprog.nxpprog("lpc1768", ispsim.IspSimulator("lpc1768"),
+                115200, 12000)
+        self.assertEqual(prog.find_serial_number(),
+                prog.get_serial_number())
+        self.assertEqual(len(prog.find_serial_number().split()), 4)
+
+    def test_no_serial_number(self):
+        sim = NoSerialSimulator("lpc1768")
+        prog = nxpprog.nxpprog("lpc1768", sim, 115200, 12000)
+        self.assertEqual(prog.find_serial_number(), None)
+        self.assertRaises(SystemExit, prog.get_serial_number)
+        # the session goes on
+        self.assertEqual(prog.read_block(0x10000000, 4), sim.mem_read(
+            0x10000000, 4))
+
+    def test_scan_part_without_serial_number(self):
+        serial_device = nxpprog.SerialDevice
+        nxpprog.SerialDevice = lambda port, *args, **kwargs: \
+                NoSerialSimulator("lpc1768")
+        try:
+            entry = nxpprog.scan_port("/dev/ttyUSB0", 115200, 12000)
+        finally:
+            nxpprog.SerialDevice = serial_device
+        self.assertEqual(entry["cpu"], "lpc1768")
+        self.assertEqual(entry["serial"], None)
+        self.assertNotIn("error", entry)
+
+    def test_nothing_is_pipelined_past_copy(self):
+        sim = ispsim.IspSimulator("lpc1768")
+        device = RecordingDevice(sim)
+        prog = nxpprog.nxpprog("lpc1768", device, 115200, 12000)
+        prog.pipeline = True
+        image = bytes(bytearray(range(256))) * 40
+        self.assertTrue(prog.prog_segments([(0, image)], verify=True))
+        self.assertEqual(sim.mem_read(32, len(image) - 32), image[32:])
+
+        commands = [data.split(b'\r\n')[:-1] for data in device.writes]
+        pipelined = [c for c in commands if len(c) > 1]
+        self.assertTrue(pipelined)
+        for c in commands:
+            for cmd in c[:-1]:
+                self.assertNotIn(cmd[:2], (b'C ', b'E '))
+        ram_addr = prog.get_cpu_parm("flash_prog_buffer_base")
+        self.assertIn([("M 0 %d 4096" % ram_addr).encode()], commands)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+# Recovery of damaged R and W transfers, run against the ispsim bootloader.
+
+import os
+import unittest
+
+import ispsim
+import nxpprog
+
+ram_addr = 0x10000000
+
+
+# passes the traffic of a device through, damaging it on the way. Every
+# function in reads is applied to one read of data, in turn, and every
+# function in checksums to one checksum line. A write of data longer than
+# drop_write bytes is lost once. The timeouts of all readlines are kept.
+class DamagingDevice(object):
+    def __init__(self, device):
+        self._device = device
+        self.reads = []
+        self.checksums = []
+        self.drop_write = None
+        self.timeouts = []
+
+    def __getattr__(self, name):
+        return getattr(self._device, name)
+
+    def read(self, size, timeout=None):
+        data = self._device.read(size, timeout)
+        if self.reads:
+            data = self.reads.pop(0)(data)
+        return data
+
+    def readline(self, timeout=None):
+        self.timeouts.append(timeout)
+        line = self._device.readline(timeout)
+        # status lines are single digits
+        if len(line) > 3 and line.isdigit() and self.checksums:
+            line = self.checksums.pop(0)(line)
+        return line
+
+    def write(self, data):
+        if self.drop_write is not None and len(data) > self.drop_write:
+            self.drop_write = None
+            return
+        self._device.write(data)
+
+
+class LinkTest(unittest.TestCase):
+    def setUp(self):
+        self.log = nxpprog.log
+        nxpprog.log = lambda str: None
+
+        self.sim = ispsim.IspSimulator("lpc1768")
+        self.device = DamagingDevice(self.sim)
+        self.prog = nxpprog.nxpprog("lpc1768", self.device, 115200, 12000)
+        self.data = os.urandom(1800)
+        self.sim.ram_write(ram_addr, self.data)
+
+    def tearDown(self):
+        nxpprog.log = self.log
+
+    def adaptive(self):
+        self.prog.link = nxpprog.LinkController(self.prog)
+
+    def test_read(self):
+        self.assertEqual(self.prog.read_block(ram_addr, len(self.data)),
+                self.data)
+        self.assertEqual(self.prog.counters["resends"], 0)
+
+    def test_bad_encoding_is_read_again(self):
+        self.adaptive()
+        self.device.reads.append(lambda data: data[:5] + b'~' + data[6:])
+        self.assertEqual(self.prog.read_block(ram_addr, len(self.data)),
+                self.data)
+        self.assertEqual(self.prog.counters["resends"], 1)
+
+    def test_bad_framing_is_read_again(self):
+        self.adaptive()
+        self.device.reads.append(lambda data: data[:61] + b'AA' + data[63:])
+        self.assertEqual(self.prog.read_block(ram_addr, len(self.data)),
+                self.data)
+        self.assertEqual(self.prog.counters["resends"], 1)
+
+    def test_short_group_is_read_again(self):
+        self.adaptive()
+        self.device.reads.append(lambda data: data[:-10])
+        self.assertEqual(self.prog.read_block(ram_addr, len(self.data)),
+                self.data)
+        self.assertEqual(self.prog.counters["resends"], 1)
+
+    def test_bad_checksum_line_is_read_again(self):
+        self.adaptive()
+        self.device.checksums.append(lambda line: line + "x")
+        self.device.checksums.append(lambda line: "")
+        self.assertEqual(self.prog.read_block(ram_addr, len(self.data)),
+                self.data)
+        self.assertEqual(self.prog.counters["resends"], 2)
+
+    def test_damaged_read_fails_without_link(self):
+        self.device.reads.append(lambda data: data[:5] + b'~' + data[6:])
+        self.assertRaises(SystemExit, self.prog.read_block, ram_addr,
+                len(self.data))
+
+    def test_lost_block_is_written_again(self):
+        self.adaptive()
+        self.device.drop_write = 100
+        data = os.urandom(900)
+        self.prog.write_ram_data(ram_addr, data)
+        self.assertEqual(self.sim.mem_read(ram_addr, len(data)), data)
+        self.assertTrue(self.prog.counters["timeouts"] > 0)
+        self.assertEqual(self.prog.counters["resends"], 1)
+        # only the first wait for the status is a full one
+        waits = [t for t in self.device.timeouts if t is not None]
+        self.assertEqual(len(waits), self.prog.counters["timeouts"])
+        self.assertEqual(set(waits), set([self.prog.csum_resend_timeout]))
+
+
+if __name__ == '__main__':
+    unittest.main()
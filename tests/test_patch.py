@@ -0,0 +1,107 @@
+# Patching data into flash sectors of the ispsim bootloader.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import ihex
+import ispsim
+import nxpprog
+
+cpu = "lpc1768"
+
+
+# a part whose first copies from ram to flash fail
+class FailingCopySimulator(ispsim.IspSimulator):
+    def __init__(self, cpu, failures):
+        ispsim.IspSimulator.__init__(self, cpu)
+        self.failures = failures
+
+    def cmd_C(self, vals):
+        if self.failures > 0:
+            self.failures -= 1
+            self.status(nxpprog.SECTOR_NOT_PREPARED_FOR_WRITE_OPERATION)
+            return
+        ispsim.IspSimulator.cmd_C(self, vals)
+
+
+# spoils the data of every ram write once armed, so no block gets through
+class SpoilingDevice(object):
+    def __init__(self, device):
+        self._device = device
+        self.armed = False
+
+    def __getattr__(self, name):
+        return getattr(self._device, name)
+
+    def write(self, data):
+        if self.armed and len(data) > 100:
+            data = bytearray(data)
+            data[1] = 0x21 if data[1] != 0x21 else 0x22
+            data = bytes(data)
+        self._device.write(data)
+
+
+class PatchTest(unittest.TestCase):
+    def setUp(self):
+        self.log = nxpprog.log
+        nxpprog.log = lambda str: None
+        self.dir = tempfile.mkdtemp()
+        self.backup = os.path.join(self.dir, "backup.hex")
+        self.image = bytes(bytearray(range(256))) * 40
+
+    def tearDown(self):
+        nxpprog.log = self.log
+        shutil.rmtree(self.dir)
+
+    def programmed(self, sim):
+        prog = nxpprog.nxpprog(cpu, sim, 115200, 12000)
+        self.assertTrue(prog.prog_segments([(0, self.image)]))
+        return prog
+
+    def test_failed_write_is_retried(self):
+        sim = FailingCopySimulator(cpu, 0)
+        prog = self.programmed(sim)
+        sim.failures = 1
+        self.assertTrue(prog.patch_segments([(0x1004, b'\x11\x22')],
+            self.backup))
+        self.assertEqual(sim.mem_read(0x1000, 8),
+                self.image[0x1000:0x1004] + b'\x11\x22' +
+                self.image[0x1006:0x1008])
+        self.assertEqual(sim.mem_read(0x1008, 0x1000 - 8),
+                self.image[0x1008:0x2000])
+
+    def test_old_sectors_are_kept_when_the_patch_fails(self):
+        sim = FailingCopySimulator(cpu, 0)
+        prog = self.programmed(sim)
+        sim.failures = 1000
+        self.assertFalse(prog.patch_segments([(0x1004, b'\x11\x22')],
+            self.backup))
+        self.assertEqual(ihex.ihex(self.backup).segments(),
+                [(0x1000, self.image[0x1000:0x2000])])
+
+    def test_old_sectors_are_kept_when_the_ram_write_fails(self):
+        sim = ispsim.IspSimulator(cpu)
+        device = SpoilingDevice(sim)
+        prog = self.programmed(device)
+        device.armed = True
+        self.assertFalse(prog.patch_segments([(0x1004, b'\x11\x22')],
+            self.backup))
+        self.assertEqual(ihex.ihex(self.backup).segments(),
+                [(0x1000, self.image[0x1000:0x2000])])
+
+    def test_backup_that_was_not_asked_for_is_removed(self):
+        sim = ispsim.IspSimulator(cpu)
+        prog = self.programmed(sim)
+        cwd = os.getcwd()
+        os.chdir(self.dir)
+        try:
+            self.assertTrue(prog.patch_segments([(0x1004, b'\x11\x22')]))
+        finally:
+            os.chdir(cwd)
+        self.assertEqual(os.listdir(self.dir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+# Unit data patched into a prepared image, programmed into the ispsim
+# bootloader directly and through the programming station.
+
+import io
+import os
+import signal
+import tempfile
+import time
+import unittest
+
+import ispsim
+import nxpprog
+import nxpstation
+
+cpu = "lpc1768"
+
+
+class PersonalizeTest(unittest.TestCase):
+    def setUp(self):
+        self.log = nxpprog.log
+        nxpprog.log = lambda str: None
+        self.image = bytes(bytearray(range(256))) * 40
+        self.prog = nxpprog.nxpprog(cpu, None, 115200, 12000, connect=False)
+        self.prog.init_banks()
+
+    def tearDown(self):
+        nxpprog.log = self.log
+
+    def patched(self, patches):
+        image = bytearray(self.image)
+        for (addr, data) in patches:
+            image[addr:addr + len(data)] = data
+        return bytes(image)
+
+    def test_same_as_prepared_from_the_patched_image(self):
+        patches = [(0x1000, b'\x11\x22\x33\x44'), (0x10, b'\xaa\xbb')]
+        prepared = nxpprog.PreparedImage(self.prog, [(0, self.image)])
+        unit = prepared.personalize(patches)
+        fresh = nxpprog.PreparedImage(self.prog,
+                [(0, self.patched(patches))])
+        self.assertEqual(unit.segments(), fresh.segments())
+        self.assertEqual(unit.frames, fresh.frames)
+        # only the blocks under the patches are framed again
+        changed = [addr for addr in unit.frames
+                if unit.frames[addr] is not prepared.frames[addr]]
+        self.assertEqual(sorted(changed), [0, 0x1000])
+        # the prepared image is left as it was
+        self.assertEqual(prepared.segments(), nxpprog.PreparedImage(
+            self.prog, [(0, self.image)]).segments())
+
+    def test_blank_block(self):
+        # a blank block in the middle is left out of the plan
+        image = self.image[:0x2000] + b'\xff' * 0x1000 + self.image[:0x1000]
+        prepared = nxpprog.PreparedImage(self.prog, [(0, image)])
+        self.assertNotIn(0x2000, dict(prepared.segments()))
+        unit = prepared.personalize([(0x2800, b'\x01\x02\x03\x04')])
+        block = dict(unit.segments())[0x2000]
+        self.assertEqual(block[0x800:0x804], b'\x01\x02\x03\x04')
+        self.assertEqual(block[:0x800], b'\xff' * 0x800)
+
+    def test_outside_the_image(self):
+        prepared = nxpprog.PreparedImage(self.prog, [(0, self.image)])
+        self.assertRaises(SystemExit, prepared.personalize,
+                [(0x70000, b'\x01\x02\x03\x04')])
+
+    def test_program(self):
+        patches = [(0x1000, b'\x11\x22\x33\x44')]
+        sim = ispsim.IspSimulator(cpu)
+        prog = nxpprog.nxpprog(cpu, sim, 115200, 12000)
+        unit = nxpprog.PreparedImage(prog, [(0, self.image)]).personalize(
+                patches)
+        self.assertTrue(prog.prog_prepared(unit))
+        self.assertEqual(sim.mem_read(32, len(self.image) - 32),
+                self.patched(patches)[32:])
+
+
+# stands in for the process of a session that was killed
+class KilledProcess(object):
+    exitcode = -9
+
+    def is_alive(self):
+        return False
+
+
+class StationUnitsTest(unittest.TestCase):
+    def setUp(self):
+        self.log = nxpprog.log
+        self.serial_device = nxpprog.SerialDevice
+        self.sigint = signal.getsignal(signal.SIGINT)
+        nxpprog.log = lambda str: None
+        self.sims = {}
+        nxpprog.SerialDevice = lambda port, *args, **kwargs: self.sims[port]
+        self.image = bytes(bytearray(range(256))) * 40
+        self.units = nxpprog.load_units(self.units_file(
+            "# serial numbers\n"
+            "0x1000:00000001\n"
+            "\n"
+            "0x1000:00000002 0x1004:aabbccdd\n"))
+        self.out = io.StringIO()
+        self.station = nxpstation.Station([(0, self.image)], (), cpu,
+                osc_freq=12000, start=False, out=self.out, units=self.units)
+
+    def tearDown(self):
+        nxpprog.log = self.log
+        nxpprog.SerialDevice = self.serial_device
+        signal.signal(signal.SIGINT, self.sigint)
+
+    def units_file(self, text):
+        (fd, filename) = tempfile.mkstemp()
+        os.write(fd, text.encode("UTF-8"))
+        os.close(fd)
+        self.addCleanup(os.remove, filename)
+        return filename
+
+    # run the session of a board in this process and collect its result
+    def program(self, port, sim):
+        self.sims[port] = sim
+        board = nxpstation.StationBoard(port)
+        if not self.station.hand_out(board):
+            return None
+        self.station.program(port, board)
+        counted = sum(self.station.counts.values())
+        deadline = time.time() + 5
+        while sum(self.station.counts.values()) == counted and \
+                time.time() < deadline:
+            self.station.collect()
+        return board
+
+    def test_load_units(self):
+        self.assertEqual(self.units, [[(0x1000, b'\x00\x00\x00\x01')],
+            [(0x1000, b'\x00\x00\x00\x02'), (0x1004, b'\xaa\xbb\xcc\xdd')]])
+
+    def test_units_are_handed_out_in_turn(self):
+        sims = [ispsim.IspSimulator(cpu) for i in range(0, 3)]
+        self.assertTrue(self.program("a", sims[0]))
+        self.assertTrue(self.program("b", sims[1]))
+        self.assertEqual(self.program("c", sims[2]), None)
+        self.assertEqual(sims[0].mem_read(0x1000, 8),
+                b'\x00\x00\x00\x01' + self.image[0x1004:0x1008])
+        self.assertEqual(sims[1].mem_read(0x1000, 8),
+                b'\x00\x00\x00\x02\xaa\xbb\xcc\xdd')
+        self.assertEqual(self.station.counts, { "ok": 2, "failed": 0 })
+
+    def test_unit_of_a_failed_board_goes_to_the_next(self):
+        # a board that never answers the sync
+        class DeadSimulator(ispsim.IspSimulator):
+            def write(self, data):
+                pass
+        self.program("a", DeadSimulator(cpu))
+        self.assertEqual(self.station.counts, { "ok": 0, "failed": 1 })
+        sim = ispsim.IspSimulator(cpu)
+        self.program("b", sim)
+        self.assertEqual(sim.mem_read(0x1000, 4), b'\x00\x00\x00\x01')
+        self.assertEqual(self.station.counts, { "ok": 1, "failed": 1 })
+
+    def test_unit_of_a_killed_session_goes_to_the_next(self):
+        board = nxpstation.StationBoard("a")
+        self.station.hand_out(board)
+        board.process = KilledProcess()
+        self.station.boards["a"] = board
+        self.station.collect()
+        self.assertEqual(self.station.assigned, {})
+        self.assertEqual(self.station.counts, { "ok": 0, "failed": 1 })
+        sim = ispsim.IspSimulator(cpu)
+        self.program("b", sim)
+        self.assertEqual(sim.mem_read(0x1000, 4), b'\x00\x00\x00\x01')
+        self.assertEqual(self.station.counts, { "ok": 1, "failed": 1 })
+
+
+if __name__ == '__main__':
+    unittest.main()
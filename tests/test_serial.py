@@ -0,0 +1,101 @@
+# Write buffering and round trip timing of SerialDevice, over a pty, the
+# pyserial loop:// url and the tcp serial bridge of the ispsim bootloader.
+
+import os
+import socket
+import threading
+import time
+import unittest
+
+import ispsim
+import nxpprog
+
+
+# a tcp port nobody listens on
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("localhost", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+# serve ispsim on a tcp port for the rest of the run, returns the port
+def serve(cpu):
+    port = free_port()
+    thread = threading.Thread(target=ispsim.serve, args=(cpu, port))
+    thread.daemon = True
+    thread.start()
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("localhost", port)).close()
+            break
+        except OSError:
+            time.sleep(.01)
+    return port
+
+
+class SerialTest(unittest.TestCase):
+    def test_port_writes_go_out_at_once(self):
+        (master, slave) = os.openpty()
+        device = nxpprog.SerialDevice(os.ttyname(slave), 115200, timeout=1)
+        try:
+            device.write(b'OK\r\n')
+            self.assertEqual(os.read(master, 16), b'OK\r\n')
+        finally:
+            device.close()
+            os.close(master)
+            os.close(slave)
+
+    def test_url_writes_are_sent_on_read(self):
+        device = nxpprog.SerialDevice("loop://", 115200, timeout=1)
+        try:
+            device.write(b'R 0 4\r\n')
+            device.write(b'1234')
+            self.assertEqual(device._txbuf, b'R 0 4\r\n1234')
+            self.assertEqual(device.readline(), "R 0 4")
+            self.assertEqual(device.read(4), b'1234')
+        finally:
+            device.close()
+
+    def test_rtt_is_not_timed_from_large_writes(self):
+        device = nxpprog.SerialDevice("loop://", 115200, timeout=1)
+        try:
+            device.write(b'x' * 1000)
+            device.read(1000)
+            self.assertEqual(device.rtt, 0)
+            device.write(b'?')
+            device.read(1)
+            self.assertTrue(device.rtt > 0)
+        finally:
+            device.close()
+
+
+class BridgeTest(unittest.TestCase):
+    def setUp(self):
+        self.log = nxpprog.log
+        nxpprog.log = lambda str: None
+
+    def tearDown(self):
+        nxpprog.log = self.log
+
+    def test_session(self):
+        port = serve("lpc1768")
+        image = bytes(bytearray(range(256))) * 40
+        for pipeline in (False, True):
+            prog = nxpprog.nxpprog("lpc1768", "socket://localhost:%d" % port,
+                    115200, 12000)
+            try:
+                prog.pipeline = pipeline
+                self.assertTrue(prog.prog_segments([(0, image)],
+                    verify=True))
+                self.assertTrue(prog.verify_segments([(0, image)]))
+                self.assertEqual(prog.read_block(0x1000, 256),
+                        image[0x1000:0x1100])
+            finally:
+                prog.device.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+# Sessions and bookkeeping of the programming station.
+
+import io
+import signal
+import time
+import unittest
+
+import ispsim
+import nxpprog
+import nxpstation
+
+cpu = "lpc1768"
+
+
+# stands in for the process of a finished session
+class FinishedProcess(object):
+    def __init__(self, exitcode=0):
+        self.exitcode = exitcode
+
+    def is_alive(self):
+        return False
+
+
+class StationTest(unittest.TestCase):
+    def setUp(self):
+        self.log = nxpprog.log
+        self.serial_device = nxpprog.SerialDevice
+        self.sigint = signal.getsignal(signal.SIGINT)
+        nxpprog.log = lambda str: None
+        self.sim = ispsim.IspSimulator(cpu)
+        nxpprog.SerialDevice = lambda port, *args, **kwargs: self.sim
+        self.image = bytes(bytearray(range(256))) * 40
+        self.station = nxpstation.Station([(0, self.image)], (), cpu,
+                osc_freq=12000, start=False, out=io.StringIO())
+
+    def tearDown(self):
+        nxpprog.log = self.log
+        nxpprog.SerialDevice = self.serial_device
+        signal.signal(signal.SIGINT, self.sigint)
+
+    def test_flash_is_verified_once(self):
+        board = nxpstation.StationBoard("a")
+        self.station.boards["a"] = board
+        self.station.program("a", board)
+        deadline = time.time() + 5
+        while not board.reported and time.time() < deadline:
+            self.station.collect()
+        self.assertEqual(board.state, "done")
+        commands = [c.split()[0] for c in self.sim.commands]
+        self.assertIn("M", commands)
+        self.assertNotIn("R", commands)
+        self.assertEqual(self.sim.mem_read(32, len(self.image) - 32),
+                self.image[32:])
+
+    def test_board_is_kept_until_its_result_is_in(self):
+        board = nxpstation.StationBoard("a")
+        self.assertTrue(self.station.finished(board))
+        board.process = FinishedProcess()
+        self.assertFalse(self.station.finished(board))
+        board.reported = True
+        self.assertTrue(self.station.finished(board))
+
+    def test_board_whose_process_died_has_failed(self):
+        board = nxpstation.StationBoard("a")
+        board.process = FinishedProcess(-9)
+        self.station.boards["a"] = board
+        self.assertFalse(self.station.finished(board))
+        self.station.collect()
+        self.assertTrue(self.station.finished(board))
+        self.assertEqual(board.state, "failed")
+        self.assertEqual(self.station.counts, { "ok": 0, "failed": 1 })
+        # it is reported once
+        self.station.collect()
+        self.assertEqual(self.station.counts, { "ok": 0, "failed": 1 })
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+# UdpFleet sessions against an ispsim bootloader answering over udp.
+
+import os
+import socket
+import threading
+import unittest
+
+import ispsim
+import nxpprog
+import udpfleet
+
+
+# an ethernet isp target on the loopback interface. Every answer is sent
+# as one datagram, preceded by a datagram of line ends only when blank is
+# set. The answers to the commands in drop are lost once.
+class UdpTarget(threading.Thread):
+    def __init__(self, cpu, blank=False, drop=()):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.sim = ispsim.IspSimulator(cpu)
+        self.blank = blank
+        self.drop = list(drop)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.settimeout(.1)
+        self.port = self.sock.getsockname()[1]
+        self.running = True
+
+    def stop(self):
+        self.running = False
+        self.join()
+        self.sock.close()
+
+    def run(self):
+        while self.running:
+            try:
+                data, addr = self.sock.recvfrom(4096)
+            except socket.timeout:
+                continue
+            self.sim.write(data)
+            answer = self.sim.outbuf
+            self.sim.outbuf = b''
+            if not answer:
+                continue
+            command = data.strip().decode("UTF-8", "ignore")
+            if command in self.drop:
+                self.drop.remove(command)
+                continue
+            if self.blank:
+                self.sock.sendto(b'\r\n', addr)
+            self.sock.sendto(answer, addr)
+
+
+class UdpFleetTest(unittest.TestCase):
+    def setUp(self):
+        self.log = nxpprog.log
+        nxpprog.log = lambda str: None
+        self.image = os.urandom(3000)
+
+    def tearDown(self):
+        nxpprog.log = self.log
+
+    def program(self, target):
+        target.start()
+        fleet = udpfleet.UdpFleet([(0, self.image)], "lpc1768", 12000,
+                port=0, verify=True, start=False, timeout=.3)
+        try:
+            fleet.add("127.0.0.1", target.port)
+            results = fleet.run()
+        finally:
+            fleet.close()
+            target.stop()
+        self.assertEqual(len(results), 1)
+        return results[0]
+
+    def flash(self, target):
+        # the vector checksum is inserted into the image
+        return target.sim.mem_read(32, len(self.image) - 32)
+
+    def test_program(self):
+        target = UdpTarget("lpc1768")
+        result = self.program(target)
+        self.assertEqual(result["result"], "ok", result.get("error"))
+        self.assertEqual(self.flash(target), self.image[32:])
+
+    def test_blank_datagrams_hold_no_line(self):
+        target = UdpTarget("lpc1768", blank=True)
+        result = self.program(target)
+        self.assertEqual(result["result"], "ok", result.get("error"))
+        self.assertEqual(self.flash(target), self.image[32:])
+
+    def test_lost_answer_is_asked_for_again(self):
+        target = UdpTarget("lpc1768", drop=("U 23130",))
+        result = self.program(target)
+        self.assertEqual(result["result"], "ok", result.get("error"))
+        self.assertEqual(result["retries"], 1)
+        self.assertEqual(self.flash(target), self.image[32:])
+
+    def test_targets_on_one_host(self):
+        targets = [UdpTarget("lpc1768"), UdpTarget("lpc1768")]
+        fleet = udpfleet.UdpFleet([(0, self.image)], "lpc1768", 12000,
+                port=0, verify=True, start=False, timeout=.3)
+        try:
+            for target in targets:
+                target.start()
+                fleet.add("127.0.0.1", target.port)
+            self.assertRaises(SystemExit, fleet.add, "127.0.0.1",
+                    targets[0].port)
+            results = fleet.run()
+        finally:
+            fleet.close()
+            for target in targets:
+                target.stop()
+        self.assertEqual([r["result"] for r in results], ["ok", "ok"])
+        for target in targets:
+            self.assertEqual(self.flash(target), self.image[32:])
+
+
+if __name__ == '__main__':
+    unittest.main()
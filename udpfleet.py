@@ -0,0 +1,408 @@
+#!/usr/bin/python3
+#
+# Programming many Ethernet ISP targets at once.
+#
+# nxpprog.py --fleet=<file> programs every target listed in the file from a
+# single process. All targets share one UDP socket bound to the ISP port.
+# Replies are handed to the target they came from by their source address
+# and every target runs its own ISP session, a generator that yields the
+# datagrams to send and gets the lines the target answers with, through
+# sync, unlock, erase, write, copy and verify. One selector loop drives all
+# sessions so a single core keeps hundreds of boards busy.
+
+import binascii
+import selectors
+import socket
+import time
+
+import nxpprog
+
+
+class TargetError(Exception):
+    pass
+
+
+class FleetTarget(object):
+    def __init__(self, fleet, address):
+        self.fleet = fleet
+        self.address = address
+        self.cpu = fleet.cpu
+        self.echo = True
+        self.state = "sync"
+        self.error = None
+        self.started = time.time()
+        self.finished = None
+        self.resends = 0
+        self.retries = 0
+
+        # received lines not yet consumed by the session
+        self.lines = []
+        self.rxbuf = b''
+        # the time the line the session waits for is due
+        self.deadline = None
+
+        self.session = self.run()
+
+    def receive(self, data):
+        self.rxbuf += data
+        # like UdpDevice.readline a datagram always ends a line
+        if not self.rxbuf.endswith(b'\n'):
+            self.rxbuf += b'\n'
+        while b'\n' in self.rxbuf:
+            line, sep, self.rxbuf = self.rxbuf.partition(b'\n')
+            line = line.decode("UTF-8", "ignore").replace('\r', '')
+            if line:
+                self.lines.append(line)
+
+    def fail(self, msg):
+        raise TargetError("%s: %s" % (self.state, msg))
+
+    # the session steps below are generators, every yield sends a list of
+    # datagrams and waits at most timeout seconds for the next line
+
+    def readline(self, timeout=None):
+        line = yield ([], timeout)
+        return line
+
+    # a command whose answer is lost is sent again, like isp_command does
+    def command(self, cmd):
+        for retry in range(0, 3):
+            line = yield ([(cmd + "\r\n").encode("UTF-8")], None)
+            if self.echo and line == cmd:
+                line = yield ([], None)
+            if line is not None:
+                break
+            self.retries += 1
+        return line
+
+    def isp_command(self, cmd):
+        status = yield from self.command(cmd)
+        if status is None:
+            self.fail("'%s' timeout" % cmd)
+        if status != str(nxpprog.CMD_SUCCESS):
+            self.fail("'%s' error %s" % (cmd, status))
+
+    def sync(self):
+        for i in range(0, self.fleet.sync_retries):
+            line = yield ([b'?'], self.fleet.sync_timeout)
+            if line == "Synchronized":
+                break
+        else:
+            self.fail("no sync string")
+
+        line = yield ([b"Synchronized\r\n"], None)
+        if line == "Synchronized":
+            self.echo = True
+            line = yield from self.readline()
+        elif line == "OK":
+            self.echo = False
+        if line != "OK":
+            self.fail("not ok")
+
+        status = yield from self.command("%d" % self.fleet.osc_freq)
+        if status not in ("OK", str(nxpprog.INVALID_COMMAND)):
+            self.fail("osc not ok")
+
+        status = yield from self.command("A 0")
+        if status == str(nxpprog.CMD_SUCCESS):
+            self.echo = False
+        elif status != str(nxpprog.INVALID_COMMAND):
+            self.fail("echo disable failed")
+
+    def get_devid(self):
+        status = yield from self.command("J")
+        if status != str(nxpprog.CMD_SUCCESS):
+            self.fail("'J' error %s" % status)
+        id1 = yield from self.readline()
+        id2 = yield from self.readline(.2)
+        if id1 is None:
+            self.fail("'J' timeout")
+        if id2:
+            return (int(id1), int(id2))
+        return int(id1)
+
+    def write_ram_data(self, addr, data):
+        block_size = self.fleet.uu_block_size
+        line_size = self.fleet.uu_line_size
+
+        for i in range(0, len(data), block_size):
+            block = data[i:i + block_size]
+            yield from self.isp_command("W %d %d" % (addr + i, len(block)))
+
+            lines = [binascii.b2a_uu(block[j:j + line_size])
+                    for j in range(0, len(block), line_size)]
+            lines.append(("%d\r\n" % sum(block)).encode("UTF-8"))
+
+            for retry in range(0, 3):
+                status = yield (lines, None)
+                # the checksum may have been lost, send it again
+                for timeout in range(0, 2):
+                    if status is not None:
+                        break
+                    self.retries += 1
+                    status = yield (lines[-1:], None)
+                if status == "OK":
+                    break
+                if status is None:
+                    self.fail("checksum timeout")
+                if status != "RESEND":
+                    self.fail("write error: %s" % status)
+                self.resends += 1
+            else:
+                self.fail("write error: too many resends")
+
+    def run(self):
+        yield from self.sync()
+
+        if self.cpu == "autodetect":
+            devid = yield from self.get_devid()
+            self.cpu = nxpprog.cpu_from_devid(devid)
+            if not self.cpu:
+                self.fail("unknown device id %s" %
+                        nxpprog.format_devid(devid))
+
+        yield from self.isp_command("U 23130")
+
+        plan = self.fleet.plan(self.cpu)
+
+        self.state = "erase"
+        for cmd in plan["erase"]:
+            yield from self.isp_command(cmd)
+
+        for (flash_addr, block, prepare) in plan["blocks"]:
+            self.state = "write"
+            yield from self.write_ram_data(plan["ram_addr"], block)
+
+            self.state = "copy"
+            yield from self.isp_command(prepare)
+            yield from self.isp_command("C %d %d %d" %
+                    (flash_addr, plan["ram_addr"], len(block)))
+
+            if self.fleet.verify:
+                self.state = "verify"
+                status = yield from self.command("M %d %d %d" %
+                        (flash_addr, plan["ram_addr"], len(block)))
+                if status == str(nxpprog.COMPARE_ERROR):
+                    offset = yield from self.readline()
+                    self.fail("content differs at 0x%x" %
+                            (flash_addr + int(offset or 0)))
+                elif status != str(nxpprog.CMD_SUCCESS):
+                    self.fail("'M' error %s" % status)
+
+        if plan["start"]:
+            self.state = "start"
+            yield from self.isp_command(plan["start"])
+
+        self.state = "done"
+
+    def result(self):
+        result = {
+            "address": "%s:%d" % self.address,
+            "cpu": self.cpu,
+            "state": self.state,
+            "result": "failed" if self.error else "ok",
+            "resends": self.resends,
+            "retries": self.retries,
+            "seconds": round((self.finished or time.time()) - self.started,
+                3),
+        }
+        if self.error:
+            result["error"] = self.error
+        return result
+
+
+class UdpFleet(object):
+    def __init__(self, segments, cpu="autodetect", osc_freq=16000,
+            port=41825, erase_all=False, verify=False, start=True,
+            timeout=5):
+        self.segments = segments
+        self.cpu = cpu
+        self.osc_freq = osc_freq
+        self.port = port
+        self.erase_all = erase_all
+        self.verify = verify
+        self.start = start
+        self.timeout = timeout
+        self.sync_timeout = .5
+        self.sync_retries = 10
+        self.uu_line_size = 45
+        self.uu_block_size = self.uu_line_size * 20
+
+        # programming plans per cpu type
+        self.plans = {}
+        # targets by (ip address, port), the address replies come from
+        self.targets = {}
+        # datagrams waiting for room in the socket buffer
+        self.txqueue = []
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        # replies of many targets can arrive at once
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        self.sock.bind(('', port))
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ)
+
+    def close(self):
+        self.selector.close()
+        self.sock.close()
+
+    def add(self, ip, port=None):
+        address = (ip, port or self.port)
+        if address in self.targets:
+            nxpprog.panic("%s:%d is in the fleet twice" % address)
+        self.targets[address] = FleetTarget(self, address)
+
+    # the commands to program the image into a cpu, worked out once per
+    # cpu type with the sector plan of nxpprog
+    def plan(self, cpu):
+        if cpu in self.plans:
+            return self.plans[cpu]
+
+        prog = nxpprog.nxpprog(cpu, None, 0, self.osc_freq, connect=False)
+        prog.init_banks()
+        ram_block = prog.get_cpu_parm("flash_prog_buffer_size",
+                nxpprog.flash_prog_buffer_size_default)
+        runs = prog.sector_plan(prog.bootable_segments(self.segments),
+                ram_block)
+
+        erase = []
+        if self.erase_all:
+            end_sector = prog.flash_sector_count() - 1
+            runs_erased = [(bank, 0, end_sector)
+                    for bank in range(0, prog.flash_bank_count())]
+        else:
+            runs_erased = [(bank, s, e) for (bank, s, e, blocks) in runs]
+        for (bank, s, e) in runs_erased:
+            erase.append(prog.sector_command("P", s, e, bank))
+            erase.append(prog.sector_command("E", s, e, bank))
+
+        blocks = []
+        for (bank, s, e, run_blocks) in runs:
+            for (flash_addr, block) in run_blocks:
+                prepare = prog.sector_command("P",
+                        prog.find_flash_sector(flash_addr),
+                        prog.find_flash_sector(flash_addr + len(block) - 1),
+                        bank)
+                blocks.append((flash_addr, block, prepare))
+
+        start = None
+        if self.start:
+            mode = prog.get_cpu_parm("cpu_type", "arm")
+            start = "G %d %s" % (self.segments[0][0],
+                    "T" if mode == "thumb" else "A")
+
+        plan = {
+            "ram_addr": prog.get_cpu_parm("flash_prog_buffer_base",
+                nxpprog.flash_prog_buffer_base_default),
+            "erase": erase,
+            "blocks": blocks,
+            "start": start,
+        }
+        self.plans[cpu] = plan
+        return plan
+
+    def send(self, target, datagrams):
+        for data in datagrams:
+            if self.txqueue:
+                self.txqueue.append((data, target.address))
+                continue
+            try:
+                self.sock.sendto(data, target.address)
+            except BlockingIOError:
+                self.txqueue.append((data, target.address))
+                self.selector.modify(self.sock,
+                        selectors.EVENT_READ | selectors.EVENT_WRITE)
+
+    def flush(self):
+        while self.txqueue:
+            (data, address) = self.txqueue[0]
+            try:
+                self.sock.sendto(data, address)
+            except BlockingIOError:
+                return
+            self.txqueue.pop(0)
+        self.selector.modify(self.sock, selectors.EVENT_READ)
+
+    # feed line (None for a timeout) to the session of target and send
+    # what it answers with, repeated while lines are waiting
+    def advance(self, target, line):
+        while True:
+            try:
+                (datagrams, timeout) = target.session.send(line)
+            except StopIteration:
+                target.finished = time.time()
+                nxpprog.log("%s:%d: done in %.1f seconds" % (target.address +
+                    (target.finished - target.started,)))
+                return
+            except TargetError as e:
+                target.error = str(e)
+                target.finished = time.time()
+                nxpprog.log("%s:%d: failed in %s" % (target.address +
+                    (e,)))
+                return
+            self.send(target, datagrams)
+            target.deadline = time.time() + (timeout or self.timeout)
+            if not target.lines:
+                return
+            line = target.lines.pop(0)
+
+    def receive(self):
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(2048)
+            except BlockingIOError:
+                return
+            except ConnectionError:
+                # an icmp error for an earlier datagram
+                continue
+            target = self.targets.get(addr[:2])
+            if target and not target.finished:
+                target.receive(data)
+                # a datagram of line ends only holds no line
+                if target.deadline is not None and target.lines:
+                    target.deadline = None
+                    self.advance(target, target.lines.pop(0))
+
+    # run all sessions to the end, returns the result of every target
+    def run(self):
+        for target in self.targets.values():
+            self.advance(target, None)
+
+        while True:
+            active = [t for t in self.targets.values() if not t.finished]
+            if not active:
+                break
+
+            now = time.time()
+            for target in active:
+                if target.deadline is not None and target.deadline <= now:
+                    target.deadline = None
+                    self.advance(target, None)
+
+            deadlines = [t.deadline for t in active
+                    if not t.finished and t.deadline is not None]
+            wait = max(0, min(deadlines) - time.time()) if deadlines else 0
+            for (key, events) in self.selector.select(wait):
+                if events & selectors.EVENT_WRITE:
+                    self.flush()
+                if events & selectors.EVENT_READ:
+                    self.receive()
+
+        return [target.result() for target in self.targets.values()]
+
+
+# read a fleet file, one target ip address, optionally followed by :port,
+# per line. Empty lines and lines starting with # are ignored.
+def load_fleet(filename):
+    targets = []
+    for line in open(filename, "r"):
+        line = line.split('#')[0].strip()
+        if not line:
+            continue
+        if ':' in line:
+            ip, port = line.rsplit(':', 1)
+            targets.append((ip, int(port)))
+        else:
+            targets.append((line, None))
+    return targets